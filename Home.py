@@ -1,5 +1,10 @@
 import streamlit as st
 
+from utils.warmup import start_warmup
+
+#The compute stack of the evaluation page is warmed in the background, see utils.warmup.
+start_warmup()
+
 st.image("images/logo_H2G.png")
 
 st.header("""Our vision""")
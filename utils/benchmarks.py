@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the hot paths of the H2Global mechanism app.
+
+Measures the stages of one evaluation of the page over a grid of cases
+(funding period, number of simulated paths, sales price volatility and
+re-usage cycles of sales revenue):
+
+    simulate             pm.Mechanism.simulate_mechanism(), without cache
+    data_to_plot         annual result columns as pandas.DataFrame
+    fiscal               get_fiscal_npv() on the annual mean values
+    fiscal_distribution  path-wise fiscal NPV distribution
+    figures              construction and serialization of all figures
+
+Results are written as JSON, so that runs of different commits can be compared.
+
+Usage:
+    python -m utils.benchmarks -o benchmarks.json
+    python -m utils.benchmarks -o new.json --baseline old.json
+    python -m utils.benchmarks --compare old.json new.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from importlib import metadata
+
+import numpy as np
+
+from utils.h2global_model import Scenario, ScenarioResults
+from utils.simulation_cache import simulate_mechanism
+from utils.fiscal_engine import get_fiscal_npv, get_fiscal_npv_distribution
+
+#Grid of benchmark cases
+BENCHMARK_GRID = {
+    "PERIOD" : (5, 10, 20, 30),
+    "NUMBER_PATHS" : (100, 1000, 10000),
+    "SALES_PRICE_VOLATILITY" : (0.0, 0.05),
+    "REINVEST_CYCLES" : (0, 2, -1),
+    }
+
+#Reduced grid for quick checks
+BENCHMARK_GRID_QUICK = {
+    "PERIOD" : (10, 30),
+    "NUMBER_PATHS" : (1000,),
+    "SALES_PRICE_VOLATILITY" : (0.0, 0.05),
+    "REINVEST_CYCLES" : (2, -1),
+    }
+
+BENCHMARK_STAGES = ("simulate", "data_to_plot", "fiscal", "fiscal_distribution", "figures")
+
+#Relative slowdown of the median, which is reported as regression
+REGRESSION_THRESHOLD = 1.2
+
+
+def get_benchmark_scenarios(grid=BENCHMARK_GRID):
+    """
+    Returns the scenarios of the cartesian product of grid. The depreciation
+    period is extended to the funding period, where necessary.
+    """
+    keys = list(grid)
+    scenarios = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        case = dict(zip(keys, values))
+        DEPRECIATION_PERIOD = max(Scenario.DEPRECIATION_PERIOD, case.get("PERIOD", Scenario.PERIOD))
+        scenarios.append(Scenario(DEPRECIATION_PERIOD=DEPRECIATION_PERIOD, **case))
+    return scenarios
+
+
+def _time_stage(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _run_figures(scenario, ATTR):
+    #plotly is only imported, if figures are benchmarked.
+    from utils.h2global_charts import METRICS
+    results = ScenarioResults(scenario, ATTR=ATTR)
+    for metric, (get_figure, _) in METRICS.items():
+        if metric == "VIS_5_DISTRIBUTION" and scenario.SALES_PRICE_VOLATILITY == 0:
+            continue
+        get_figure(results).to_json()
+
+
+def _run_fiscal(scenario, ATTR):
+    results = ScenarioResults(scenario, ATTR=ATTR)
+    return get_fiscal_npv(
+        ANNUAL_PRODUCTION=results["Hydrogen Purchases [kg]"],
+        ANNUAL_PRODUCT_PURCHASES=results["Hydrogen Purchases [$]"],
+        ANNUAL_PRODUCT_SALES=results["Annual Sales [$]"],
+        ANNUAL_FUNDING=results["Used Funding Volume [$]"],
+        **scenario.get_fiscal_parameters()
+        )
+
+
+def benchmark_scenario(scenario, stages=BENCHMARK_STAGES, repeat=5):
+    """
+    Returns the run times of all stages for one scenario as list of records.
+    """
+    MECHANISM_INPUTS = scenario.get_mechanism_inputs()
+    ATTR = simulate_mechanism(**MECHANISM_INPUTS)
+
+    STAGE_FUNCTIONS = {
+        "simulate" : lambda: simulate_mechanism(**MECHANISM_INPUTS),
+        "data_to_plot" : lambda: ScenarioResults(scenario, ATTR=ATTR).to_dataframe(),
+        "fiscal" : lambda: _run_fiscal(scenario, ATTR),
+        "fiscal_distribution" : lambda: get_fiscal_npv_distribution(ATTR=ATTR, **scenario.get_fiscal_parameters()),
+        "figures" : lambda: _run_figures(scenario, ATTR),
+        }
+
+    case = {key: getattr(scenario, key) for key in BENCHMARK_GRID}
+    records = []
+    for stage in stages:
+        #____One warm-up run, e.g. for imports.
+        STAGE_FUNCTIONS[stage]()
+        times = _time_stage(STAGE_FUNCTIONS[stage], repeat)
+        records.append({
+            "STAGE" : stage,
+            "CASE" : case,
+            "TIMES" : times,
+            "MIN" : min(times),
+            "MEDIAN" : float(np.median(times)),
+            })
+    return records
+
+
+def _get_version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def get_environment():
+    """
+    Returns the environment of a benchmark run: versions, machine and commit.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "COMMIT" : commit,
+        "TIMESTAMP" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "PYTHON" : sys.version.split()[0],
+        "PLATFORM" : platform.platform(),
+        "PROCESSOR" : platform.processor() or platform.machine(),
+        "CPU_COUNT" : os.cpu_count(),
+        "PACKAGES" : {p: _get_version(p) for p in ("numpy", "pandas", "plotly", "pymechanism")},
+        }
+
+
+def run_benchmarks(grid=BENCHMARK_GRID, stages=BENCHMARK_STAGES, repeat=5, progress=None):
+    """
+    Runs all stages for all cases of grid and returns the benchmark results.
+    """
+    scenarios = get_benchmark_scenarios(grid)
+    records = []
+    for i, scenario in enumerate(scenarios):
+        records.extend(benchmark_scenario(scenario, stages=stages, repeat=repeat))
+        if progress is not None:
+            progress(i+1, len(scenarios))
+    return {
+        "ENVIRONMENT" : get_environment(),
+        "REPEAT" : repeat,
+        "RESULTS" : records,
+        }
+
+
+def _get_record_key(record):
+    return record["STAGE"] + " " + json.dumps(record["CASE"], sort_keys=True)
+
+
+def compare_benchmarks(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """
+    Returns the ratio of the median run times of results and baseline for
+    each stage and case, which is contained in both, and the list of
+    regressions (ratio above threshold).
+    """
+    baseline_records = {_get_record_key(r): r for r in baseline["RESULTS"]}
+    ratios = {}
+    for record in results["RESULTS"]:
+        key = _get_record_key(record)
+        if key in baseline_records and baseline_records[key]["MEDIAN"] > 0:
+            ratios[key] = record["MEDIAN"] / baseline_records[key]["MEDIAN"]
+    regressions = sorted((k for k, r in ratios.items() if r > threshold), key=ratios.get, reverse=True)
+    return ratios, regressions
+
+
+def _print_summary(results):
+    by_stage = {}
+    for record in results["RESULTS"]:
+        by_stage.setdefault(record["STAGE"], []).append(record["MEDIAN"])
+    for stage, medians in by_stage.items():
+        print("{:<20} median {:9.2f} ms   max {:9.2f} ms   ({} cases)".format(
+            stage, np.median(medians)*1e3, np.max(medians)*1e3, len(medians)))
+
+
+def _print_comparison(ratios, regressions, threshold):
+    if not ratios:
+        print("No common benchmark cases.")
+        return
+    print("Geometric mean of the ratio new/old:", round(float(np.exp(np.mean(np.log(list(ratios.values()))))), 3))
+    print("Regressions above", threshold, ":", len(regressions))
+    for key in regressions:
+        print("  {:6.2f}x  {}".format(ratios[key], key))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the simulation, fiscal and chart stages.")
+    parser.add_argument("-o", "--output", default="benchmarks.json", help="JSON file for the benchmark results.")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of timed runs per stage and case.")
+    parser.add_argument("--quick", action="store_true", help="Run a reduced grid of cases.")
+    parser.add_argument("--stages", nargs="+", choices=BENCHMARK_STAGES, default=BENCHMARK_STAGES, help="Stages to benchmark.")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run, to which the results are compared.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None, help="Only compare two JSON files of earlier runs.")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Ratio of medians, which is reported as regression.")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+    else:
+        def progress(done, total):
+            print("Finished case", done, "of", total, flush=True)
+
+        results = run_benchmarks(
+            grid=BENCHMARK_GRID_QUICK if args.quick else BENCHMARK_GRID,
+            stages=args.stages,
+            repeat=args.repeat,
+            progress=progress
+            )
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        _print_summary(results)
+        print("Results in", args.output)
+        if args.baseline is None:
+            return
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    ratios, regressions = compare_benchmarks(baseline, results, args.threshold)
+    _print_comparison(ratios, regressions, args.threshold)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
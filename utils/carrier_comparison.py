@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Comparison of energy carriers under the same funding settings.
+
+The scenario of each carrier shares the funding volume, the funding period
+and all further specifications of the mechanism and the fiscal model with a
+base scenario. The base carrier keeps the prices of the base scenario, the
+other carriers are evaluated at their default prices and with the default
+parameters of their downstream chain. Mechanism inputs, which are not cached
+yet, are simulated in parallel on a process pool, so that the comparison of
+several carriers takes about as long as one simulation. The fiscal model of
+all carriers is evaluated in one batch.
+"""
+
+import numpy as np
+
+from utils.h2global_model import DICT_DOWNSTREAM_PARAMETERS, Scenario, ScenarioResults, get_price_defaults
+from utils.simulation_cache import get_mechanism_attrs
+from utils.sensitivity import get_fiscal_npv_batch
+from utils.instrumentation import instrumented
+
+#Totals of the comparison table: ScenarioResults attribute --> column
+COMPARISON_METRICS = {
+    "TOTAL_PURCHASES_TONS" : "Traded product [tons]",
+    "TOTAL_PURCHASES_USD" : "Purchases [US$]",
+    "TOTAL_USED_FUNDING_USD" : "Used funding [US$]",
+    "TOTAL_MITIGATED_CO2_TONS" : "Mitigated CO2-emissions [tons]",
+    "MAX_ELECTROLYZER_GW" : "Required electrolyzer capacity [GW]",
+    "FISCAL_NPV" : "Net-present value of fiscal benefits [US$]",
+    }
+
+#Annual columns, which are overlaid for all carriers in the comparison charts
+COMPARISON_COLUMNS = (
+    "Hydrogen Purchases [tons]",
+    "Mitigated CO2-emissions [tons]",
+    "Required installed electrolyzer capacity [GW]",
+    )
+
+
+def get_carrier_scenario(scenario, carrier):
+    """
+    Returns the scenario of carrier with the funding settings of scenario,
+    see module docstring.
+    """
+    if carrier == scenario.CARRIER:
+        return scenario
+    DEFAULT_SCENARIO = Scenario()
+    PURCHASE_PRICE_START, PURCHASE_PRICE_END, SALES_PRICE_START, SALES_PRICE_END = get_price_defaults(carrier)
+    return scenario.replace(
+        CARRIER=carrier,
+        PURCHASE_PRICE_START=PURCHASE_PRICE_START,
+        PURCHASE_PRICE_END=PURCHASE_PRICE_END,
+        SALES_PRICE_START=SALES_PRICE_START,
+        SALES_PRICE_END=SALES_PRICE_END,
+        PURCHASE_PRICE=None,
+        SALES_PRICE=None,
+        PURCHASE_PRICE_PATH=None,
+        SALES_PRICE_PATH=None,
+        **{name: getattr(DEFAULT_SCENARIO, name) for name in DICT_DOWNSTREAM_PARAMETERS.get(carrier, ())}
+        )
+
+
+@instrumented("carrier_comparison")
+def run_carrier_comparison(scenario, CARRIERS, store=None, max_workers=None):
+    """
+    Evaluates the scenarios of CARRIERS with the funding settings of scenario.
+
+    Returns a dictionary with
+        "CARRIERS" : Evaluated carriers
+        "SCENARIOS" : Scenario of each carrier
+        "RESULTS" : ScenarioResults of each carrier
+        "TABLE" : Totals of each carrier, {metric: array}, see COMPARISON_METRICS.
+    """
+    CARRIERS = list(CARRIERS)
+    SCENARIOS = [get_carrier_scenario(scenario, carrier) for carrier in CARRIERS]
+    for s in SCENARIOS:
+        s.validate()
+
+    ATTRS = get_mechanism_attrs(
+        [s.get_mechanism_inputs() for s in SCENARIOS],
+        max_workers=max_workers,
+        )
+    RESULTS = [ScenarioResults(s, store=store, ATTR=ATTR, memoize=True) for s, ATTR in zip(SCENARIOS, ATTRS)]
+    FISCAL_NPV = get_fiscal_npv_batch(RESULTS)
+
+    return {
+        "CARRIERS" : CARRIERS,
+        "SCENARIOS" : SCENARIOS,
+        "RESULTS" : RESULTS,
+        "TABLE" : {
+            METRIC: FISCAL_NPV if METRIC == "FISCAL_NPV" else np.array([float(getattr(r, METRIC)) for r in RESULTS])
+            for METRIC in COMPARISON_METRICS
+            },
+        }
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the energy carriers of the H2Global mechanism.
+
+All constants of a carrier are rows of one table, CARRIER_TABLE: short name,
+efficiency, lower heating value, emission reduction, investment costs,
+default prices and the domestic downstream chain of the fiscal model. The
+table is indexed once at import, per-carrier dictionaries and arrays over all
+carriers are derived from it, so that models look up carriers by index
+instead of branching on the carrier name.
+
+This module only depends on numpy.
+"""
+
+import numpy as np
+
+#Domestic downstream chains of the fiscal model: part of the domestically
+#sold carrier is processed into a downstream product, whose domestic sales are subject to VAT.
+#____The parameters are attributes of Scenario, in the order of DOWNSTREAM_ROLES.
+DOWNSTREAM_ROLES = ("SHARE_DOMESTIC_USE", "SALES_PRICE", "OUTPUT_PER_KG", "SHARE_DOMESTIC_SALES", "VAT_BOOL")
+DOWNSTREAM_CHAINS = {
+    "DRI" : {
+        "CATEGORY" : "VAT_DRI",
+        "PARAMETERS" : ("SHARE_H2_DRI_DOMESTIC", "DRI_SALES_PRICE", "DRI_PER_KG_H2", "SHARE_DOMESTIC_SALES_DRI", "VAT_DRI_BOOL"),
+        "VAT_LABEL" : "Revenue from domestic DRI sales",
+        #____Inputs of the app: parameter, label, default, step, value of the app per unit of the parameter
+        "INPUTS" : (
+            ("SHARE_H2_DRI_DOMESTIC", "Share of hydrogen which is used for the domestic production of DRI [%]", 50, 1, 100),
+            ("DRI_SALES_PRICE", "Domestic sales price of DRI [USD/ton]", 300, 10, 1000),
+            ("DRI_PER_KG_H2", "DRI production per consumed hydrogen [kg-DRI/kg-H2]", 20, 1, 1),
+            ("SHARE_DOMESTIC_SALES_DRI", "Share of DRI which is sold domestically [%]", 100, 1, 100),
+            ),
+        },
+    "FERTILIZER" : {
+        "CATEGORY" : "VAT_FERTILIZER",
+        "PARAMETERS" : ("SHARE_NH3_FERTILIZER_DOMESTIC", "FERTILIZER_SALES_PRICE", "FERTILIZER_PER_KG_NH3", "SHARE_DOMESTIC_SALES_FERTILIZER", "VAT_FERTILIZER_BOOL"),
+        "VAT_LABEL" : "Revenue from domestic fertilizer sales",
+        "INPUTS" : (
+            ("SHARE_NH3_FERTILIZER_DOMESTIC", "Share of ammonia which is used for the domestic production of fertilizer [%]", 50, 1, 100),
+            ("FERTILIZER_SALES_PRICE", "Domestic sales price of ammonia-based fertilizer [USD/ton]", 500, 10, 1000),
+            ("FERTILIZER_PER_KG_NH3", "Fertilizer (urea) production per consumed ammonia [kg-fertilizer/kg-NH3]", 2.0, 0.1, 1),
+            ("SHARE_DOMESTIC_SALES_FERTILIZER", "Share of fertilizer which is sold domestically [%]", 100, 1, 100),
+            ),
+        },
+    }
+
+#Constants of each carrier
+#____SHORT: Short name for labels
+#____EFFICIENCY: Efficiency from renewable electricity to carrier
+#____LHV: Lower heating value
+#____EMISSION_REDUCTION: Reduced CO2-emissions compared to the grey product [kg_CO2/kg]
+#________Emissions according to EU commission: https://eur-lex.europa.eu/legal-content/EN/TXT/?uri=uriserv%3AOJ.L_.2023.157.01.0020.01.ENG&toc=OJ%3AL%3A2023%3A157%3ATOC
+#________Grey Methanol: 97.1 gCO2eq/MJ, LHV: 19.9 MJ/kg --> 1932.3 gCO2eq/kg
+#________Grey Ammonia: 2351.3 gCO2eq/kg, LHV: 18.8 MJ/kg --> 2351.3 gCO2eq/kg
+#________Grey Kerosene: --> 3150 gCO2/kgSAF
+#________Reference: RED II --> Green hydrogen must mitigate CO2-emissions by a min. of 3.38 kg_CO2/kg_H2
+#________Reference: Buberger et al. (2022)
+#____CAPEX_PER_KG: Investment costs of the production project per annual production capacity [US$/(kg/year)]
+#________Hydrogen: Evaluation Kenya White Paper: 22.3 (Turkana South 500 MW), Turkana Central 10 MW: 38.4, Kisumu 10GW: 57.5 €/kg H2/year
+#________Ammonia: Evaluation Kenya White Paper: 5.2 (Turkana South 500 MW), Turkana Central 10 MW: 10.6, Kisumu 10GW: 15.7 €/kg NH3/year
+#________SAF and Methanol: Investment costs of hydrogen per kg of hydrogen input (about 0.5 kg_H2/kg_SAF, 0.19 kg_H2/kg_MeOH) plus synthesis.
+#____PRICE_DEFAULTS: Default prices of the app: purchase price start/end, sales price start/end [US$/kg]
+#________SAF and Methanol use the defaults of hydrogen.
+#____DOWNSTREAM: Domestic downstream chain of the fiscal model, see DOWNSTREAM_CHAINS, or None
+CARRIER_TABLE = {
+    "Hydrogen" : {
+        "SHORT" : "Hydrogen",
+        "EFFICIENCY" : 0.7,
+        "LHV" : 33.33,
+        "EMISSION_REDUCTION" : 3.38,
+        "CAPEX_PER_KG" : 45,
+        "PRICE_DEFAULTS" : (6.0, 6.0, 3.0, 4.5),
+        "DOWNSTREAM" : "DRI",
+        },
+    "Ammonia" : {
+        "SHORT" : "Ammonia",
+        "EFFICIENCY" : 0.7*0.55,
+        "LHV" : 5.2,
+        "EMISSION_REDUCTION" : 2.351*0.7,
+        "CAPEX_PER_KG" : 10,
+        "PRICE_DEFAULTS" : (1.0, 1.0, 0.5, 0.65),
+        "DOWNSTREAM" : "FERTILIZER",
+        },
+    "Sustainable Aviation Fuel (SAF)" : {
+        "SHORT" : "SAF",
+        "EFFICIENCY" : 0.7*0.6,
+        "LHV" : 12.17,
+        "EMISSION_REDUCTION" : 3.15*0.7,
+        "CAPEX_PER_KG" : 30,
+        "PRICE_DEFAULTS" : (6.0, 6.0, 3.0, 4.5),
+        "DOWNSTREAM" : None,
+        },
+    "Methanol" : {
+        "SHORT" : "Methanol",
+        "EFFICIENCY" : 0.7*0.8,
+        "LHV" : 5.58,
+        "EMISSION_REDUCTION" : 1.932*0.7,
+        "CAPEX_PER_KG" : 12,
+        "PRICE_DEFAULTS" : (6.0, 6.0, 3.0, 4.5),
+        "DOWNSTREAM" : None,
+        },
+    }
+
+#Index of the table
+CARRIERS = tuple(CARRIER_TABLE)
+CARRIER_INDEX = {carrier: i for i, carrier in enumerate(CARRIERS)}
+
+#Constants over all carriers, in the order of CARRIERS
+CARRIER_CAPEX_PER_KG = np.array([CARRIER_TABLE[c]["CAPEX_PER_KG"] for c in CARRIERS], dtype=np.float64)
+#____Downstream chain of each carrier as one-hot rows (carrier x chain)
+CARRIER_DOWNSTREAM_WEIGHTS = np.array(
+    [[CARRIER_TABLE[c]["DOWNSTREAM"] == chain for chain in DOWNSTREAM_CHAINS] for c in CARRIERS],
+    dtype=np.float64,
+    )
+
+
+def get_carrier_column(name):
+    """
+    Returns one constant of all carriers as dictionary carrier --> value.
+    """
+    return {carrier: CARRIER_TABLE[carrier][name] for carrier in CARRIERS}
+
+
+def get_carrier_index(CARRIER):
+    """
+    Returns the index of a carrier, or of each carrier of an array of carriers.
+    Unknown carriers raise a ValueError.
+    """
+    try:
+        if np.ndim(CARRIER) == 0:
+            return CARRIER_INDEX[str(CARRIER)]
+        return np.array([CARRIER_INDEX[str(c)] for c in np.ravel(CARRIER)], dtype=np.intp)
+    except KeyError as error:
+        raise ValueError("Unknown carrier: " + str(error.args[0]))
+
+
+def get_downstream_chain(CARRIER):
+    """
+    Returns the downstream chain of a carrier (see DOWNSTREAM_CHAINS), or None.
+    """
+    chain = CARRIER_TABLE[CARRIER]["DOWNSTREAM"]
+    return DOWNSTREAM_CHAINS[chain] if chain is not None else None
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Fiscal model of the H2Global mechanism.
+
+All fiscal cashflow categories are represented as rows of one 2-D array
+(category x year), which is discounted with a single discount-factor vector.
+The core is written for a batch of scenarios (scenario x category x year),
+a single scenario is evaluated as a batch of size one.
+"""
+
+import numpy as np
+
+from utils.carriers import CARRIER_CAPEX_PER_KG, CARRIER_DOWNSTREAM_WEIGHTS, DOWNSTREAM_CHAINS, get_carrier_column, get_carrier_index
+from utils.instrumentation import instrumented
+from utils.loans import get_loan_schedules
+
+#Order of the rows of the fiscal cashflow matrix
+FISCAL_CATEGORIES = (
+    "FISCAL_EXPENSES",
+    "CORPORATE_TAX",
+    "VAT_INVEST",
+    "IMPORT_DUTIES",
+    "VAT_HPA",
+    "VAT_HSA",
+    "VAT_H2_PRODUCT",
+    "VAT_DRI",
+    "VAT_FERTILIZER",
+    )
+FISCAL_INDEX = {c: i for i, c in enumerate(FISCAL_CATEGORIES)}
+
+#Investment costs of the production project per annual production capacity [US$/(kg/year)], see utils.carriers
+CAPEX_PER_KG_ANNUAL_PRODUCTION = get_carrier_column("CAPEX_PER_KG")
+
+
+def get_discount_factors(WACC, PERIOD):
+    """
+    Returns the discount factors 1/(1+WACC)**t for t = 0, ..., PERIOD-1.
+    For an array of WACCs, the years are appended as last axis.
+    """
+    return (1 + np.asarray(WACC, dtype=np.float64)[..., np.newaxis]) ** -np.arange(PERIOD, dtype=np.float64)
+
+
+def get_share_hpa_contract(SHARE_HPA_CONTRACT_SINGLE, RAMP_UP, DEPRECIATION_PERIOD):
+    """
+    Returns the annual share of the HPA contract of the total production.
+    During the ramp-up period, the share decreases linearly from 1 to
+    SHARE_HPA_CONTRACT_SINGLE and stays constant afterwards.
+    """
+    if RAMP_UP > 0:
+        DELTA_YEARS_RAMP_UP = DEPRECIATION_PERIOD - RAMP_UP
+        SHARE_HPA_CONTRACT_RAMP_UP = np.linspace(1,SHARE_HPA_CONTRACT_SINGLE,RAMP_UP)
+        SHARE_HPA_CONTRACT_AFTER_RAMP_UP = np.full(DELTA_YEARS_RAMP_UP, SHARE_HPA_CONTRACT_SINGLE)
+        return np.concatenate((SHARE_HPA_CONTRACT_RAMP_UP, SHARE_HPA_CONTRACT_AFTER_RAMP_UP))
+    else:
+        return np.full(DEPRECIATION_PERIOD, SHARE_HPA_CONTRACT_SINGLE, dtype=np.float64)
+
+
+def get_fiscal_revenues(CASHFLOWS):
+    """
+    Returns the annual fiscal revenues, i.e. the fiscal cashflows without the
+    fiscal expenses, of a cashflow matrix (..., category, year).
+    """
+    return np.delete(CASHFLOWS, FISCAL_INDEX["FISCAL_EXPENSES"], axis=-2).sum(axis=-2)
+
+
+def _as_scenario_column(value, dtype=np.float64):
+    #Scalars and per-scenario vectors are returned with shape (1, 1) or (N, 1),
+    #so they broadcast against annual arrays of shape (N, year).
+    value = np.asarray(value, dtype=dtype)
+    if value.ndim > 1:
+        raise ValueError("Per-scenario parameters must be scalars or 1-D arrays.")
+    return value.reshape(-1, 1)
+
+
+def _as_scenario_rows(value):
+    #Annual arrays are returned with shape (1, year) or (N, year).
+    value = np.asarray(value, dtype=np.float64)
+    if value.ndim > 2:
+        raise ValueError("Annual arrays must be 1-D (one scenario) or 2-D (scenario x year).")
+    return np.atleast_2d(value)
+
+
+def get_fiscal_cashflows_batch(
+        PRODUCT_TYPE,
+        TOTAL_LOAN,
+        ANNUAL_PRODUCTION, #kg
+        ANNUAL_PRODUCT_PURCHASES, #USD
+        ANNUAL_PRODUCT_SALES, #USD
+        ANNUAL_FUNDING, #USD
+        DEPRECIATION_PERIOD, #YEARS
+        GRACE_PERIOD, #YEARS
+        CONTRACT_PERIOD_HPA, #years
+        WACC,
+        INFLATION,
+        CORPORATE_TAX_RATE,
+        SHARE_HPA_CONTRACT, #This is the share that the HPA contract takes of the companies total revenue.
+        SHARE_TAXABLE_INCOME, #This is the share of the taxable income of the total revenue of the supply side company.
+        SHARE_DOMESTIC_SALES, #This is the share of the hydrogen product which is sold domestically.
+        SHARE_IMPORTED_PRODUCTION_EQUIPMENT, #This is the share of imported production equipment required to construct the production plant.
+        SHARE_H2_DRI_DOMESTIC, #This is the share of the domestically sold hydrogen, which is used for domestic DRI production.
+        DRI_SALES_PRICE, #USD/kg
+        DRI_PER_KG_H2, #DRI output per input of H2
+        SHARE_DOMESTIC_SALES_DRI, #How much of the fertilizer is then sold domestically?
+        SHARE_NH3_FERTILIZER_DOMESTIC, #This is the share of the domestically sold ammonia, which is used for domestic fertilizer production.
+        FERTILIZER_SALES_PRICE, #
+        FERTILIZER_PER_KG_NH3, #Fertilizer output per input of NH3
+        SHARE_DOMESTIC_SALES_FERTILIZER, #How much of the fertilizer is then sold domestically?
+        IMPORT_DUTIES_RATE,
+        VAT_RATE,
+        VAT_INVEST_BOOL,
+        VAT_HPA_BOOL,
+        VAT_HSA_BOOL,
+        VAT_HYDROGEN_PRODUCT_BOOL,
+        VAT_DRI_BOOL,
+        VAT_FERTILIZER_BOOL,
+        LOAN_PROFILE="straight_line", #Repayment profile of the loan, see utils.loans
+        ):
+    """
+    Calculates the fiscal cashflows for a batch of N scenarios at once.
+
+    Annual inputs (ANNUAL_*) are arrays of shape (N, CONTRACT_PERIOD_HPA),
+    SHARE_HPA_CONTRACT has shape (DEPRECIATION_PERIOD,) or (N, DEPRECIATION_PERIOD).
+    All other parameters are either scalars, which apply to all scenarios, or
+    arrays of shape (N,). This includes the VAT flags, LOAN_PROFILE and PRODUCT_TYPE, so
+    that all carriers can be evaluated in one batch. Each carrier only uses
+    the parameters of its downstream chain (see utils.carriers), e.g. DRI
+    for hydrogen. DEPRECIATION_PERIOD and CONTRACT_PERIOD_HPA are common to the batch.
+
+    Returns a dictionary with
+        "NPV" : Net-present value of all fiscal cashflows, shape (N,) [US$]
+        "CATEGORIES" : Names of the category axis of "CASHFLOWS"
+        "CASHFLOWS" : Annual fiscal cashflows, shape (N, category, year) [US$]
+        "PRESENT_VALUES" : Discounted sum of each category, shape (N, category) [US$]
+        "DISCOUNT_FACTORS" : Discount factor of each year, shape (N, year)
+        "LOAN_CASHFLOWS_DICT" : Annual interest and principal payments, shape (N, year) [US$]
+        "LOAN_BALANCE" : Outstanding balance of the loan at the start of each year, shape (N, year) [US$]
+        "SALES_REVENUES_DICT" : Annual domestic and export sales revenues, shape (N, year) [US$]
+    """
+
+    if CONTRACT_PERIOD_HPA > DEPRECIATION_PERIOD:
+        raise ValueError("Depreciation period of loan is shorter than HPA contract period.")
+    CARRIER_INDEX = get_carrier_index(PRODUCT_TYPE)
+
+    delta_years = DEPRECIATION_PERIOD - CONTRACT_PERIOD_HPA
+
+    ANNUAL_PRODUCTION = _as_scenario_rows(ANNUAL_PRODUCTION)
+    ANNUAL_PRODUCT_PURCHASES = _as_scenario_rows(ANNUAL_PRODUCT_PURCHASES)
+    ANNUAL_PRODUCT_SALES = _as_scenario_rows(ANNUAL_PRODUCT_SALES)
+    ANNUAL_FUNDING = _as_scenario_rows(ANNUAL_FUNDING)
+    SHARE_HPA_CONTRACT = _as_scenario_rows(SHARE_HPA_CONTRACT)
+
+    TOTAL_LOAN = _as_scenario_column(TOTAL_LOAN)
+    GRACE_PERIOD = _as_scenario_column(GRACE_PERIOD)
+    WACC = _as_scenario_column(WACC)
+    INFLATION = _as_scenario_column(INFLATION)
+    CORPORATE_TAX_RATE = _as_scenario_column(CORPORATE_TAX_RATE)
+    SHARE_TAXABLE_INCOME = _as_scenario_column(SHARE_TAXABLE_INCOME)
+    SHARE_DOMESTIC_SALES = _as_scenario_column(SHARE_DOMESTIC_SALES)
+    SHARE_IMPORTED_PRODUCTION_EQUIPMENT = _as_scenario_column(SHARE_IMPORTED_PRODUCTION_EQUIPMENT)
+    IMPORT_DUTIES_RATE = _as_scenario_column(IMPORT_DUTIES_RATE)
+    VAT_RATE = _as_scenario_column(VAT_RATE)
+    VAT_INVEST_BOOL = _as_scenario_column(VAT_INVEST_BOOL, dtype=bool)
+    VAT_HPA_BOOL = _as_scenario_column(VAT_HPA_BOOL, dtype=bool)
+    VAT_HSA_BOOL = _as_scenario_column(VAT_HSA_BOOL, dtype=bool)
+    VAT_HYDROGEN_PRODUCT_BOOL = _as_scenario_column(VAT_HYDROGEN_PRODUCT_BOOL, dtype=bool)
+
+    CAPEX_PER_KG = _as_scenario_column(CARRIER_CAPEX_PER_KG[CARRIER_INDEX])
+
+    #____Domestic downstream products, e.g. DRI from hydrogen, fertilizer from ammonia.
+    #____Each chain is weighted with 1 for the scenarios of its carriers and 0 otherwise.
+    DOWNSTREAM_WEIGHTS = np.atleast_2d(CARRIER_DOWNSTREAM_WEIGHTS[CARRIER_INDEX])
+    DOWNSTREAM_VALUES = dict(
+        SHARE_H2_DRI_DOMESTIC=SHARE_H2_DRI_DOMESTIC,
+        DRI_SALES_PRICE=DRI_SALES_PRICE,
+        DRI_PER_KG_H2=DRI_PER_KG_H2,
+        SHARE_DOMESTIC_SALES_DRI=SHARE_DOMESTIC_SALES_DRI,
+        VAT_DRI_BOOL=VAT_DRI_BOOL,
+        SHARE_NH3_FERTILIZER_DOMESTIC=SHARE_NH3_FERTILIZER_DOMESTIC,
+        FERTILIZER_SALES_PRICE=FERTILIZER_SALES_PRICE,
+        FERTILIZER_PER_KG_NH3=FERTILIZER_PER_KG_NH3,
+        SHARE_DOMESTIC_SALES_FERTILIZER=SHARE_DOMESTIC_SALES_FERTILIZER,
+        VAT_FERTILIZER_BOOL=VAT_FERTILIZER_BOOL,
+        )
+    DOWNSTREAM = []
+    for k, CHAIN in enumerate(DOWNSTREAM_CHAINS.values()):
+        SHARE_DOMESTIC_USE, SALES_PRICE, OUTPUT_PER_KG, SHARE_DOMESTIC_SALES_CHAIN, VAT_BOOL = CHAIN["PARAMETERS"]
+        DOWNSTREAM.append((
+            CHAIN["CATEGORY"],
+            DOWNSTREAM_WEIGHTS[:, k:k+1],
+            _as_scenario_column(DOWNSTREAM_VALUES[SHARE_DOMESTIC_USE]),
+            _as_scenario_column(DOWNSTREAM_VALUES[OUTPUT_PER_KG]),
+            _as_scenario_column(DOWNSTREAM_VALUES[SALES_PRICE]),
+            _as_scenario_column(DOWNSTREAM_VALUES[SHARE_DOMESTIC_SALES_CHAIN]),
+            _as_scenario_column(DOWNSTREAM_VALUES[VAT_BOOL], dtype=bool),
+            ))
+
+    #____Number of scenarios of the batch
+    N = np.broadcast_shapes(*[x[:, :1].shape for x in (
+        ANNUAL_PRODUCTION, ANNUAL_PRODUCT_PURCHASES, ANNUAL_PRODUCT_SALES, ANNUAL_FUNDING,
+        SHARE_HPA_CONTRACT, TOTAL_LOAN, GRACE_PERIOD, WACC, INFLATION, CORPORATE_TAX_RATE,
+        SHARE_TAXABLE_INCOME, SHARE_DOMESTIC_SALES, SHARE_IMPORTED_PRODUCTION_EQUIPMENT,
+        IMPORT_DUTIES_RATE, VAT_RATE, VAT_INVEST_BOOL, VAT_HPA_BOOL, VAT_HSA_BOOL,
+        VAT_HYDROGEN_PRODUCT_BOOL, CAPEX_PER_KG, *(x for chain in DOWNSTREAM for x in chain[1:]),
+        )])[0]
+    ZEROS_AFTER_CONTRACT = np.zeros((N, delta_years))
+    YEARS_AFTER_CONTRACT = np.arange(delta_years)
+
+    #resize external input arrays.
+    #____This is the annual production volume under the HPA contract in kg
+    ANNUAL_PRODUCTION = np.broadcast_to(ANNUAL_PRODUCTION, (N, CONTRACT_PERIOD_HPA))
+    ANNUAL_PRODUCTION = np.concatenate([ANNUAL_PRODUCTION, np.repeat(ANNUAL_PRODUCTION[:, -1:], delta_years, axis=1)], axis=1) #kg
+    #____These are the annual product purchases by Hintco
+    ANNUAL_PRODUCT_PURCHASES = np.broadcast_to(ANNUAL_PRODUCT_PURCHASES, (N, CONTRACT_PERIOD_HPA))
+    ANNUAL_PRODUCT_PURCHASES_HINTCO = np.concatenate([ANNUAL_PRODUCT_PURCHASES, ZEROS_AFTER_CONTRACT], axis=1) #USD
+    #____This is for how much producers can sell to the market, after the offtake contract expired.
+    #____Conservative assumption: Last Hintco sales price*inflation
+    ANNUAL_PRODUCT_SALES = np.broadcast_to(ANNUAL_PRODUCT_SALES, (N, CONTRACT_PERIOD_HPA))
+    ANNUAL_PRODUCT_SALES_AFTER_HINTCO = ANNUAL_PRODUCT_SALES[:, -1:] * (1 + INFLATION) ** YEARS_AFTER_CONTRACT
+    #____These are the annual product purchases by Hintco, extended by a future offtake --> Used for calculating the revenue of the production projects.
+    ANNUAL_PRODUCT_PURCHASES_TOTAL = np.concatenate([ANNUAL_PRODUCT_PURCHASES, ANNUAL_PRODUCT_SALES_AFTER_HINTCO], axis=1) #USD
+    #____These are the sales via hintco within the contract period.
+    ANNUAL_PRODUCT_SALES_HINTCO = np.concatenate([ANNUAL_PRODUCT_SALES, ZEROS_AFTER_CONTRACT], axis=1) #USD
+    #____These are the sales by Hintco, extended by future offtake. --> Used for domestic and export volume calculations.
+    ANNUAL_PRODUCT_SALES_TOTAL = np.concatenate([ANNUAL_PRODUCT_SALES, ANNUAL_PRODUCT_SALES_AFTER_HINTCO], axis=1) #USD
+    #____This is the required funding for Hintco.
+    ANNUAL_FUNDING = np.broadcast_to(ANNUAL_FUNDING, (N, CONTRACT_PERIOD_HPA))
+    ANNUAL_FUNDING_LONG = np.concatenate([ANNUAL_FUNDING, ZEROS_AFTER_CONTRACT], axis=1) #USD
+
+    CASHFLOWS = np.zeros((N, len(FISCAL_CATEGORIES), DEPRECIATION_PERIOD))
+
+    #Calculate fiscal expenses. (Cashflows to Hintco)
+    CASHFLOWS[:, FISCAL_INDEX["FISCAL_EXPENSES"]] = -ANNUAL_FUNDING_LONG
+
+    #Calculate fiscal benefits. (tax revenues)
+    #____CORPORATE_TAX: Only include supply side, because these will be genuinely new businesses.
+    TOTAL_ANNUAL_PRODUCTION = ANNUAL_PRODUCT_PURCHASES_TOTAL / SHARE_HPA_CONTRACT
+    TOTAL_ANNUAL_PRODUCTION_KG = ANNUAL_PRODUCTION / SHARE_HPA_CONTRACT
+    TOTAL_ANNUAL_PRODUCT_SALES = ANNUAL_PRODUCT_SALES_TOTAL / SHARE_HPA_CONTRACT
+    TAXABLE_INCOME = (SHARE_HPA_CONTRACT*TOTAL_ANNUAL_PRODUCTION + (1-SHARE_HPA_CONTRACT)*TOTAL_ANNUAL_PRODUCT_SALES)*SHARE_TAXABLE_INCOME
+    CASHFLOWS[:, FISCAL_INDEX["CORPORATE_TAX"]] = TAXABLE_INCOME * CORPORATE_TAX_RATE
+
+    #____VAT_RATE_INVEST: Includes the VAT on initial investments on the supply side.
+    CAPEX = np.max(ANNUAL_PRODUCTION, axis=1, keepdims=True) * CAPEX_PER_KG
+    CASHFLOWS[:, FISCAL_INDEX["VAT_INVEST"], :1] = np.where(VAT_INVEST_BOOL, CAPEX * VAT_RATE, 0)
+
+    #____IMPORT_DUTIES_RATE
+    CASHFLOWS[:, FISCAL_INDEX["IMPORT_DUTIES"], :1] = CAPEX * SHARE_IMPORTED_PRODUCTION_EQUIPMENT * IMPORT_DUTIES_RATE
+
+    #____VAT_HPA
+    CASHFLOWS[:, FISCAL_INDEX["VAT_HPA"]] = np.where(VAT_HPA_BOOL, VAT_RATE * ANNUAL_PRODUCT_PURCHASES_HINTCO, 0)
+
+    #____VAT_HSA
+    CASHFLOWS[:, FISCAL_INDEX["VAT_HSA"]] = np.where(VAT_HSA_BOOL, VAT_RATE * ANNUAL_PRODUCT_SALES_HINTCO, 0)
+
+    TOTAL_DOMESTIC_PRODUCTION = TOTAL_ANNUAL_PRODUCT_SALES * SHARE_DOMESTIC_SALES
+    TOTAL_EXPORT_PRODUCTION = TOTAL_ANNUAL_PRODUCT_SALES * (1-SHARE_DOMESTIC_SALES)
+    TOTAL_DOMESTIC_PRODUCTION_KG = TOTAL_ANNUAL_PRODUCTION_KG * SHARE_DOMESTIC_SALES
+
+    #____VAT_DRI, VAT_FERTILIZER, ...: Downstream chain of each scenario, carriers without chain sell the product directly.
+    SHARE_DOWNSTREAM_DOMESTIC = 0
+    DOMESTIC_SALES_REVENUE_DOWNSTREAM = 0
+    EXPORT_SALES_REVENUE_DOWNSTREAM = 0
+    for CATEGORY, WEIGHT, SHARE_DOMESTIC_USE, OUTPUT_PER_KG, SALES_PRICE, SHARE_DOMESTIC_SALES_CHAIN, VAT_BOOL in DOWNSTREAM:
+        DOWNSTREAM_REVENUE = WEIGHT * (TOTAL_DOMESTIC_PRODUCTION_KG * SHARE_DOMESTIC_USE * OUTPUT_PER_KG * SALES_PRICE)
+        DOMESTIC_SALES_REVENUE_CHAIN = DOWNSTREAM_REVENUE * SHARE_DOMESTIC_SALES_CHAIN
+        CASHFLOWS[:, FISCAL_INDEX[CATEGORY]] = np.where(VAT_BOOL, DOMESTIC_SALES_REVENUE_CHAIN * VAT_RATE, 0)
+        SHARE_DOWNSTREAM_DOMESTIC = SHARE_DOWNSTREAM_DOMESTIC + WEIGHT * SHARE_DOMESTIC_USE
+        DOMESTIC_SALES_REVENUE_DOWNSTREAM = DOMESTIC_SALES_REVENUE_DOWNSTREAM + DOMESTIC_SALES_REVENUE_CHAIN
+        EXPORT_SALES_REVENUE_DOWNSTREAM = EXPORT_SALES_REVENUE_DOWNSTREAM + DOWNSTREAM_REVENUE * (1-SHARE_DOMESTIC_SALES_CHAIN)
+
+    #____VAT_DOMESTIC. E.g. thermal use of hydrogen or ammonia, or other direct end-use.
+    DOMESTIC_SALES_REVENUE_PRODUCT = TOTAL_DOMESTIC_PRODUCTION * (1-SHARE_DOWNSTREAM_DOMESTIC)
+    CASHFLOWS[:, FISCAL_INDEX["VAT_H2_PRODUCT"]] = np.where(VAT_HYDROGEN_PRODUCT_BOOL, DOMESTIC_SALES_REVENUE_PRODUCT * VAT_RATE, 0)
+
+    #Discounting of all scenarios and cashflow categories at once
+    DISCOUNT_FACTORS = np.broadcast_to(get_discount_factors(WACC[:, 0], DEPRECIATION_PERIOD), (N, DEPRECIATION_PERIOD))
+    PRESENT_VALUES = np.einsum("ncy,ny->nc", CASHFLOWS, DISCOUNT_FACTORS)
+
+    #calculate loan payments
+    #____Interest at the cost of capital on the outstanding balance, sculpted repayments follow the fiscal revenues.
+    LOAN_SCHEDULES = get_loan_schedules(
+        PRINCIPAL=TOTAL_LOAN[:, 0],
+        RATE=WACC[:, 0],
+        TERM=DEPRECIATION_PERIOD,
+        GRACE_PERIOD=GRACE_PERIOD[:, 0],
+        PROFILE=np.broadcast_to(np.asarray(LOAN_PROFILE).reshape(-1), (N,)),
+        CASHFLOWS=get_fiscal_revenues(CASHFLOWS),
+        )
+
+    LOAN_CASHFLOWS_DICT = {
+        "INTEREST_PAYMENTS" : -LOAN_SCHEDULES["INTEREST_PAYMENTS"],
+        "PRINCIPAL_PAYMENTS" : -LOAN_SCHEDULES["PRINCIPAL_PAYMENTS"]
+        }
+
+    SALES_REVENUES_DICT = {
+        "DOMESTIC_SALES_REVENUE" : DOMESTIC_SALES_REVENUE_PRODUCT + DOMESTIC_SALES_REVENUE_DOWNSTREAM,
+        "EXPORT_SALES_REVENUE" : TOTAL_EXPORT_PRODUCTION + EXPORT_SALES_REVENUE_DOWNSTREAM
+        }
+
+    return {
+        "NPV" : PRESENT_VALUES.sum(axis=1),
+        "CATEGORIES" : FISCAL_CATEGORIES,
+        "CASHFLOWS" : CASHFLOWS,
+        "PRESENT_VALUES" : PRESENT_VALUES,
+        "DISCOUNT_FACTORS" : DISCOUNT_FACTORS,
+        "LOAN_CASHFLOWS_DICT" : LOAN_CASHFLOWS_DICT,
+        "LOAN_BALANCE" : LOAN_SCHEDULES["BALANCE"],
+        "SALES_REVENUES_DICT" : SALES_REVENUES_DICT,
+        }
+
+
+@instrumented("fiscal")
+def get_fiscal_cashflows(*args, **kwargs):
+    """
+    Calculates all fiscal cashflows of the funding instrument for one scenario.
+    Takes the same arguments as get_fiscal_cashflows_batch with 1-D annual
+    arrays and scalar parameters.
+
+    Returns a dictionary with
+        "NPV" : Net-present value of all fiscal cashflows [US$]
+        "CATEGORIES" : Names of the rows of "CASHFLOWS"
+        "CASHFLOWS" : Annual fiscal cashflows, array of shape (category, year) [US$]
+        "PRESENT_VALUES" : Discounted sum of each category [US$]
+        "DISCOUNT_FACTORS" : Discount factor of each year
+        "LOAN_CASHFLOWS_DICT" : Annual interest and principal payments [US$]
+        "LOAN_BALANCE" : Outstanding balance of the loan at the start of each year [US$]
+        "SALES_REVENUES_DICT" : Annual domestic and export sales revenues [US$]
+    """
+
+    FISCAL_RESULTS = get_fiscal_cashflows_batch(*args, **kwargs)
+    if len(FISCAL_RESULTS["NPV"]) != 1:
+        raise ValueError("Use get_fiscal_cashflows_batch to evaluate more than one scenario.")
+
+    return {
+        key : (
+            {k: v[0] for k, v in value.items()} if isinstance(value, dict)
+            else value if key == "CATEGORIES"
+            else value[0]
+            )
+        for key, value in FISCAL_RESULTS.items()
+        }
+
+
+def get_fiscal_npv(*args, **kwargs):
+    """
+    Returns the net-present value of the fiscal cashflows together with the
+    fiscal, loan and sales revenue cashflows as dictionaries.
+    Takes the same arguments as get_fiscal_cashflows.
+    """
+
+    FISCAL_RESULTS = get_fiscal_cashflows(*args, **kwargs)
+    FISCAL_CASHFLOWS_DICT = dict(zip(FISCAL_RESULTS["CATEGORIES"], FISCAL_RESULTS["CASHFLOWS"]))
+
+    return (
+        FISCAL_RESULTS["NPV"],
+        FISCAL_CASHFLOWS_DICT,
+        FISCAL_RESULTS["LOAN_CASHFLOWS_DICT"],
+        FISCAL_RESULTS["SALES_REVENUES_DICT"]
+        )
+
+
+#Default memory budget for the path-wise fiscal evaluation [bytes]
+FISCAL_MEMORY_BUDGET_BYTES = 64 * 1024**2
+#Approximate number of (scenario x year) float64 arrays held by get_fiscal_cashflows_batch per category row
+_ARRAYS_PER_SCENARIO = len(FISCAL_CATEGORIES) + 20
+
+
+@instrumented("fiscal_distribution")
+def get_fiscal_npv_distribution(
+        ATTR,
+        DEPRECIATION_PERIOD,
+        PERCENTILES=(5, 25, 50, 75, 95),
+        MEMORY_BUDGET_BYTES=FISCAL_MEMORY_BUDGET_BYTES,
+        **kwargs
+        ):
+    """
+    Evaluates the fiscal model for every simulated path of a mechanism.
+
+    ATTR is the attribute dictionary of a simulated pm.Mechanism, whose
+    annual results have shape (year, path). The remaining keyword arguments
+    are the scalar parameters of get_fiscal_cashflows_batch. Paths are
+    streamed through the fiscal model in chunks, so that the intermediate
+    arrays stay within MEMORY_BUDGET_BYTES for any number of paths.
+
+    Returns a dictionary with
+        "NPV" : Net-present value of each path, shape (path,) [US$]
+        "NPV_MEAN", "NPV_STD" : Mean and standard deviation of the NPV [US$]
+        "NPV_PERCENTILES" : Dictionary percentile --> NPV [US$]
+        "PROBABILITY_NEGATIVE_NPV" : Share of paths with NPV < 0
+        "CATEGORIES" : Names of the rows of "MEAN_CASHFLOWS"
+        "MEAN_CASHFLOWS" : Annual fiscal cashflows averaged over paths, shape (category, year) [US$]
+        "MEAN_PRESENT_VALUES" : Present value of each category averaged over paths [US$]
+    """
+
+    ANNUAL_PRODUCTION = ATTR["Yearly_Product_Purchases"]
+    ANNUAL_PRODUCT_PURCHASES_LONG = ATTR["Yearly_Purchases_LONG"]
+    ANNUAL_PRODUCT_PURCHASES_SHORT = ATTR["Yearly_Purchases_SHORT"]
+    ANNUAL_PRODUCT_SALES = ATTR["Yearly_Sales"]
+    ANNUAL_FUNDING = ATTR["Yearly_Used_Funding"]
+
+    NUMBER_PATHS = ANNUAL_PRODUCTION.shape[1]
+    BYTES_PER_PATH = _ARRAYS_PER_SCENARIO * DEPRECIATION_PERIOD * 8
+    CHUNK_SIZE = int(max(1, min(NUMBER_PATHS, MEMORY_BUDGET_BYTES // BYTES_PER_PATH)))
+
+    NPV = np.empty(NUMBER_PATHS)
+    CASHFLOWS_SUM = np.zeros((len(FISCAL_CATEGORIES), DEPRECIATION_PERIOD))
+    PRESENT_VALUES_SUM = np.zeros(len(FISCAL_CATEGORIES))
+
+    for start in range(0, NUMBER_PATHS, CHUNK_SIZE):
+        paths = slice(start, start+CHUNK_SIZE)
+        FISCAL_RESULTS = get_fiscal_cashflows_batch(
+            ANNUAL_PRODUCTION=ANNUAL_PRODUCTION[:, paths].T,
+            ANNUAL_PRODUCT_PURCHASES=(ANNUAL_PRODUCT_PURCHASES_LONG[:, paths] + ANNUAL_PRODUCT_PURCHASES_SHORT[:, paths]).T,
+            ANNUAL_PRODUCT_SALES=ANNUAL_PRODUCT_SALES[:, paths].T,
+            ANNUAL_FUNDING=ANNUAL_FUNDING[:, paths].T,
+            DEPRECIATION_PERIOD=DEPRECIATION_PERIOD,
+            **kwargs
+            )
+        NPV[paths] = FISCAL_RESULTS["NPV"]
+        CASHFLOWS_SUM += FISCAL_RESULTS["CASHFLOWS"].sum(axis=0)
+        PRESENT_VALUES_SUM += FISCAL_RESULTS["PRESENT_VALUES"].sum(axis=0)
+
+    return {
+        "NPV" : NPV,
+        "NPV_MEAN" : NPV.mean(),
+        "NPV_STD" : NPV.std(),
+        "NPV_PERCENTILES" : dict(zip(PERCENTILES, np.percentile(NPV, PERCENTILES))),
+        "PROBABILITY_NEGATIVE_NPV" : np.mean(NPV < 0),
+        "CATEGORIES" : FISCAL_CATEGORIES,
+        "MEAN_CASHFLOWS" : CASHFLOWS_SUM / NUMBER_PATHS,
+        "MEAN_PRESENT_VALUES" : PRESENT_VALUES_SUM / NUMBER_PATHS,
+        }
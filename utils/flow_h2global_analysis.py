@@ -5,16 +5,43 @@ Created on Wed Aug 14 14:37:58 2024
 @author: JulianReul
 """
 
+import os
+
 import streamlit as st
-import pandas as pd
-import numpy as np
-import plotly.express as px
 
-import pymechanism as pm
-import plotly.graph_objects as go
+#All computations are done in utils.h2global_model, this module only holds the widgets and charts.
+#Charts (pandas and plotly) are imported on first use, so that the page starts fast.
+from utils.h2global_model import Scenario, ScenarioResults, DICT_CARRIER_SHORT, get_price_defaults
+from utils.carriers import get_downstream_chain
+from utils.loans import LOAN_PROFILES
+from utils.pipeline import get_changed_stages
+from utils.goal_seek import solve_goal_seek, TARGET_METRICS, GOAL_SEEK_PARAMETERS
+#get_fiscal_npv is kept importable from this module for existing scripts.
+from utils.fiscal_engine import get_fiscal_npv # noqa: F401
+from utils.instrumentation import request_scope, set_memory_tracing, start_metrics_server, get_prometheus_text
+from utils.simulation_jobs import SIMULATION_JOBS, JOB_FAILED
+from utils.simulation_cache import SIMULATION_CACHE
+from utils.warmup import start_warmup
+from utils.scenario_library import (
+    SCENARIO_LIBRARY_ENV, SCENARIO_LIMITS, SCENARIO_QUERY_PARAM, encode_scenario, get_default_scenario_library, restore_scenario
+    )
+from utils.result_export import (
+    EXPORT_TABLES, EXPORT_FORMATS, EXPORT_INLINE_MAX_ROWS, get_export_filename, get_export_url, register_export,
+    start_export_server, stream_export
+    )
+
+#Environment variable, which shows the debug panel on every run of the evaluation page and enables memory tracing.
+#____Otherwise, the panel is shown with the query parameter ?debug=1, without memory tracing unless H2G_TRACE_MEMORY is set.
+DEBUG_PANEL_ENV = "H2G_DEBUG_PANEL"
+
+#Simulations, which take longer, are shown with progress and polled in the background [s]
+JOB_INLINE_WAIT_SECONDS = 0.5
+JOB_POLL_SECONDS = 0.5
 #%%
 
 def show_info_page():
+    #The compute stack is warmed in the background, while the info page is read, see utils.warmup.
+    start_warmup()
     st.image("images/logo_H2G.png")
     st.header('Exploring the H2Global Mechanism')
         
@@ -41,21 +68,319 @@ Exporters and importers of clean hydrogen and other similar products can all mak
     st.image("images/mechanism.png")
 
 
+def is_debug_panel_enabled():
+    return bool(os.environ.get(DEBUG_PANEL_ENV)) or st.query_params.get("debug") == "1"
+
+
+def show_debug_panel(REQUEST):
+    """
+    Shows the measured stages, peak memory and cache counters of one run of
+    the evaluation page, see utils.instrumentation.
+    """
+    import pandas as pd
+    
+    with st.expander("Debug: performance of this run", expanded=False):
+        st.write("Run time of the page:", round(REQUEST["SECONDS"]*1e3, 1), "[ms]")
+        if REQUEST["PEAK_MEMORY_BYTES"] is not None:
+            st.write("Peak memory of the page:", round(REQUEST["PEAK_MEMORY_BYTES"]/1024**2, 2), "[MiB]")
+        if REQUEST["STAGES"]:
+            STAGES = pd.DataFrame(REQUEST["STAGES"])
+            STAGES["SECONDS"] = STAGES["SECONDS"]*1e3
+            STAGES = STAGES.rename(columns={"STAGE": "Stage", "SECONDS": "Run time [ms]", "PEAK_MEMORY_BYTES": "Peak memory [bytes]"})
+            st.dataframe(STAGES, hide_index=True)
+        else:
+            st.write("No stage was computed, all results were cached.")
+        st.dataframe(
+            pd.DataFrame(REQUEST["CACHES"]).T.rename(columns={"HITS": "Hits", "MISSES": "Misses"}),
+            )
+        st.code(get_prometheus_text(), language="text")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id, scenario):
+    """
+    Shows the progress of a background simulation and preliminary results of
+    the paths simulated so far. Reruns the page, once the job is done.
+    """
+    job = SIMULATION_JOBS.get(job_id)
+    if job is None or job.done:
+        st.rerun()
+    
+    st.progress(job.PROGRESS, text="Simulating the mechanism: " + str(int(job.PROGRESS*100)) + " % of the paths")
+    ATTR = job.get_partial_attr()
+    if ATTR is not None:
+        PARTIAL_RESULTS = ScenarioResults(scenario, ATTR=ATTR)
+        st.write(
+            "Preliminary results of", ATTR["NUMBER_SCENARIOS"], "of", job.NUMBER_PATHS, "paths: traded",
+            DICT_CARRIER_SHORT[scenario.CARRIER], round(PARTIAL_RESULTS.TOTAL_PURCHASES_TONS*1e-6, 2), "[Mt],",
+            "used funding", int(round(PARTIAL_RESULTS.TOTAL_USED_FUNDING_USD*1e-6, 0)), "[Million US$]"
+            )
+
+
+def _show_what_if_totals(results, scenario, note):
+    st.write(
+        "Traded", DICT_CARRIER_SHORT[scenario.CARRIER], round(results.TOTAL_PURCHASES_TONS*1e-6, 3), "[Mt],",
+        "used funding", int(round(results.TOTAL_USED_FUNDING_USD*1e-6, 0)), "[Million US$],",
+        "reduced CO2-emissions", round(results.TOTAL_MITIGATED_CO2_TONS*1e-6, 3), "[Mt]", note
+        )
+
+
+@st.fragment
+def show_what_if(scenario):
+    """
+    Shows approximate results of a surrogate model for the funding volume and
+    prices of the sliders at once, and the exact results, once the background
+    simulation is done, see utils.surrogate.
+    """
+    from utils.surrogate import find_surrogate
+    from utils.scenario_atlas import get_atlas_results
+
+    #____Sliders and simulations are only shown on request, the expander runs with every run of the page.
+    if not st.toggle("Show what-if analysis", key="H2G_WHAT_IF"):
+        return
+
+    surrogate = find_surrogate(scenario, fixed_only=True)
+    if surrogate is None:
+        st.info(
+            "No surrogate model for this funding period and these specifications of the mechanism. "
+            "Surrogate models are built with: python -m utils.surrogate"
+            )
+        return
+
+    PURCHASE_PRICE_MIN, PURCHASE_PRICE_MAX = float(surrogate.LOWER[0]), float(surrogate.UPPER[0])
+
+    def clip(value, lower, upper):
+        return float(min(max(value, lower), upper))
+
+    WHAT_IF_FUNDING = st.slider(
+        "Funding volume [Billion US$]", 0.1, 10.0, clip(scenario.SUBSIDY_VOLUME*1e-9, 0.1, 10.0), 0.1, key="H2G_WHAT_IF_FUNDING"
+        )
+    WHAT_IF_PURCHASE_PRICE = st.slider(
+        "Purchase price start / end [US$/kg]", PURCHASE_PRICE_MIN, PURCHASE_PRICE_MAX,
+        (clip(scenario.PURCHASE_PRICE_START, PURCHASE_PRICE_MIN, PURCHASE_PRICE_MAX), clip(scenario.PURCHASE_PRICE_END, PURCHASE_PRICE_MIN, PURCHASE_PRICE_MAX)),
+        key="H2G_WHAT_IF_PURCHASE_PRICE"
+        )
+    WHAT_IF_SALES_PRICE = st.slider(
+        "Sales price start / end [US$/kg]", 0.0, PURCHASE_PRICE_MAX,
+        (clip(scenario.SALES_PRICE_START, 0.0, PURCHASE_PRICE_MAX), clip(scenario.SALES_PRICE_END, 0.0, PURCHASE_PRICE_MAX)),
+        key="H2G_WHAT_IF_SALES_PRICE"
+        )
+
+    what_if_scenario = scenario.replace(
+        SUBSIDY_VOLUME=WHAT_IF_FUNDING*1e9,
+        PURCHASE_PRICE_START=WHAT_IF_PURCHASE_PRICE[0],
+        PURCHASE_PRICE_END=WHAT_IF_PURCHASE_PRICE[1],
+        SALES_PRICE_START=WHAT_IF_SALES_PRICE[0],
+        SALES_PRICE_END=WHAT_IF_SALES_PRICE[1],
+        )
+    try:
+        what_if_scenario.validate()
+    except ValueError as error:
+        st.error(str(error))
+        return
+
+    #The exact simulation refines the approximate results in the background.
+    #____Scenarios of the atlas are put into the simulation cache, so that their job is done at once.
+    get_atlas_results(what_if_scenario)
+    show_what_if_results(SIMULATION_JOBS.submit_scenario(what_if_scenario), what_if_scenario, surrogate)
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_what_if_results(job_id, scenario, surrogate):
+    """
+    Shows the exact results of the what-if analysis, if its simulation is
+    done, otherwise the approximate results of the surrogate model.
+    """
+    job = SIMULATION_JOBS.get(job_id)
+    if job is not None and job.state == JOB_FAILED:
+        st.error("Simulation failed: " + job.error)
+    elif job is not None and job.done:
+        _show_what_if_totals(ScenarioResults(scenario, ATTR=job.ATTR, memoize=True), scenario, "(exact).")
+    elif surrogate.covers(scenario):
+        _show_what_if_totals(
+            surrogate.get_results(scenario), scenario,
+            "(approximate, ±" + str(round(surrogate.get_error_bound()*100, 1)) + " %, exact results follow)."
+            )
+    else:
+        st.write("The prices are not within the range of the surrogate model, the exact results follow.")
+
+
+def show_price_path_inputs(label, key, START, END, PERIOD, SPEC=None):
+    """
+    Shows the inputs of the price path of label (e.g. "Purchase price") and
+    returns its generator as JSON, see utils.price_paths, or None for a
+    linear development between START and END. The inputs start at the
+    generator SPEC of a restored scenario, if given; uploaded tables are
+    restored as piecewise linear path.
+    """
+    from utils.price_paths import PRICE_PATH_LIMITS, get_price_path_spec, parse_price_path_spec, read_price_path_csv
+
+    SPEC = parse_price_path_spec(SPEC) if SPEC is not None else {}
+    if "VALUES" in SPEC:
+        KNOTS = zip(SPEC.get("YEARS", range(1, len(SPEC["VALUES"])+1)), SPEC["VALUES"])
+        KNOTS_TEXT = "; ".join("%g" % year + ":" + str(value) for year, value in KNOTS)
+    else:
+        KNOTS_TEXT = "1:" + str(START) + "; " + str(max(PERIOD, 1)) + ":" + str(END)
+
+    TYPE = st.selectbox(
+        label + ' path',
+        ("Linear", "Piecewise linear", "Learning curve", "CSV upload", "Geometric Brownian motion - BETA", "Mean-reverting - BETA"),
+        index={"piecewise": 1, "table": 1, "learning_curve": 2, "gbm": 4, "mean_reverting": 5}.get(SPEC.get("TYPE"), 0),
+        key=key + "_TYPE",
+        )
+    try:
+        if TYPE == "Piecewise linear":
+            TEXT = st.text_input(
+                label + ' in selected years [year:US$/kg; ...]',
+                value=KNOTS_TEXT,
+                key=key + "_PIECEWISE",
+                help="Prices between the given years are interpolated linearly, e.g. 1:6.0; 5:4.0; 10:3.5"
+                )
+            KNOTS = [item.split(":") for item in TEXT.split(";") if item.strip()]
+            return get_price_path_spec("piecewise", YEARS=[float(y) for y, _ in KNOTS], VALUES=[float(v) for _, v in KNOTS])
+        if TYPE == "Learning curve":
+            LEARNING_RATE = st.number_input(label + ' reduction per doubling of production [%]', value=round(SPEC.get("LEARNING_RATE", 0.15)*100, 10), step=1.0, min_value=0.0, max_value=PRICE_PATH_LIMITS["LEARNING_RATE"][1]*100, key=key + "_LEARNING_RATE")
+            GROWTH_RATE = st.number_input('Annual growth of production [%]', value=round(SPEC.get("GROWTH_RATE", 0.3)*100, 10), step=5.0, min_value=0.0, max_value=PRICE_PATH_LIMITS["GROWTH_RATE"][1]*100, key=key + "_GROWTH_RATE")
+            FLOOR = st.number_input(label + ' floor [US$/kg]', value=float(SPEC.get("FLOOR", 0.0)), step=0.1, min_value=0.0, max_value=PRICE_PATH_LIMITS["FLOOR"][1], key=key + "_FLOOR")
+            return get_price_path_spec("learning_curve", START=START, LEARNING_RATE=LEARNING_RATE/100, GROWTH_RATE=GROWTH_RATE/100, FLOOR=FLOOR)
+        if TYPE == "CSV upload":
+            file = st.file_uploader(label + ' per year [CSV]', type="csv", key=key + "_CSV", help="One column of annual prices [US$/kg], optionally with a column Year.")
+            if file is None:
+                return None
+            COLUMNS = read_price_path_csv(file.getvalue())
+            column = st.selectbox('Column of the CSV file', list(COLUMNS), key=key + "_CSV_COLUMN")
+            return get_price_path_spec("table", VALUES=COLUMNS[column])
+        if TYPE.startswith("Geometric Brownian motion"):
+            DRIFT = st.number_input('Annual drift [%]', value=round(SPEC.get("DRIFT", 0.0)*100, 10), step=1.0, min_value=PRICE_PATH_LIMITS["DRIFT"][0]*100, max_value=PRICE_PATH_LIMITS["DRIFT"][1]*100, key=key + "_DRIFT")
+            VOLATILITY = st.number_input('Annual volatility [%]', value=round(SPEC.get("VOLATILITY", 0.1)*100, 10), step=1.0, min_value=0.0, max_value=PRICE_PATH_LIMITS["VOLATILITY"][1]*100, key=key + "_VOLATILITY")
+            return get_price_path_spec("gbm", START=START, DRIFT=DRIFT/100, VOLATILITY=VOLATILITY/100)
+        if TYPE.startswith("Mean-reverting"):
+            REVERSION = st.number_input('Speed of reversion [1/year]', value=float(SPEC.get("REVERSION", 0.5)), step=0.1, min_value=0.0, max_value=PRICE_PATH_LIMITS["REVERSION"][1], key=key + "_REVERSION")
+            VOLATILITY = st.number_input('Annual volatility [%]', value=round(SPEC.get("VOLATILITY", 0.1)*100, 10), step=1.0, min_value=0.0, max_value=PRICE_PATH_LIMITS["VOLATILITY"][1]*100, key=key + "_VOLATILITY")
+            return get_price_path_spec("mean_reverting", START=START, MEAN=END, REVERSION=REVERSION, VOLATILITY=VOLATILITY/100)
+    except ValueError as error:
+        st.error("Invalid " + label.lower() + " path: " + str(error))
+    return None
+
+
+def restore_scenario_from_url():
+    """
+    Restores the scenario of the query parameter "scenario" (e.g. of a shared
+    link, see utils.scenario_library) once as confirmed scenario. Returns the
+    restored scenario of the session, whose inputs are shown by the widgets,
+    or None.
+    """
+    token = st.query_params.get(SCENARIO_QUERY_PARAM)
+    if token is not None and token != st.session_state.get("H2G_SCENARIO_TOKEN"):
+        st.session_state["H2G_SCENARIO_TOKEN"] = token
+        try:
+            #____Stored mechanism results of the library are added to the cache, so they are not simulated again.
+            scenario = restore_scenario(token, library=get_default_scenario_library())
+            scenario.validate()
+        except ValueError as error:
+            st.error("The scenario of the link cannot be restored: " + str(error))
+        else:
+            st.session_state["H2G_RESTORED"] = scenario
+            st.session_state["H2G_SCENARIO"] = scenario
+            #____Widgets with keys keep their state, so the inputs of price paths are reset.
+            for key in list(st.session_state):
+                if key.startswith(("H2G_PURCHASE_PRICE_PATH", "H2G_SALES_PRICE_PATH")):
+                    del st.session_state[key]
+    return st.session_state.get("H2G_RESTORED")
+
+
+def _get_input_value(RESTORED, name, default, scale=1):
+    #Value of a widget: the parameter of the restored scenario in units of the widget, or the default of the widget.
+    if RESTORED is None:
+        return default
+    return type(default)(round(getattr(RESTORED, name)*scale, 10))
+
+
+def _get_price_path_spec(RESTORED, name):
+    #Generator of a price path of the restored scenario, annual prices are restored as table.
+    from utils.price_paths import get_price_path_spec
+
+    if RESTORED is None:
+        return None
+    if getattr(RESTORED, name) is not None:
+        return get_price_path_spec("table", VALUES=getattr(RESTORED, name))
+    return getattr(RESTORED, name + "_PATH")
+
+
+def show_scenario_library(scenario):
+    """
+    Shows the link parameter of the current inputs and, if a scenario
+    library is configured, saves scenarios to and loads scenarios from the
+    library, see utils.scenario_library.
+    """
+    if scenario is not None:
+        st.caption("The address of this page holds the confirmed scenario and can be shared. Link parameter of the current inputs:")
+        st.code("?" + SCENARIO_QUERY_PARAM + "=" + encode_scenario(scenario), language=None)
+
+    library = get_default_scenario_library()
+    if library is None:
+        st.caption("Set the environment variable " + SCENARIO_LIBRARY_ENV + " to save scenarios and their results.")
+        return
+
+    NAME = st.text_input("Name of the scenario")
+    if st.button("Save scenario") and scenario is not None:
+        #____Mechanism results are saved along, if the scenario was simulated already.
+        library.save(scenario, NAME, ATTR=SIMULATION_CACHE.get(scenario.get_mechanism_hash()))
+        st.success("Scenario saved.")
+
+    SAVED = library.list_scenarios()
+    if SAVED:
+        i = st.selectbox(
+            "Saved scenarios",
+            range(len(SAVED)),
+            format_func=lambda i: SAVED[i]["NAME"] + " (" + DICT_CARRIER_SHORT.get(SAVED[i]["CARRIER"], SAVED[i]["CARRIER"]) + ")",
+            )
+        if st.button("Load scenario"):
+            st.query_params[SCENARIO_QUERY_PARAM] = SAVED[i]["TOKEN"]
+            st.rerun()
+
+
 def show_evaluation_page():
+    """
+    Shows the evaluation page. Each run of the page is measured as request
+    "evaluation_page", see utils.instrumentation.
+    """
+    #The Prometheus text endpoint is only started, if H2G_METRICS_PORT is set.
+    start_metrics_server()
+    #Large exports are streamed by a separate endpoint, if H2G_EXPORT_PORT is set.
+    start_export_server()
+    #Imports, a dummy simulation and the plotly templates are warmed once per process.
+    start_warmup()
+    debug = is_debug_panel_enabled()
+    #____Tracing slows down all sessions of the server, so it is only enabled server-side, never by a query parameter.
+    if os.environ.get(DEBUG_PANEL_ENV):
+        set_memory_tracing(True)
+    
+    with request_scope("evaluation_page") as REQUEST:
+        _show_evaluation_page()
+    
+    if debug:
+        show_debug_panel(REQUEST)
+
+
+def _show_evaluation_page():
     st.image("images/logo_H2G.png")
     st.title('Exploring the H2Global Mechanism')
     
+    #Scenario of a shared link or of the scenario library, whose inputs are shown by the widgets
+    RESTORED = restore_scenario_from_url()
+    
     #Main input parameters    
     Derivative = st.selectbox(
     "Please select an energy carrier",
-    ("Hydrogen", "Ammonia", "Sustainable Aviation Fuel (SAF)", "Methanol"),
-    index=None,
+    tuple(DICT_CARRIER_SHORT),
+    index=None if RESTORED is None else tuple(DICT_CARRIER_SHORT).index(RESTORED.CARRIER),
     placeholder="Select energy carrier...",
     )
     
     Subsidy_Volume = st.number_input(
         'Funding volume [Billion US$]',
-        value = 1.0,
+        value = _get_input_value(RESTORED, "SUBSIDY_VOLUME", 1.0, 1e-9),
         step=0.1,
         min_value=0.0
         )
@@ -63,58 +388,57 @@ def show_evaluation_page():
 
     Period = st.number_input(
         'Funding period [years]',
-        value = 10,
-        min_value=0
+        value = _get_input_value(RESTORED, "PERIOD", 10),
+        min_value=SCENARIO_LIMITS["PERIOD"][0],
+        max_value=SCENARIO_LIMITS["PERIOD"][1]
         )
     
-    if Derivative == "Hydrogen":
-        Purchase_Price_Start_DEFAULT = 6.0
-        Purchase_Price_End_DEFAULT = 6.0
-        Sales_Price_Start_DEFAULT = 3.0
-        Sales_Price_End_DEFAULT = 4.5
-    elif Derivative == "Ammonia":
-        Purchase_Price_Start_DEFAULT = 1.0
-        Purchase_Price_End_DEFAULT = 1.0
-        Sales_Price_Start_DEFAULT = 0.5
-        Sales_Price_End_DEFAULT = 0.65
-    else:
-        Purchase_Price_Start_DEFAULT = 6.0
-        Purchase_Price_End_DEFAULT = 6.0
-        Sales_Price_Start_DEFAULT = 3.0
-        Sales_Price_End_DEFAULT = 4.5
+    #Default prices of the carrier, see utils.h2global_model
+    (
+        Purchase_Price_Start_DEFAULT,
+        Purchase_Price_End_DEFAULT,
+        Sales_Price_Start_DEFAULT,
+        Sales_Price_End_DEFAULT
+        ) = get_price_defaults(Derivative)
+    #____Prices of the restored scenario are only kept for its carrier.
+    PRICE_INPUTS = RESTORED if RESTORED is not None and RESTORED.CARRIER == Derivative else None
 
 
     Purchase_Price_Start = st.number_input(
         'Purchase price start [US$/kg]',
-        value = Purchase_Price_Start_DEFAULT,
+        value = _get_input_value(PRICE_INPUTS, "PURCHASE_PRICE_START", Purchase_Price_Start_DEFAULT),
         step=0.1,
         min_value=0.0,
+        max_value=SCENARIO_LIMITS["PURCHASE_PRICE_START"][1],
         help="""The purchase price includes transport costs from the production site to the agreed demand location."""
         )
     Purchase_Price_End = st.number_input(
         'Purchase price end [US$/kg]',
-        value = Purchase_Price_End_DEFAULT,
+        value = _get_input_value(PRICE_INPUTS, "PURCHASE_PRICE_END", Purchase_Price_End_DEFAULT),
         step=0.1,
         min_value=0.0,
+        max_value=SCENARIO_LIMITS["PURCHASE_PRICE_END"][1],
         help="""The purchase price includes transport costs from the production site to the agreed demand location."""
         )
     Sales_Price_Start = st.number_input(
         'Sales price start [US$/kg]',
-        value = Sales_Price_Start_DEFAULT,
+        value = _get_input_value(PRICE_INPUTS, "SALES_PRICE_START", Sales_Price_Start_DEFAULT),
         step=0.1,
-        min_value=0.0
+        min_value=0.0,
+        max_value=SCENARIO_LIMITS["SALES_PRICE_START"][1]
         )
 
     Sales_Price_End = st.number_input(
         'Sales price end [US$/kg]',
-        value = Sales_Price_End_DEFAULT,
+        value = _get_input_value(PRICE_INPUTS, "SALES_PRICE_END", Sales_Price_End_DEFAULT),
         step=0.1,
-        min_value=0.0
+        min_value=0.0,
+        max_value=SCENARIO_LIMITS["SALES_PRICE_END"][1]
         )
 
     Sales_Price_Volatility = st.number_input(
         'Standard deviation of sales price [%] - BETA',
-        value=0.0,
+        value=_get_input_value(RESTORED, "SALES_PRICE_VOLATILITY", 0.0, 100),
         step=0.5,
         min_value=0.0,
         max_value=20.0
@@ -122,6 +446,11 @@ def show_evaluation_page():
 
     Sales_Price_Volatility = Sales_Price_Volatility/100
 
+    with st.expander("Click for price paths beyond a linear development"):
+        st.markdown("Start and end prices above are used as start of learning curves and stochastic paths, and as mean of mean-reverting paths.")
+        Purchase_Price_Path = show_price_path_inputs('Purchase price', "H2G_PURCHASE_PRICE_PATH", Purchase_Price_Start, Purchase_Price_End, Period, _get_price_path_spec(RESTORED, "PURCHASE_PRICE"))
+        Sales_Price_Path = show_price_path_inputs('Sales price', "H2G_SALES_PRICE_PATH", Sales_Price_Start, Sales_Price_End, Period, _get_price_path_spec(RESTORED, "SALES_PRICE"))
+
     # Create an expander object
     expander_mechanism = st.expander("Click for further specifications of the H2Global mechanism")
     
@@ -131,7 +460,7 @@ def show_evaluation_page():
         #Ratio of the funding volume which is used to purchase hydrogen-derivatives for long-term SALES agreements.
         RATIO_LONGTERM_HSA = st.number_input(
             'Ratio of long-term sales agreements',
-            value = 0.0,
+            value = _get_input_value(RESTORED, "RATIO_LONGTERM_HSA", 0.0),
             step=0.1,
             min_value=0.0,
             max_value=1.0,
@@ -141,33 +470,36 @@ def show_evaluation_page():
         #Ratio of the funding volume which is used to purchase hydrogen-derivatives for long-term SALES agreements.
         FLOOR_PRICE_HSA = st.number_input(
             'Floor price for long-term sales [US$/kg]',
-            value = 4.0,
+            value = _get_input_value(RESTORED, "FLOOR_PRICE_HSA", 4.0),
             step=0.1,
             min_value=0.0,
+            max_value=SCENARIO_LIMITS["FLOOR_PRICE_HSA"][1],
             help="""Only relevant, if long-term sales agreements exist. The floor price indicates the minimum price the offtaker is paying, even if the market price is lower than the floor price."""
             )
          
         #Ratio of the funding volume which is used to purchase hydrogen-derivatives for long-term SALES agreements.
         BID_CAP_HSA = st.number_input(
             'Ceiling price of long-term sales [US$/kg]',
-            value = 4.0,
+            value = _get_input_value(RESTORED, "BID_CAP_HSA", 4.0),
             step=0.1,
             min_value=0.0,
+            max_value=SCENARIO_LIMITS["BID_CAP_HSA"][1],
             help="""Only relevant, if long-term sales agreements exist. The ceiling price indicates the maximum price the offtaker is paying, even if the market price exceeds the ceiling price."""
             )
         
         #Keyword / specific input parameters
         Reinvest_Cycles = st.number_input(
             'Re-usage of sales revenue: cycles',
-            value = 2,
-            min_value=-1,
+            value = _get_input_value(RESTORED, "REINVEST_CYCLES", 2),
+            min_value=SCENARIO_LIMITS["REINVEST_CYCLES"][0],
+            max_value=SCENARIO_LIMITS["REINVEST_CYCLES"][1],
             help="""How often are the proceeds from sales being re-used for additional purchases per year?"""
             )
         
         #Ratio of the funding volume which is used to purchase hydrogen-derivatives for long-term SALES agreements.
         RATIO_GUARANTEED_SHORTTERM_HSA = st.number_input(
             'Ratio of guaranteed short-term sales',
-            value = 0.0,
+            value = _get_input_value(RESTORED, "RATIO_GUARANTEED_SHORTTERM_HSA", 0.0),
             step=0.1,
             min_value=0.0,
             max_value=1.0,
@@ -186,25 +518,34 @@ def show_evaluation_page():
         #Depreciation period of fiscal loan
         DEPRECIATION_PERIOD = st.number_input(
             'Depreciation period [years]',
-            value = 25,
+            value = _get_input_value(RESTORED, "DEPRECIATION_PERIOD", 25),
             step=1,
-            min_value=0,
+            min_value=SCENARIO_LIMITS["DEPRECIATION_PERIOD"][0],
+            max_value=SCENARIO_LIMITS["DEPRECIATION_PERIOD"][1],
             )
 
         #Depreciation period of fiscal loan
         GRACE_PERIOD = st.number_input(
             'Grace period of the loan [years]',
-            value = 8,
+            value = _get_input_value(RESTORED, "GRACE_PERIOD", 8),
             step=1,
             min_value=0,
             help="During the grace period, no principal payments have to be made."
             )
 
+        LOAN_PROFILE = st.selectbox(
+            'Repayment profile of the loan',
+            tuple(LOAN_PROFILES),
+            index=tuple(LOAN_PROFILES).index(RESTORED.LOAN_PROFILE) if RESTORED is not None else 0,
+            format_func=LOAN_PROFILES.get,
+            help="Interest is paid on the outstanding balance. Sculpted repayments follow the annual fiscal revenues of the instrument."
+            )
+
 
         #Depreciation period of fiscal loan
         WACC_PERCENT = st.number_input(
             'Cost of Capital [%]',
-            value = 2.5,
+            value = _get_input_value(RESTORED, "WACC", 2.5, 100),
             step=0.1,
             min_value=0.0,
             )
@@ -213,7 +554,7 @@ def show_evaluation_page():
         #Depreciation period of fiscal loan
         INFLATION_PERCENT = st.number_input(
             'Inflation [%]',
-            value = 3.0,
+            value = _get_input_value(RESTORED, "INFLATION", 3.0, 100),
             step=0.1,
             min_value=0.0,
             )
@@ -223,7 +564,7 @@ def show_evaluation_page():
         #____Only consider corporate tax on revenue of production projects.
         CORPORATE_TAX_RATE_PERCENT = st.number_input(
             'Corporate tax rate [%]',
-            value = 35,
+            value = _get_input_value(RESTORED, "CORPORATE_TAX_RATE", 35, 100),
             step=1,
             min_value=0,
             )
@@ -239,7 +580,7 @@ def show_evaluation_page():
         #____6) VAT on domestically sold hydrogen or ammonia
         VAT_RATE_PERCENT = st.number_input(
             'VAT rate [%]',
-            value = 19.0,
+            value = _get_input_value(RESTORED, "VAT_RATE", 19.0, 100),
             step=1.0,
             min_value=0.0,
             )
@@ -247,21 +588,24 @@ def show_evaluation_page():
         
         st.markdown("**Please specify below for which revenue streams VAT applies.**")
 
-        VAT_INVEST_BOOL=st.checkbox(label="Investments into machinery and equipment")
-        VAT_HPA_BOOL=st.checkbox(label="Revenue from HPA agreement")
-        VAT_HSA_BOOL=st.checkbox(label="Revenue from HSA agreement")
-        VAT_HYDROGEN_PRODUCT_BOOL=st.checkbox(label="Revenue from domestic hydrogen product (gaseous hydrogen or ammonia) sales")        
-        if Derivative == "Hydrogen":
-            VAT_DRI_BOOL=st.checkbox(label="Revenue from domestic DRI sales")
-            VAT_FERTILIZER_BOOL = False
-        if Derivative == "Ammonia":
-            VAT_FERTILIZER_BOOL=st.checkbox(label="Revenue from domestic fertilizer sales")
-            VAT_DRI_BOOL = False
+        VAT_INVEST_BOOL=st.checkbox(label="Investments into machinery and equipment", value=_get_input_value(RESTORED, "VAT_INVEST_BOOL", False))
+        VAT_HPA_BOOL=st.checkbox(label="Revenue from HPA agreement", value=_get_input_value(RESTORED, "VAT_HPA_BOOL", False))
+        VAT_HSA_BOOL=st.checkbox(label="Revenue from HSA agreement", value=_get_input_value(RESTORED, "VAT_HSA_BOOL", False))
+        VAT_HYDROGEN_PRODUCT_BOOL=st.checkbox(label="Revenue from domestic hydrogen product (gaseous hydrogen or ammonia) sales", value=_get_input_value(RESTORED, "VAT_HYDROGEN_PRODUCT_BOOL", False))        
+        #Downstream products of the carrier, e.g. DRI from hydrogen, fertilizer from ammonia, see utils.carriers.
+        #____Parameters of the downstream chains of other carriers keep the defaults of Scenario.
+        DOWNSTREAM_CHAIN = get_downstream_chain(Derivative) if Derivative in DICT_CARRIER_SHORT else None
+        DOWNSTREAM_PARAMETERS = {}
+        if DOWNSTREAM_CHAIN is not None:
+            DOWNSTREAM_PARAMETERS[DOWNSTREAM_CHAIN["PARAMETERS"][-1]] = st.checkbox(
+                label=DOWNSTREAM_CHAIN["VAT_LABEL"],
+                value=_get_input_value(RESTORED, DOWNSTREAM_CHAIN["PARAMETERS"][-1], False),
+                )
 
         #Import duties
         IMPORT_DUTIES_RATE_PERCENT = st.number_input(
             'Import duties [%]',
-            value = 0.0,
+            value = _get_input_value(RESTORED, "IMPORT_DUTIES_RATE", 0.0, 100),
             step=1.0,
             min_value=0.0,
             )
@@ -269,7 +613,7 @@ def show_evaluation_page():
 
         SHARE_IMPORTED_PRODUCTION_EQUIPMENT_PERCENT = st.number_input(
             'Share of the production equipment which is imported [%]',
-            value = 90,
+            value = _get_input_value(RESTORED, "SHARE_IMPORTED_PRODUCTION_EQUIPMENT", 90, 100),
             step = 1,
             min_value=0,
             max_value=100,
@@ -281,7 +625,7 @@ def show_evaluation_page():
         #SHARES
         SHARE_HPA_CONTRACT_PERCENT = st.number_input(
             'Share of the HPA contract of total production [%]',
-            value = 20,
+            value = _get_input_value(RESTORED, "SHARE_HPA_CONTRACT", 20, 100),
             step=1,
             min_value=0,
             max_value=100
@@ -290,24 +634,16 @@ def show_evaluation_page():
         
         RAMP_UP = st.number_input(
             'Ramp up period for production project [years]',
-            value = 3,
+            value = _get_input_value(RESTORED, "RAMP_UP", 3),
             step=1,
             min_value=0,
             max_value=Period,
             help="During this period, the share of the HPA contract of the total production of the project decreases linearly from 1 to the indicated share."
             )
         
-        if RAMP_UP > 0:
-            DELTA_YEARS_RAMP_UP = DEPRECIATION_PERIOD - RAMP_UP
-            SHARE_HPA_CONTRACT_RAMP_UP = np.linspace(1,SHARE_HPA_CONTRACT_SINGLE,RAMP_UP)
-            SHARE_HPA_CONTRACT_AFTER_RAMP_UP = np.linspace(SHARE_HPA_CONTRACT_SINGLE,SHARE_HPA_CONTRACT_SINGLE,DELTA_YEARS_RAMP_UP)
-            SHARE_HPA_CONTRACT = np.concatenate((SHARE_HPA_CONTRACT_RAMP_UP, SHARE_HPA_CONTRACT_AFTER_RAMP_UP))
-        else:
-            SHARE_HPA_CONTRACT = np.linspace(SHARE_HPA_CONTRACT_SINGLE,SHARE_HPA_CONTRACT_SINGLE,DEPRECIATION_PERIOD)
-        
         SHARE_TAXABLE_INCOME_PERCENT = st.number_input(
             'Share of taxable income of total revenue of the production project [%]',
-            value = 50,
+            value = _get_input_value(RESTORED, "SHARE_TAXABLE_INCOME", 50, 100),
             step=1,
             min_value=0,
             max_value=100
@@ -316,90 +652,22 @@ def show_evaluation_page():
         
         SHARE_DOMESTIC_SALES_PERCENT = st.number_input(
             'Share of total hydrogen product which is sold domestically [%]',
-            value = 50,
+            value = _get_input_value(RESTORED, "SHARE_DOMESTIC_SALES", 50, 100),
             step = 1,
             min_value=0,
             max_value=100
             )
         SHARE_DOMESTIC_SALES = SHARE_DOMESTIC_SALES_PERCENT/100
         
-        if Derivative == "Hydrogen":
-            SHARE_H2_DRI_DOMESTIC_PERCENT = st.number_input(
-                'Share of hydrogen which is used for the domestic production of DRI [%]',
-                value = 50,
-                step = 1,
-                min_value=0,
-                max_value=100,
-                )
-            SHARE_H2_DRI_DOMESTIC = SHARE_H2_DRI_DOMESTIC_PERCENT/100
-
-            DRI_SALES_PRICE_PER_TON = st.number_input(
-                'Domestic sales price of DRI [USD/ton]',
-                value = 300,
-                step = 10,
-                min_value=0,
-                )
-            DRI_SALES_PRICE = DRI_SALES_PRICE_PER_TON/1000
-    
-            DRI_PER_KG_H2 = st.number_input(
-                'DRI production per consumed hydrogen [kg-DRI/kg-H2]',
-                value = 20,
-                step = 1,
-                min_value=0,
-                )
-    
-            SHARE_DOMESTIC_SALES_DRI_PERCENT = st.number_input(
-                'Share of DRI which is sold domestically [%]',
-                value = 100,
-                step = 1,
-                min_value=0,
-                )
-            SHARE_DOMESTIC_SALES_DRI = SHARE_DOMESTIC_SALES_DRI_PERCENT/100
-        
-            #DEFINE FOR FUNCTIONALITY
-            SHARE_NH3_FERTILIZER_DOMESTIC = 0
-            FERTILIZER_SALES_PRICE = 0
-            FERTILIZER_PER_KG_NH3 = 2
-            SHARE_DOMESTIC_SALES_FERTILIZER = 0
-
-        if Derivative == "Ammonia":
-
-            SHARE_NH3_FERTILIZER_DOMESTIC_PERCENT = st.number_input(
-                'Share of ammonia which is used for the domestic production of fertilizer [%]',
-                value = 50,
-                step = 1,
-                min_value=0,
-                )
-            SHARE_NH3_FERTILIZER_DOMESTIC = SHARE_NH3_FERTILIZER_DOMESTIC_PERCENT/100
-    
-            FERTILIZER_SALES_PRICE_PER_TON = st.number_input(
-                'Domestic sales price of ammonia-based fertilizer [USD/ton]',
-                value = 500,
-                step = 10,
-                min_value=0,
-                )
-            FERTILIZER_SALES_PRICE = FERTILIZER_SALES_PRICE_PER_TON/1000
-    
-            FERTILIZER_PER_KG_NH3 = st.number_input(
-                'Fertilizer (urea) production per consumed ammonia [kg-fertilizer/kg-NH3]',
-                value = 2.0,
-                step = 0.1,
-                min_value=0.0,
-                )
-    
-            SHARE_DOMESTIC_SALES_FERTILIZER_PERCENT = st.number_input(
-                'Share of fertilizer which is sold domestically [%]',
-                value = 100,
-                step = 1,
-                min_value=0,
-                )
-            SHARE_DOMESTIC_SALES_FERTILIZER = SHARE_DOMESTIC_SALES_FERTILIZER_PERCENT/100
-                
-            #DEFINE FOR FUNCTIONALITY
-            SHARE_H2_DRI_DOMESTIC = 0
-            DRI_SALES_PRICE = 0
-            DRI_PER_KG_H2 = 20
-            SHARE_DOMESTIC_SALES_DRI = 0
+        if DOWNSTREAM_CHAIN is not None:
+            for PARAMETER, label, value, step, scale in DOWNSTREAM_CHAIN["INPUTS"]:
+                DOWNSTREAM_PARAMETERS[PARAMETER] = st.number_input(
+                    label,
+                    value = _get_input_value(RESTORED, PARAMETER, value, scale),
+                    step = step,
+                    min_value=type(value)(0),
+                    max_value=100 if scale == 100 else None,
+                    )/scale
         
     
     st.markdown("**Which metrics do you want to visualize?**")
@@ -412,279 +680,274 @@ def show_evaluation_page():
     VIS_4=st.checkbox(label="Required electrolyzer capacity [GW]")
     VIS_5=st.checkbox(label="Visualize net-present value of fiscal benefits to the state [US$]")
     VIS_6=st.checkbox(label="Visualize absolute fiscal cashflows [US$]")
+    VIS_7=st.checkbox(label="Sensitivity analysis of fiscal net-present value and traded energy [tornado chart] - BETA")
+    if VIS_7:
+        SENSITIVITY_CHANGE_PERCENT = st.number_input(
+            'Change of each input parameter for the sensitivity analysis [%]',
+            value=10.0,
+            step=1.0,
+            min_value=1.0,
+            max_value=50.0,
+            help="Each input parameter is decreased and increased by this share, while all other parameters are kept at their values."
+            )
     
     
-    if st.button("Confirm selection"):   
-    
-        if Sales_Price_End >= Purchase_Price_End and (RATIO_GUARANTEED_SHORTTERM_HSA > 0 or Reinvest_Cycles == -1):
-            raise ValueError("Definition of input parameters leads to infinite energy purchases. Consider a sales price below the purchase price.")
-        
-        purchase_price_array = np.linspace(Purchase_Price_Start, Purchase_Price_End, Period)
-        sales_price_array = np.linspace(Sales_Price_Start, Sales_Price_End, Period)
-        
-        #(NEW - USING PyPI Package)
-        mechanism_instance = pm.Mechanism(
-            purchase_price=purchase_price_array,
-            sales_price=sales_price_array,
-            subsidy_period=Period,
-            subsidy_volume=Subsidy_Volume,
+    #Scenario of the current inputs
+    if Derivative in DICT_CARRIER_SHORT:
+        scenario = Scenario(
+            CARRIER=Derivative,
+            SUBSIDY_VOLUME=Subsidy_Volume,
+            PERIOD=Period,
+            PURCHASE_PRICE_START=Purchase_Price_Start,
+            PURCHASE_PRICE_END=Purchase_Price_End,
+            SALES_PRICE_START=Sales_Price_Start,
+            SALES_PRICE_END=Sales_Price_End,
+            PURCHASE_PRICE_PATH=Purchase_Price_Path,
+            SALES_PRICE_PATH=Sales_Price_Path,
+            SALES_PRICE_VOLATILITY=Sales_Price_Volatility,
             RATIO_LONGTERM_HSA=RATIO_LONGTERM_HSA,
             FLOOR_PRICE_HSA=FLOOR_PRICE_HSA,
             BID_CAP_HSA=BID_CAP_HSA,
             REINVEST_CYCLES=Reinvest_Cycles,
             RATIO_GUARANTEED_SHORTTERM_HSA=RATIO_GUARANTEED_SHORTTERM_HSA,
-            VOLATILITY=Sales_Price_Volatility
+            DEPRECIATION_PERIOD=DEPRECIATION_PERIOD,
+            GRACE_PERIOD=GRACE_PERIOD,
+            LOAN_PROFILE=LOAN_PROFILE,
+            WACC=WACC,
+            INFLATION=INFLATION,
+            CORPORATE_TAX_RATE=CORPORATE_TAX_RATE,
+            VAT_RATE=VAT_RATE,
+            VAT_INVEST_BOOL=VAT_INVEST_BOOL,
+            VAT_HPA_BOOL=VAT_HPA_BOOL,
+            VAT_HSA_BOOL=VAT_HSA_BOOL,
+            VAT_HYDROGEN_PRODUCT_BOOL=VAT_HYDROGEN_PRODUCT_BOOL,
+            IMPORT_DUTIES_RATE=IMPORT_DUTIES_RATE,
+            SHARE_IMPORTED_PRODUCTION_EQUIPMENT=SHARE_IMPORTED_PRODUCTION_EQUIPMENT,
+            SHARE_HPA_CONTRACT=SHARE_HPA_CONTRACT_SINGLE,
+            RAMP_UP=RAMP_UP,
+            SHARE_TAXABLE_INCOME=SHARE_TAXABLE_INCOME,
+            SHARE_DOMESTIC_SALES=SHARE_DOMESTIC_SALES,
+            **DOWNSTREAM_PARAMETERS,
             )
+    else:
+        scenario = None
+    
+    # Create an expander object
+    expander_goal_seek = st.expander("Click for goal seek: required funding volume or sales price for a target")
+    
+    # Add content to the expander
+    with expander_goal_seek:
         
-        #simulate mechanism
-        mechanism_instance.simulate_mechanism()
-            
-        #Plot hydrogen purchases
-        data_to_plot = pd.DataFrame(
-            {
-               "Hydrogen Purchases [kg]": mechanism_instance.ATTR["Yearly_Product_Purchases"].mean(axis=1),
-               "Hydrogen Purchases STD [kg]": mechanism_instance.ATTR["Yearly_Product_Purchases"].std(axis=1),
-               "Hydrogen Purchases from Funding [$]": mechanism_instance.ATTR["Yearly_Purchases_LONG"].mean(axis=1),
-               "Hydrogen Purchases from Funding STD [$]": mechanism_instance.ATTR["Yearly_Purchases_LONG"].std(axis=1),
-               "Hydrogen Purchases from Sales Revenue [$]": mechanism_instance.ATTR["Yearly_Purchases_SHORT"].mean(axis=1),
-               "Hydrogen Purchases from Sales Revenue STD [$]": mechanism_instance.ATTR["Yearly_Purchases_SHORT"].std(axis=1),
-               "Used Funding Volume [$]": mechanism_instance.ATTR["Yearly_Used_Funding"].mean(axis=1),
-               "Used Funding Volume STD [$]": mechanism_instance.ATTR["Yearly_Used_Funding"].std(axis=1),
-               "Annual Sales [$]" : mechanism_instance.ATTR["Yearly_Sales"].mean(axis=1),
-               "Annual Sales STD [$]" : mechanism_instance.ATTR["Yearly_Sales"].std(axis=1)
-               }
+        GOAL_SEEK_METRIC = st.selectbox(
+            "Target metric",
+            tuple(TARGET_METRICS),
+            format_func=TARGET_METRICS.get,
             )
         
-        data_to_plot["Year"] = range(1,Period+1)
-        #Derive purchased hydrogen quantities in kg and tons
-        data_to_plot["Hydrogen Purchases [$]"] = data_to_plot["Hydrogen Purchases from Funding [$]"] + data_to_plot["Hydrogen Purchases from Sales Revenue [$]"]
-        data_to_plot["Hydrogen Purchases STD [$]"] = data_to_plot["Hydrogen Purchases from Funding STD [$]"] + data_to_plot["Hydrogen Purchases from Sales Revenue STD [$]"]
-        data_to_plot["Hydrogen Purchases [tons]"] = data_to_plot["Hydrogen Purchases [kg]"] / 1000
-        data_to_plot["Hydrogen Purchases STD [tons]"] = data_to_plot["Hydrogen Purchases STD [kg]"] / 1000
-        data_to_plot["Hydrogen Purchases from Funding [kg]"] = mechanism_instance.ATTR["Yearly_Product_Purchases_LONG"].mean(axis=1)
-        data_to_plot["Hydrogen Purchases from Funding [tons]"] = data_to_plot["Hydrogen Purchases from Funding [kg]"] / 1000
-        data_to_plot["Hydrogen Purchases from Sales Revenue [kg]"] = data_to_plot["Hydrogen Purchases [kg]"] - data_to_plot["Hydrogen Purchases from Funding [kg]"]
-        data_to_plot["Hydrogen Purchases from Sales Revenue [tons]"] = data_to_plot["Hydrogen Purchases from Sales Revenue [kg]"] / 1000
-        data_to_plot["NOT Used Funding Volume [$]"] = Subsidy_Volume/Period - data_to_plot["Used Funding Volume [$]"]
-        data_to_plot["Total Used Funding Volume [$]"] = data_to_plot["Used Funding Volume [$]"].cumsum()
-        data_to_plot["Total NOT Used Funding Volume [$]"] = Subsidy_Volume - data_to_plot["Total Used Funding Volume [$]"]
+        GOAL_SEEK_TARGET = st.number_input(
+            'Target [Mt]',
+            value=1.0,
+            step=0.1,
+            min_value=0.0,
+            )
         
-        #Efficiency from renewable electricity to 
-        dict_efficiency_factors = {
-            "Hydrogen" : 0.7,
-            "Ammonia" : 0.7*0.55,
-            "Sustainable Aviation Fuel (SAF)" : 0.7*0.6,
-            "Methanol" : 0.7*0.8
-            }
+        GOAL_SEEK_PARAMETER = st.selectbox(
+            "Solve for",
+            tuple(GOAL_SEEK_PARAMETERS),
+            format_func=GOAL_SEEK_PARAMETERS.get,
+            help="For the sales price, the sales price at the start of the funding period is shifted by the same amount as the sales price at the end."
+            )
         
-        #Lower heating values
-        dict_LHV = {
-            "Hydrogen" : 33.33,
-            "Ammonia" : 5.2,
-            "Sustainable Aviation Fuel (SAF)" : 12.17,
-            "Methanol" : 5.58
-            }
+        if st.button("Solve"):
+            
+            if scenario is None:
+                raise ValueError("No such carrier defined.")
+            
+            try:
+                GOAL_SEEK = solve_goal_seek(scenario, GOAL_SEEK_METRIC, GOAL_SEEK_TARGET*1e6, GOAL_SEEK_PARAMETER)
+            except ValueError as error:
+                st.error(str(error))
+            else:
+                if GOAL_SEEK_PARAMETER == "SUBSIDY_VOLUME":
+                    st.write("Required funding volume:", round(GOAL_SEEK["VALUE"]*1e-9, 3), "[Billion US$]")
+                else:
+                    st.write(
+                        "Required sales price start / end:",
+                        round(GOAL_SEEK["SCENARIO"].SALES_PRICE_START, 3), "/",
+                        round(GOAL_SEEK["SCENARIO"].SALES_PRICE_END, 3), "[US$/kg]"
+                        )
+                st.write(
+                    TARGET_METRICS[GOAL_SEEK_METRIC], "reached:", round(GOAL_SEEK["ACHIEVED"]*1e-6, 3), "[Mt].",
+                    "Number of simulations:", GOAL_SEEK["SIMULATIONS"]
+                    )
+
+    expander_what_if = st.expander("Click for a what-if analysis of funding volume and prices")
+
+    with expander_what_if:
+
+        if scenario is not None:
+            show_what_if(scenario)
+
+    expander_comparison = st.expander("Click to compare energy carriers under the same funding settings")
+
+    with expander_comparison:
+
+        COMPARISON_CARRIERS = st.multiselect(
+            "Energy carriers",
+            tuple(DICT_CARRIER_SHORT),
+            default=tuple(DICT_CARRIER_SHORT),
+            help="The selected energy carrier keeps the prices above, all other carriers are evaluated at their default prices."
+            )
+
+        if st.button("Compare") and COMPARISON_CARRIERS:
+
+            if scenario is None:
+                raise ValueError("No such carrier defined.")
+
+            import pandas as pd
+            from utils.carrier_comparison import COMPARISON_METRICS, run_carrier_comparison
+            from utils.h2global_charts import get_carrier_comparison_figure
+
+            try:
+                #All carriers are simulated at once on a process pool.
+                COMPARISON = run_carrier_comparison(scenario, COMPARISON_CARRIERS)
+            except ValueError as error:
+                st.error(str(error))
+            else:
+                st.dataframe(pd.DataFrame(
+                    {COMPARISON_METRICS[METRIC]: VALUES for METRIC, VALUES in COMPARISON["TABLE"].items()},
+                    index=[DICT_CARRIER_SHORT[c] for c in COMPARISON["CARRIERS"]],
+                    ))
+                for column, title in (
+                        ("Hydrogen Purchases [tons]", "Traded Product [tons]"),
+                        ("Mitigated CO2-emissions [tons]", "Mitigated CO2-emissions* [tons]"),
+                        ("Required installed electrolyzer capacity [GW]", "Required Installed Electrolyzer Capacity [GW]"),
+                        ):
+                    st.plotly_chart(get_carrier_comparison_figure(COMPARISON, column, title), use_container_width=True)
+
+    expander_library = st.expander("Click to save, load or share scenarios")
+
+    with expander_library:
+        show_scenario_library(scenario)
+    
+    if st.button("Confirm selection"):   
     
+        if scenario is None:
+            raise ValueError("No such carrier defined.")
         
-        #operational full load hours of the electrolyzer
-        full_load_hours = 4000
-        data_to_plot["Required installed electrolyzer capacity [GW]"] = data_to_plot["Hydrogen Purchases [tons]"]*1e+3*dict_LHV[Derivative]*1e-6 / (full_load_hours*dict_efficiency_factors[Derivative])
+        scenario.validate()
+        #____The confirmed scenario is kept for the session, so that toggling a metric
+        #____afterwards only renders the newly selected chart.
+        st.session_state["H2G_SCENARIO"] = scenario
+    
+    elif scenario is not None and "H2G_SCENARIO" in st.session_state:
+        
+        #____Edits of a confirmed scenario, which keep the mechanism stage (e.g. fiscal parameters),
+        #____are applied at once: only the downstream stages are rerun, see utils.pipeline.
+        #____Edits of the mechanism inputs still have to be confirmed.
+        if "mechanism" not in get_changed_stages(st.session_state["H2G_SCENARIO"], scenario):
+            try:
+                scenario.validate()
+            except ValueError:
+                pass
+            else:
+                st.session_state["H2G_SCENARIO"] = scenario
+    
+    if "H2G_SCENARIO" in st.session_state:
+        
+        #Figures are built on first request and cached across sessions, see utils.h2global_charts.
+        from utils.h2global_charts import get_figure, get_fiscal_distribution, get_sensitivity_analysis, get_tornado_figure, put_figure_jsons
+        from utils.result_store import get_default_result_store
+        from utils.scenario_atlas import get_atlas_results, get_default_atlas
+        
+        scenario = st.session_state["H2G_SCENARIO"]
+        store = get_default_result_store()
+        
+        #____The address of the page holds the confirmed scenario, so that it can be shared, see utils.scenario_library.
+        token = encode_scenario(scenario)
+        if st.query_params.get(SCENARIO_QUERY_PARAM) != token:
+            st.session_state["H2G_SCENARIO_TOKEN"] = token
+            st.query_params[SCENARIO_QUERY_PARAM] = token
+        
+        #(NEW - USING PyPI Package)
+        #____Simulations are cached across sessions, keyed on the full input vector.
+        #____If a result store is configured, past runs are read from disk instead of being simulated.
+        #____Scenarios of the precomputed atlas are served with their results and figures.
+        #____Otherwise, the simulation runs as background job, repeated submissions join the running job.
+        #____Short simulations are awaited, longer ones are polled until they are done.
+        results = get_atlas_results(scenario)
+        if results is not None:
+            put_figure_jsons(scenario, get_default_atlas().get_figure_jsons(scenario))
+        else:
+            job_id = SIMULATION_JOBS.submit_scenario(scenario, store=store)
+            try:
+                job = SIMULATION_JOBS.wait(job_id, timeout=JOB_INLINE_WAIT_SECONDS)
+            except TimeoutError:
+                show_job_progress(job_id, scenario)
+                return
+            
+            if job.state == JOB_FAILED:
+                st.error("Simulation failed: " + job.error)
+                return
+            
+            results = ScenarioResults(scenario, store=store, ATTR=job.ATTR, memoize=True)
+            
+            #____Mechanism results of confirmed scenarios are kept in the scenario library, so shared links are not simulated again.
+            library = get_default_scenario_library()
+            if library is not None:
+                library.put_attr(scenario.get_mechanism_hash(), job.ATTR)
         
         #VISUALIZATIONS
         
         #____Define short name for derivative
-        if Derivative == "Hydrogen":
-            Derivative_Short = "Hydrogen"
-        elif Derivative == "Ammonia":
-            Derivative_Short = "Ammonia"
-        elif Derivative == "Sustainable Aviation Fuel (SAF)":
-            Derivative_Short = "SAF"
-        elif Derivative == "Methanol":
-            Derivative_Short = "Methanol"
-        else:
-            raise ValueError("No such carrier defined.")
+        Derivative_Short = DICT_CARRIER_SHORT[scenario.CARRIER]
         
         if VIS_0:
-                    
-            fig = go.Figure()
-            
-            #Add bar for Hydrogen Purchases from Funding with error bars
-            fig.add_trace(go.Bar(
-                x=data_to_plot['Year'],
-                y=data_to_plot['Hydrogen Purchases from Funding [$]'],
-                name=Derivative_Short + ' purchases <br>using initial funding [US$]'
-                )
-            )
-    
-            # Add bar for Hydrogen Purchases from Sales Revenue with error bars
-            fig.add_trace(go.Bar(
-                x=data_to_plot['Year'],
-                y=data_to_plot['Hydrogen Purchases from Sales Revenue [$]'],
-                name=Derivative_Short + ' purchases <br>using sales revenue [US$]',
-                error_y=dict(
-                    type='data',
-                    array=data_to_plot["Hydrogen Purchases STD [$]"],
-                    visible=True)
-                ),
-                )
-    
-            # Update layout to stack bars
-            fig.update_layout(
-                title="Traded " + Derivative_Short + " [US$]",
-                barmode='stack',  # Stack bars
-                xaxis_title='Year',
-                yaxis_title='Cashflows [US$]',
-            )
             
             # Render the Plotly chart in Streamlit
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(get_figure(results, "VIS_0"), use_container_width=True)
             
-            Total_Hydrogen_Purchases = data_to_plot["Hydrogen Purchases [$]"].sum() * 1e-6
+            Total_Hydrogen_Purchases = results.TOTAL_PURCHASES_USD * 1e-6
             
             st.write("Total ", Derivative_Short, " purchases within contract period [Million $]:", int(round(Total_Hydrogen_Purchases, 0)))
           
         if VIS_1:
             
-            
-            fig1 = go.Figure()
-            
-            #Add bar for Hydrogen Purchases from Funding with error bars
-            fig1.add_trace(go.Bar(
-                x=data_to_plot['Year'],
-                y=data_to_plot['Hydrogen Purchases from Funding [tons]'],
-                name=Derivative_Short + ' purchases <br>using initial funding [tons]'
-                )
-            )
-    
-            # Add bar for Hydrogen Purchases from Sales Revenue with error bars
-            fig1.add_trace(go.Bar(
-                x=data_to_plot['Year'],
-                y=data_to_plot['Hydrogen Purchases from Sales Revenue [tons]'],
-                name=Derivative_Short + ' purchases <br>using sales revenue [tons]',
-                error_y=dict(
-                    type='data',
-                    array=data_to_plot["Hydrogen Purchases STD [tons]"],
-                    visible=True)
-                ),
-                )
-    
-            # Update layout to stack bars
-            fig1.update_layout(
-                title="Traded " + Derivative_Short + " [tons]",
-                barmode='stack',  # Stack bars
-                xaxis_title='Year',
-                yaxis_title="Purchased " + Derivative_Short + " [tons]",
-            )
-            
             # Render the Plotly chart in Streamlit
-            st.plotly_chart(fig1, use_container_width=True)
+            st.plotly_chart(get_figure(results, "VIS_1"), use_container_width=True)
         
             Total_Hydrogen_Quantity = (
-                data_to_plot["Hydrogen Purchases from Funding [tons]"] +
-                data_to_plot["Hydrogen Purchases from Sales Revenue [tons]"]
+                results["Hydrogen Purchases from Funding [tons]"] +
+                results["Hydrogen Purchases from Sales Revenue [tons]"]
                 ).sum()
                     
             st.write("Total purchased ", Derivative_Short," [Mt]:", round(Total_Hydrogen_Quantity*1e-6, 2))
+        
+        if VIS_2_A or VIS_2_B:
+            
+            #Totals are shared by both funding charts
+            Total_Used_Funding = results.TOTAL_USED_FUNDING_USD
+            RATIO_FUNDING_UTILIZATION = int((Total_Used_Funding / scenario.SUBSIDY_VOLUME)*100)
     
         if VIS_2_A:
             
-            fig2a = px.bar(
-                data_to_plot, 
-                x='Year', 
-                y=[
-                    "Used Funding Volume [$]", 
-                    "NOT Used Funding Volume [$]",
-                    ],
-                title="Annual Funding Usage",
-                labels={ # replaces default labels by column name
-                        "value": "Annual funding [US$]",
-                    },
-                color_discrete_map={'Used Funding Volume [$]': 'rgb(204, 85, 0)', 'NOT Used Funding Volume [$]': 'rgb(255, 165, 0)'}
-                )
-            
-            fig2a.update_traces(
-                name='Funding spent [US$]',
-                selector=dict(name='Used Funding Volume [$]')
-            )     
-            
-            fig2a.update_traces(
-                name='Funding remaining [US$]',
-                selector=dict(name='NOT Used Funding Volume [$]')
-            )     
-            
             #NOT Used Funding Volume --> Remaining funding
-            st.plotly_chart(fig2a, use_container_width=True)
-            
-            Total_Used_Funding = data_to_plot["Used Funding Volume [$]"].sum()
-            Total_NOT_Used_Funding = data_to_plot["NOT Used Funding Volume [$]"].sum()
-            RATIO_FUNDING_UTILIZATION = int((Total_Used_Funding / Subsidy_Volume)*100)
+            st.plotly_chart(get_figure(results, "VIS_2_A"), use_container_width=True)
             
             st.write("Ratio of funding used:", RATIO_FUNDING_UTILIZATION, "[%]")
             st.write("Total amount of funding used:", int(round(Total_Used_Funding * 1e-6, 0)), "[Million US$]")
             
         if VIS_2_B:
             
-            fig2b = px.bar(
-                data_to_plot, 
-                x='Year', 
-                y=[
-                    "Total Used Funding Volume [$]", 
-                    "Total NOT Used Funding Volume [$]",
-                    ],
-                title="Total Funding Usage",
-                labels={ # replaces default labels by column name
-                        "value": "Total funding volume [US$]",
-                    },
-                color_discrete_map={"Total Used Funding Volume [$]": 'rgb(204, 85, 0)', "Total NOT Used Funding Volume [$]": 'rgb(255, 165, 0)'}
-                )
-            
-            fig2b.update_traces(
-                name='Total funding spent [US$]',
-                selector=dict(name='Total Used Funding Volume [$]')
-            )     
-            
-            fig2b.update_traces(
-                name='Total funding remaining [US$]',
-                selector=dict(name='Total NOT Used Funding Volume [$]')
-            )     
-            
-            st.plotly_chart(fig2b, use_container_width=True)
-            
-            Total_Used_Funding = data_to_plot["Used Funding Volume [$]"].sum()
-            Total_NOT_Used_Funding = data_to_plot["NOT Used Funding Volume [$]"].sum()
-            RATIO_FUNDING_UTILIZATION = int((Total_Used_Funding / Subsidy_Volume)*100)
+            st.plotly_chart(get_figure(results, "VIS_2_B"), use_container_width=True)
             
             st.write("Ratio of funding used:", RATIO_FUNDING_UTILIZATION, "[%]")
             st.write("Total amount of funding used:", int(round(Total_Used_Funding * 1e-6, 0)), "[Million US$]")
                
         if VIS_3:
-            #Plot mitigated CO2 emissions
-            #____Emissions according to EU commission: https://eur-lex.europa.eu/legal-content/EN/TXT/?uri=uriserv%3AOJ.L_.2023.157.01.0020.01.ENG&toc=OJ%3AL%3A2023%3A157%3ATOC
-            #________Grey Methanol: 97.1 gCO2eq/MJ, LHV: 19.9 MJ/kg --> 1932.3 gCO2eq/kg
-            #________Grey Ammonia: 2351.3 gCO2eq/kg, LHV: 18.8 MJ/kg --> 2351.3 gCO2eq/kg
-            #________Grey Kerosene: --> 3150 gCO2/kgSAF
-            #____Reference: RED II --> Green hydrogen must mitigate CO2-emissions by a min. of 3.38 kg_CO2/kg_H2
-            #____Reference: Buberger et al. (2022)
-    
-            dict_emission_reduction = {
-                "Hydrogen" : 3.38,
-                "Ammonia" : 2.351*0.7,
-                "Sustainable Aviation Fuel (SAF)" : 3.15*0.7,
-                "Methanol" : 1.932*0.7
-                }
-            
-            data_to_plot["Mitigated CO2-emissions [tons]"] = data_to_plot["Hydrogen Purchases [tons]"]*dict_emission_reduction[Derivative]
-        
-            fig3 = px.scatter(
-                data_to_plot, 
-                x='Year', 
-                y='Mitigated CO2-emissions [tons]',
-                title="Mitigated CO2-emissions* [tons]"
-                )
-            fig3.update_traces(mode='lines+markers', line_shape='linear', marker_color='green')
-            fig3.update_layout(width=600, height=500, yaxis=dict(range=[0, 1.1*max(data_to_plot['Mitigated CO2-emissions [tons]'])]))
+            #Plot mitigated CO2 emissions, see utils.h2global_model for the emission factors.
             
-            st.plotly_chart(fig3, use_container_width=True)
+            st.plotly_chart(get_figure(results, "VIS_3"), use_container_width=True)
             
             st.markdown(
                 """
@@ -692,7 +955,7 @@ def show_evaluation_page():
                 """
                 )
             
-            total_mitigated_co2 = data_to_plot["Mitigated CO2-emissions [tons]"].sum()
+            total_mitigated_co2 = results.TOTAL_MITIGATED_CO2_TONS
             total_mitigated_co2_million = total_mitigated_co2*1e-6
             total_car_equivalent = total_mitigated_co2 / 50
             
@@ -717,17 +980,8 @@ def show_evaluation_page():
             #____Full load hours: 4000 hours --> No reference yet!
             # H2 [GWh] = Installed capacity [GW] * FLH [h/a] * efficiency; 1000 ton H2 = 33.33 GWh H2 --> 1000/33.33 ton H2 = 30 ton H2 = 1 GWh H2 --> 1 ton H2 = 1/30 GWh H2
             # --> Installed capacity [GW] = H2 [GWh] / (FLH [h/a] * efficiency)
-        
-            fig4 = px.scatter(
-                data_to_plot, 
-                x='Year',
-                y='Required installed electrolyzer capacity [GW]',
-                title="Required Installed Electrolyzer Capacity for Green Hydrogen Production [GW]"
-                )
-            fig4.update_traces(mode='lines+markers', line_shape='linear', marker_color='green')
-            fig4.update_layout(width=600, height=500, yaxis=dict(range=[0, 1.1*max(data_to_plot['Required installed electrolyzer capacity [GW]'])]))
             
-            st.plotly_chart(fig4 , use_container_width=True)
+            st.plotly_chart(get_figure(results, "VIS_4"), use_container_width=True)
             st.markdown("""
                         Technology Assumptions:
                             
@@ -735,401 +989,110 @@ def show_evaluation_page():
                         2) Electrolyzer efficiency: 70% [4]
                                                                                  """)
         
-        if VIS_5 or VIS_6:
+        if VIS_5:
             
-            FISCAL_NPV, FISCAL_CASHFLOWS_DICT, LOAN_CASHFLOWS_DICT, SALES_REVENUES_DICT = get_fiscal_npv(
-                    PRODUCT_TYPE=Derivative,
-                    TOTAL_LOAN=Subsidy_Volume,
-                    ANNUAL_PRODUCTION=data_to_plot["Hydrogen Purchases [kg]"], #kg
-                    ANNUAL_PRODUCT_PURCHASES=data_to_plot["Hydrogen Purchases [$]"], #USD
-                    ANNUAL_PRODUCT_SALES=data_to_plot["Annual Sales [$]"], #USD
-                    ANNUAL_FUNDING=data_to_plot["Used Funding Volume [$]"], #USD   
-                    DEPRECIATION_PERIOD=DEPRECIATION_PERIOD, #YEARS
-                    GRACE_PERIOD=GRACE_PERIOD,
-                    CONTRACT_PERIOD_HPA=Period,
-                    WACC=WACC,
-                    INFLATION=INFLATION,
-                    CORPORATE_TAX_RATE=CORPORATE_TAX_RATE,
-                    SHARE_HPA_CONTRACT=SHARE_HPA_CONTRACT, #This is the share that the HPA contract takes of the companies total revenue.
-                    SHARE_TAXABLE_INCOME=SHARE_TAXABLE_INCOME, #This is the share of the taxable income of the total revenue of the supply side company.
-                    SHARE_DOMESTIC_SALES=SHARE_DOMESTIC_SALES, #This is the share of the hydrogen product which is sold domestically.
-                    SHARE_IMPORTED_PRODUCTION_EQUIPMENT=SHARE_IMPORTED_PRODUCTION_EQUIPMENT, #This is the share of imported production equipment required to construct the production plant.
-                    SHARE_H2_DRI_DOMESTIC=SHARE_H2_DRI_DOMESTIC, #This is the share of the domestically sold hydrogen, which is used for domestic DRI production.  
-                    DRI_SALES_PRICE=DRI_SALES_PRICE, #USD/kg
-                    DRI_PER_KG_H2=DRI_PER_KG_H2, #DRI output per input of H2
-                    SHARE_DOMESTIC_SALES_DRI=SHARE_DOMESTIC_SALES_DRI, #How much of the fertilizer is then sold domestically?
-                    SHARE_NH3_FERTILIZER_DOMESTIC=SHARE_NH3_FERTILIZER_DOMESTIC, #This is the share of the domestically sold ammonia, which is used for domestic fertilizer production.  
-                    FERTILIZER_SALES_PRICE=FERTILIZER_SALES_PRICE, #
-                    FERTILIZER_PER_KG_NH3=FERTILIZER_PER_KG_NH3, #Fertilizer output per input of NH3
-                    SHARE_DOMESTIC_SALES_FERTILIZER=SHARE_DOMESTIC_SALES_FERTILIZER, #How much of the fertilizer is then sold domestically?
-                    IMPORT_DUTIES_RATE=IMPORT_DUTIES_RATE,
-                    VAT_RATE=VAT_RATE,
-                    VAT_INVEST_BOOL=VAT_INVEST_BOOL,
-                    VAT_HPA_BOOL=VAT_HPA_BOOL,
-                    VAT_HSA_BOOL=VAT_HSA_BOOL,
-                    VAT_HYDROGEN_PRODUCT_BOOL=VAT_HYDROGEN_PRODUCT_BOOL,
-                    VAT_DRI_BOOL=VAT_DRI_BOOL,
-                    VAT_FERTILIZER_BOOL=VAT_FERTILIZER_BOOL
-                    )
+            # Display the chart in Streamlit
+            st.plotly_chart(get_figure(results, "VIS_5"))
             
-            if VIS_5:                                
-
-                # Convert dictionary to calculate total depreciated cashflows for each category
-                categories = list(FISCAL_CASHFLOWS_DICT.keys())
-                FISCAL_CASHFLOWS_TOTAL_DEPRECIATED = {}
-                
-                for c in categories:
-                    CASHFLOW_DEPRECIATED_TOTAL = 0
-                    FISCAL_CASHFLOWS_TEMP = FISCAL_CASHFLOWS_DICT[c]
-                    
-                    # If the value is a scalar, add it directly; otherwise, depreciate it over the specified period and sum
-                    if isinstance(FISCAL_CASHFLOWS_TEMP, (int, float)):
-                        FISCAL_CASHFLOWS_TOTAL_DEPRECIATED[c] = FISCAL_CASHFLOWS_TEMP
-                    else:
-                        for t in range(DEPRECIATION_PERIOD):
-                            CASHFLOW_DEPRECIATED_TOTAL += FISCAL_CASHFLOWS_TEMP[t] / (1 + WACC) ** t
-                        FISCAL_CASHFLOWS_TOTAL_DEPRECIATED[c] = CASHFLOW_DEPRECIATED_TOTAL
-                
-                # Prepare data for Plotly as a single stacked bar
-                data = [{'Category': category, 'Total Depreciated Cashflow': value} 
-                        for category, value in FISCAL_CASHFLOWS_TOTAL_DEPRECIATED.items()]
-                
-                # Create a DataFrame for visualization
-                df = pd.DataFrame(data)
-                
-                # Add a dummy column for y-axis to create a single stacked bar
-                df['Stacked Bar'] = 'Total Depreciated Cashflow'
-                
-                # Create a single stacked bar chart
-                fig5 = px.bar(
-                    df,
-                    x="Stacked Bar",  # Single stacked bar label
-                    y="Total Depreciated Cashflow",
-                    color="Category",
-                    labels={'Total Depreciated Cashflow': 'Total Depreciated Cashflow [US$]', 'Stacked Bar': ''},
-                    title="Total Depreciated Cashflow for All Categories [US$]",
-                )
-                
-                # Customize the chart
-                fig5.update_layout(
-                    xaxis=dict(showticklabels=False),  # Hide x-axis tick label
-                    yaxis=dict(
-                        title="Total Depreciated Cashflow [US$]",
-                        zeroline=True,          # Show a zero line on the y-axis
-                        zerolinecolor="black",   # Set the color of the zero line
-                        zerolinewidth=1.5        # Set the thickness of the zero line
-                    ),
-                    showlegend=True  # Show legend for categories
-                )
+            # Display NPV calculation
+            st.write(
+                "Net-present value of funding instrument for fiscal authority:", 
+                round(results.FISCAL_NPV * 1e-6, 2), 
+                "[Million US$]"
+            )
+            
+            #With volatile sales prices or stochastic price paths, evaluate the fiscal model for each simulated path
+            if scenario.is_stochastic():
+                FISCAL_DISTRIBUTION = get_fiscal_distribution(results)
                 
-                # Display the chart in Streamlit
-                st.plotly_chart(fig5)
+                st.plotly_chart(get_figure(results, "VIS_5_DISTRIBUTION"))
                 
-                # Display NPV calculation
+                NPV_PERCENTILES = FISCAL_DISTRIBUTION["NPV_PERCENTILES"]
                 st.write(
-                    "Net-present value of funding instrument for fiscal authority:", 
-                    round(FISCAL_NPV * 1e-6, 2), 
-                    "[Million US$]"
-                )
-                    
-            if VIS_6:
-                
-                # Combine fiscal and loan cashflows into a DataFrame for each year
-                years = list(range(1, DEPRECIATION_PERIOD + 1))  # Define years as labels
-                data = {"Year": years}
-                
-                # Add fiscal cashflows to data dictionary
-                for key, values in FISCAL_CASHFLOWS_DICT.items():
-                    if key == "FISCAL_EXPENSES":
-                        continue
-                    else:
-                        data[key] = values
-                
-                # Add loan cashflows to data dictionary
-                for key, values in LOAN_CASHFLOWS_DICT.items():
-                    data[key] = values
-                
-                # Convert data dictionary to a DataFrame
-                df = pd.DataFrame(data)
-                
-                # Melt DataFrame for Plotly to create stacked bars
-                df_melted = df.melt(id_vars=["Year"], var_name="Category", value_name="Cashflow")
-                
-                # Create a stacked bar chart in Plotly
-                fig6 = px.bar(
-                    df_melted,
-                    x="Year",
-                    y="Cashflow",
-                    color="Category",
-                    title="Yearly Cashflows by Category [US$]",
-                    labels={"Cashflow": "Cashflow [US$]", "Year": "Year"},
-                )
-                
-                # Customize the chart
-                fig6.update_layout(
-                    yaxis=dict(title="Cashflow [US$]", zeroline=True, zerolinecolor="black", zerolinewidth=1.5),
-                    showlegend=True
-                )
-                
+                    "Mean net-present value over all simulated paths:",
+                    round(FISCAL_DISTRIBUTION["NPV_MEAN"] * 1e-6, 2),
+                    "[Million US$]. 5th / 50th / 95th percentile:",
+                    round(NPV_PERCENTILES[5] * 1e-6, 2), "/",
+                    round(NPV_PERCENTILES[50] * 1e-6, 2), "/",
+                    round(NPV_PERCENTILES[95] * 1e-6, 2), "[Million US$]"
+                    )
+                st.write(
+                    "Probability of a negative net-present value:",
+                    round(FISCAL_DISTRIBUTION["PROBABILITY_NEGATIVE_NPV"]*100, 1), "[%]"
+                    )
                 
-                # Display the chart in Streamlit
-                st.plotly_chart(fig6)
+        if VIS_6:
             
-                #Output of sales revenues
-                TOTAL_DOMESTIC_REVENUES = SALES_REVENUES_DICT["DOMESTIC_SALES_REVENUE"].sum()
-                st.write("Total domestic sales revenue (hydrogen product, fertilizer, DRI) [USD Mio.]:", round(TOTAL_DOMESTIC_REVENUES*1e-6, 1))
-                TOTAL_EXPORT_REVENUES = SALES_REVENUES_DICT["EXPORT_SALES_REVENUE"].sum()
-                st.write("Total export sales revenue (hydrogen product, fertilizer, DRI) [USD Mio.]:", round(TOTAL_EXPORT_REVENUES*1e-6, 1))
-
-            
-def get_fiscal_npv(
-        PRODUCT_TYPE,
-        TOTAL_LOAN,
-        ANNUAL_PRODUCTION, #kg
-        ANNUAL_PRODUCT_PURCHASES, #USD
-        ANNUAL_PRODUCT_SALES, #USD
-        ANNUAL_FUNDING, #USD
-        DEPRECIATION_PERIOD, #YEARS
-        GRACE_PERIOD, #YEARS
-        CONTRACT_PERIOD_HPA, #years
-        WACC,
-        INFLATION,
-        CORPORATE_TAX_RATE,
-        SHARE_HPA_CONTRACT, #This is the share that the HPA contract takes of the companies total revenue.
-        SHARE_TAXABLE_INCOME, #This is the share of the taxable income of the total revenue of the supply side company.
-        SHARE_DOMESTIC_SALES, #This is the share of the hydrogen product which is sold domestically.
-        SHARE_IMPORTED_PRODUCTION_EQUIPMENT, #This is the share of imported production equipment required to construct the production plant.
-        SHARE_H2_DRI_DOMESTIC, #This is the share of the domestically sold hydrogen, which is used for domestic DRI production.  
-        DRI_SALES_PRICE, #USD/kg
-        DRI_PER_KG_H2, #DRI output per input of H2
-        SHARE_DOMESTIC_SALES_DRI, #How much of the fertilizer is then sold domestically?
-        SHARE_NH3_FERTILIZER_DOMESTIC, #This is the share of the domestically sold ammonia, which is used for domestic fertilizer production.  
-        FERTILIZER_SALES_PRICE, #
-        FERTILIZER_PER_KG_NH3, #Fertilizer output per input of NH3
-        SHARE_DOMESTIC_SALES_FERTILIZER, #How much of the fertilizer is then sold domestically?
-        IMPORT_DUTIES_RATE,
-        VAT_RATE,
-        VAT_INVEST_BOOL,
-        VAT_HPA_BOOL,
-        VAT_HSA_BOOL,
-        VAT_HYDROGEN_PRODUCT_BOOL,
-        VAT_DRI_BOOL,
-        VAT_FERTILIZER_BOOL,
-        ):
-    
-    if CONTRACT_PERIOD_HPA > DEPRECIATION_PERIOD:
-        raise ValueError("Depreciation period of loan is shorter than HPA contract period.")
-    else:
-        if DEPRECIATION_PERIOD >= CONTRACT_PERIOD_HPA:
-            delta_years = DEPRECIATION_PERIOD - CONTRACT_PERIOD_HPA
-        else:
-            raise ValueError("Loan period must be equal to or larger than contract period.")
-        
-        #resize external input arrays.
-        #____This is the annual production volume under the HPA contract in kg
-        ANNUAL_PRODUCTION = np.concatenate([ANNUAL_PRODUCTION, np.full(delta_years, ANNUAL_PRODUCTION.iloc[-1])]) #kg
-        #____These are the annual product purchases by Hintco
-        ANNUAL_PRODUCT_PURCHASES_HINTCO = np.concatenate([ANNUAL_PRODUCT_PURCHASES, np.zeros(delta_years)]) #USD
-        #____This is for how much producers can sell to the market, after the offtake contract expired.
-        #____Conservative assumption: Last Hintco sales price*inflation
-        ANNUAL_PRODUCT_SALES_AFTER_HINTCO = np.array([ANNUAL_PRODUCT_SALES.iloc[-1]*(1+INFLATION)**t for t in range(delta_years)])
-        #____These are the annual product purchases by Hintco, extended by a future offtake --> Used for calculating the revenue of the production projects.
-        #____Assume the last Hintco sales price here and increase this by inflation.
-        ANNUAL_PRODUCT_PURCHASES_TOTAL = np.concatenate([ANNUAL_PRODUCT_PURCHASES, ANNUAL_PRODUCT_SALES_AFTER_HINTCO]) #USD
-        #____These are the sales via hintco within the contract period.
-        ANNUAL_PRODUCT_SALES_HINTCO = np.concatenate([ANNUAL_PRODUCT_SALES, np.zeros(delta_years)]) #USD
-        #____These are the sales by Hintco, extended by future offtake. --> Used for domestic and export volume calculations.
-        #____Assume the last Hintco sales price here and increase this by inflation.
-        ANNUAL_PRODUCT_SALES_TOTAL = np.concatenate([ANNUAL_PRODUCT_SALES, ANNUAL_PRODUCT_SALES_AFTER_HINTCO]) #USD
-        #____This is the required funding for Hintco.
-        ANNUAL_FUNDING_LONG = np.concatenate([ANNUAL_FUNDING, np.zeros(delta_years)]) #USD
-        
-    #Calculate fiscal benefits. (tax revenues)
-    #____CORPORATE_TAX: Only include supply side, because these will be genuinely new businesses.
-    TOTAL_ANNUAL_PRODUCTION = ANNUAL_PRODUCT_PURCHASES_TOTAL / SHARE_HPA_CONTRACT
-    TOTAL_ANNUAL_PRODUCTION_KG = ANNUAL_PRODUCTION / SHARE_HPA_CONTRACT
-    TOTAL_ANNUAL_PRODUCT_SALES = ANNUAL_PRODUCT_SALES_TOTAL / SHARE_HPA_CONTRACT
-    TAXABLE_INCOME = (SHARE_HPA_CONTRACT*TOTAL_ANNUAL_PRODUCTION + (1-SHARE_HPA_CONTRACT)*TOTAL_ANNUAL_PRODUCT_SALES)*SHARE_TAXABLE_INCOME
-    CORPORATE_TAX = TAXABLE_INCOME * CORPORATE_TAX_RATE
-    DOMESTIC_SALES_REVENUE = 0
-    EXPORT_SALES_REVENUE = 0
-    
-    #____VAT_RATE_INVEST: Includes the VAT on initial investments on the supply side.
-    VAT_INVEST = np.zeros(DEPRECIATION_PERIOD)
-    if PRODUCT_TYPE == "Ammonia":
-        CAPEX_PER_KG_ANNUAL_PRODUCTION = 10 #Evaluation Kenya White Paper: 5.2 (Turkana South 500 MW), Turkana Central 10 MW: 10.6, Kisumu 10GW: 15.7 €/kg NH3/year
-    elif PRODUCT_TYPE == "Hydrogen":
-        CAPEX_PER_KG_ANNUAL_PRODUCTION = 45 #Evaluation Kenya White Paper: 22.3 (Turkana South 500 MW), Turkana Central 10 MW: 38.4, Kisumu 10GW: 57.5 €/kg H2/year 
-    else:
-        raise AttributeError("Unknown -PRODUCT_TYPE-")
-        
-    CAPEX = np.max(ANNUAL_PRODUCTION) * CAPEX_PER_KG_ANNUAL_PRODUCTION
-    if VAT_INVEST_BOOL:
-        VAT_INVEST[0] = CAPEX * VAT_RATE
-    else:
-        VAT_INVEST[0] = 0
-    
-    #____IMPORT_DUTIES_RATE
-    IMPORT_DUTIES = np.zeros(DEPRECIATION_PERIOD)
-    IMPORT_DUTIES[0] = CAPEX * SHARE_IMPORTED_PRODUCTION_EQUIPMENT * IMPORT_DUTIES_RATE
-    
-    #____VAT_HPA
-    if VAT_HPA_BOOL:
-        VAT_HPA = VAT_RATE * ANNUAL_PRODUCT_PURCHASES_HINTCO
-    else:
-        VAT_HPA = 0
-    
-    #____VAT_HSA
-    if VAT_HSA_BOOL:
-        VAT_HSA = VAT_RATE * ANNUAL_PRODUCT_SALES_HINTCO
-    else:
-        VAT_HSA = 0
+            # Display the chart in Streamlit
+            st.plotly_chart(get_figure(results, "VIS_6"))
         
-    TOTAL_DOMESTIC_PRODUCTION = TOTAL_ANNUAL_PRODUCT_SALES * SHARE_DOMESTIC_SALES
-    TOTAL_EXPORT_PRODUCTION = TOTAL_ANNUAL_PRODUCT_SALES * (1-SHARE_DOMESTIC_SALES)
-    TOTAL_DOMESTIC_PRODUCTION_KG = TOTAL_ANNUAL_PRODUCTION_KG * SHARE_DOMESTIC_SALES
-    
-    if PRODUCT_TYPE == "Ammonia":
-        
-        #____VAT_DOMESTIC. E.g. thermal use of ammonia or other direct end-use.
-        DOMESTIC_SALES_REVENUE_PRODUCT = TOTAL_DOMESTIC_PRODUCTION * (1-SHARE_NH3_FERTILIZER_DOMESTIC)
-        DOMESTIC_SALES_REVENUE += DOMESTIC_SALES_REVENUE_PRODUCT
-        EXPORT_SALES_REVENUE_PRODUCT = TOTAL_EXPORT_PRODUCTION
-        EXPORT_SALES_REVENUE += EXPORT_SALES_REVENUE_PRODUCT
-
-        if VAT_HYDROGEN_PRODUCT_BOOL:
-            VAT_DOMESTIC = DOMESTIC_SALES_REVENUE_PRODUCT * VAT_RATE
-        else:
-            VAT_DOMESTIC = 0
-        
-        #____VAT_DRI
-        VAT_DRI = 0
-        
-        #____VAT_FERTILIZER
-        DOMESTIC_SALES_REVENUE_FERTILIZER = (
-            TOTAL_DOMESTIC_PRODUCTION_KG * 
-            SHARE_NH3_FERTILIZER_DOMESTIC * 
-            FERTILIZER_PER_KG_NH3 * 
-            FERTILIZER_SALES_PRICE * 
-            SHARE_DOMESTIC_SALES_FERTILIZER)
-        DOMESTIC_SALES_REVENUE += DOMESTIC_SALES_REVENUE_FERTILIZER
-                
-        EXPORT_SALES_REVENUE_FERTILIZER = (
-            TOTAL_DOMESTIC_PRODUCTION_KG * 
-            SHARE_NH3_FERTILIZER_DOMESTIC * 
-            FERTILIZER_PER_KG_NH3 * 
-            FERTILIZER_SALES_PRICE * 
-            (1-SHARE_DOMESTIC_SALES_FERTILIZER))
-        EXPORT_SALES_REVENUE += EXPORT_SALES_REVENUE_FERTILIZER
-
-        if VAT_FERTILIZER_BOOL:
-            VAT_FERTILIZER = (
-                DOMESTIC_SALES_REVENUE_FERTILIZER * 
-                VAT_RATE
+            #Output of sales revenues
+            SALES_REVENUES_DICT = results.FISCAL_RESULTS["SALES_REVENUES_DICT"]
+            TOTAL_DOMESTIC_REVENUES = SALES_REVENUES_DICT["DOMESTIC_SALES_REVENUE"].sum()
+            st.write("Total domestic sales revenue (hydrogen product, fertilizer, DRI) [USD Mio.]:", round(TOTAL_DOMESTIC_REVENUES*1e-6, 1))
+            TOTAL_EXPORT_REVENUES = SALES_REVENUES_DICT["EXPORT_SALES_REVENUE"].sum()
+            st.write("Total export sales revenue (hydrogen product, fertilizer, DRI) [USD Mio.]:", round(TOTAL_EXPORT_REVENUES*1e-6, 1))
+            
+            #Comparison of the repayment profiles of the loan, evaluated in one batch
+            LOAN_COMPARISON = results.get_loan_comparison()
+            st.markdown("**Comparison of repayment profiles of the loan**")
+            st.dataframe(
+                {
+                    "Repayment profile" : [LOAN_PROFILES[name] for name in LOAN_COMPARISON["PROFILES"]],
+                    "Total interest [USD Mio.]" : (LOAN_COMPARISON["TOTAL_INTEREST"]*1e-6).round(1),
+                    "Highest annual debt service [USD Mio.]" : (LOAN_COMPARISON["MAX_DEBT_SERVICE"]*1e-6).round(1),
+                    "Average life [years]" : LOAN_COMPARISON["AVERAGE_LIFE"].round(1),
+                    },
+                hide_index=True,
                 )
-        else:
-            VAT_FERTILIZER = 0
-
-    
-    elif PRODUCT_TYPE == "Hydrogen":
-        #____VAT_DOMESTIC. E.g. thermal use of hydrogen. 
-        DOMESTIC_SALES_REVENUE_PRODUCT = TOTAL_DOMESTIC_PRODUCTION * (1-SHARE_H2_DRI_DOMESTIC)
-        DOMESTIC_SALES_REVENUE += DOMESTIC_SALES_REVENUE_PRODUCT
-        EXPORT_SALES_REVENUE_PRODUCT = TOTAL_EXPORT_PRODUCTION
-        EXPORT_SALES_REVENUE += EXPORT_SALES_REVENUE_PRODUCT
-
-        if VAT_HYDROGEN_PRODUCT_BOOL:
-            VAT_DOMESTIC = DOMESTIC_SALES_REVENUE_PRODUCT * VAT_RATE
-        else:
-            VAT_DOMESTIC = 0
         
-        #____VAT_DRI
-        DOMESTIC_SALES_REVENUE_DRI = ( 
-            TOTAL_DOMESTIC_PRODUCTION_KG * 
-            SHARE_H2_DRI_DOMESTIC * 
-            DRI_PER_KG_H2 * 
-            DRI_SALES_PRICE * 
-            SHARE_DOMESTIC_SALES_DRI
-            )
-        DOMESTIC_SALES_REVENUE += DOMESTIC_SALES_REVENUE_DRI
-        EXPORT_SALES_REVENUE_DRI = (
-            TOTAL_DOMESTIC_PRODUCTION_KG * 
-            SHARE_H2_DRI_DOMESTIC * 
-            DRI_PER_KG_H2 * 
-            DRI_SALES_PRICE * 
-            (1-SHARE_DOMESTIC_SALES_DRI))
-        EXPORT_SALES_REVENUE += EXPORT_SALES_REVENUE_DRI
-        if VAT_DRI_BOOL:
-            VAT_DRI = (
-                DOMESTIC_SALES_REVENUE_DRI *
-                VAT_RATE
+        if VIS_7:
+            
+            #All perturbed scenarios are evaluated at once, mechanism simulations run in parallel.
+            SENSITIVITY = get_sensitivity_analysis(scenario, SENSITIVITY_CHANGE_PERCENT/100)
+            
+            st.plotly_chart(get_tornado_figure(
+                SENSITIVITY,
+                "FISCAL_NPV",
+                title="Sensitivity of the Net-Present Value of Fiscal Benefits [Million US$]",
+                unit="Million US$",
+                scale=1e-6,
+                ), use_container_width=True)
+            
+            st.plotly_chart(get_tornado_figure(
+                SENSITIVITY,
+                "TOTAL_PURCHASES_TONS",
+                title="Sensitivity of Traded " + Derivative_Short + " [tons]",
+                unit="tons",
+                ), use_container_width=True)
+            
+            st.write(
+                "Baseline: net-present value of", round(SENSITIVITY["BASELINE"]["FISCAL_NPV"]*1e-6, 2),
+                "[Million US$], traded", Derivative_Short, round(SENSITIVITY["BASELINE"]["TOTAL_PURCHASES_TONS"]*1e-6, 2), "[Mt].",
+                "Parameters with a value of zero are not varied."
                 )
-        else:
-            VAT_DRI = 0
-        #____VAT_FERTILIZER
-        VAT_FERTILIZER = 0
         
-    else:
-        raise AttributeError("Unknown -PRODUCT_TYPE-")
-
-
-    FISCAL_BENEFITS = (
-        CORPORATE_TAX +
-        VAT_INVEST + 
-        IMPORT_DUTIES +
-        VAT_HPA + 
-        VAT_HSA +
-        VAT_DOMESTIC +
-        VAT_DRI +
-        VAT_FERTILIZER
-        )
-    
-    #Calculate fiscal expenses. (Cashflows to Hintco)
-    FISCAL_EXPENSES = ANNUAL_FUNDING_LONG
-
-    #Calculate NPV
-    RELEVANT_CASHFLOWS = (
-        FISCAL_BENEFITS -
-        FISCAL_EXPENSES
-        )
-    
-    #Discounting of annual cashflows and investments
-    NPV = 0
-    for t in range(DEPRECIATION_PERIOD):
-        NPV += RELEVANT_CASHFLOWS[t] / (1+WACC)**t
+        expander_export = st.expander("Click to export results as CSV or Parquet")
         
-    FISCAL_CASHFLOWS_DICT = {
-        "FISCAL_EXPENSES" : -FISCAL_EXPENSES,
-        "CORPORATE_TAX" : CORPORATE_TAX,
-        "VAT_INVEST": VAT_INVEST, 
-        "IMPORT_DUTIES": IMPORT_DUTIES,
-        "VAT_HPA": VAT_HPA, 
-        "VAT_HSA": VAT_HSA,
-        "VAT_H2_PRODUCT": VAT_DOMESTIC,
-        "VAT_DRI": VAT_DRI,
-        "VAT_FERTILIZER": VAT_FERTILIZER
-        }
-
-    #calculate loan payments
-    interest_payments = np.array([TOTAL_LOAN*WACC for t in range(DEPRECIATION_PERIOD)])
-    
-    if GRACE_PERIOD == 0:
-        annual_principal = TOTAL_LOAN / DEPRECIATION_PERIOD
-        principal_payments = np.array([annual_principal for t in range(DEPRECIATION_PERIOD)])
-    else:
-        annual_principal = TOTAL_LOAN / (DEPRECIATION_PERIOD-GRACE_PERIOD)
-        principal_payments_I = np.array([0 for t in range(GRACE_PERIOD)])
-        principal_payments_II = np.array([annual_principal for t in range(GRACE_PERIOD, DEPRECIATION_PERIOD)])
-        principal_payments = np.concatenate((principal_payments_I, principal_payments_II), axis=0)
-
-    LOAN_CASHFLOWS_DICT = {
-        "INTEREST_PAYMENTS" : -interest_payments,
-        "PRINCIPAL_PAYMENTS" : -principal_payments
-        }
-
-    SALES_REVENUES_DICT = {
-        "DOMESTIC_SALES_REVENUE" : DOMESTIC_SALES_REVENUE,
-        "EXPORT_SALES_REVENUE" : EXPORT_SALES_REVENUE
-        }
-
-    return NPV, FISCAL_CASHFLOWS_DICT, LOAN_CASHFLOWS_DICT, SALES_REVENUES_DICT
\ No newline at end of file
+        with expander_export:
+            
+            EXPORT_TABLE = st.selectbox("Table", tuple(EXPORT_TABLES), format_func=EXPORT_TABLES.get)
+            EXPORT_FORMAT = st.radio("Format", tuple(EXPORT_FORMATS), format_func=str.upper, horizontal=True)
+            EXPORT_FILENAME = get_export_filename(results, EXPORT_TABLE, EXPORT_FORMAT)
+            
+            #____The endpoint streams the export in chunks, st.download_button keeps the whole file in memory.
+            EXPORT_URL = get_export_url(register_export(results), EXPORT_TABLE, EXPORT_FORMAT)
+            if EXPORT_URL is not None:
+                st.link_button("Download " + EXPORT_FILENAME, EXPORT_URL)
+            elif EXPORT_TABLE == "paths" and scenario.NUMBER_PATHS*scenario.PERIOD > EXPORT_INLINE_MAX_ROWS:
+                st.info(
+                    "The per-path results of this scenario are too large for a download from the page. "
+                    "Reduce the number of simulated paths or start the app with H2G_EXPORT_PORT for streamed exports."
+                    )
+            else:
+                st.download_button(
+                    "Download " + EXPORT_FILENAME,
+                    data=lambda: b"".join(stream_export(results, EXPORT_TABLE, EXPORT_FORMAT)),
+                    file_name=EXPORT_FILENAME,
+                    mime=EXPORT_FORMATS[EXPORT_FORMAT],
+                    )
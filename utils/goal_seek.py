@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Inverse solver (goal seek) for the H2Global mechanism.
+
+Solves for the funding volume, or for the sales price, which is required to
+reach a target of traded tons or mitigated CO2-emissions. The target metric
+increases monotonically with both parameters, so the root is bracketed and
+found with Brent's method (scipy.optimize.brentq).
+
+Evaluations are remembered per scenario, target metric and solved parameter.
+A later goal seek on the same scenario starts from the closest remembered
+evaluations below and above the target, and mechanism simulations are reused
+from the simulation cache.
+"""
+
+import numpy as np
+
+from utils.h2global_model import ScenarioResults
+from utils.simulation_cache import SIMULATION_CACHE, SimulationCache, get_parameter_hash
+from utils.instrumentation import instrumented
+
+#Target metrics, given as attributes of ScenarioResults
+TARGET_METRICS = {
+    "TOTAL_PURCHASES_TONS" : "Traded energy [tons]",
+    "TOTAL_MITIGATED_CO2_TONS" : "Mitigated CO2-emissions [tons]",
+    }
+
+#Solvable parameters. For SALES_PRICE, the value is the sales price at the
+#end of the funding period, the sales price at the start is shifted by the same amount.
+GOAL_SEEK_PARAMETERS = {
+    "SUBSIDY_VOLUME" : "Funding volume [US$]",
+    "SALES_PRICE" : "Sales price end [US$/kg]",
+    }
+
+#Tolerance of the solved parameter, relative to its value
+GOAL_SEEK_RTOL = 1e-4
+#Maximum number of bracket expansions
+GOAL_SEEK_MAX_EXPANSIONS = 30
+
+#Module-level instance, shared across sessions of the Streamlit server.
+#____Holds the evaluated (parameter value, metric) pairs of each goal-seek problem.
+GOAL_SEEK_HISTORY = SimulationCache(max_entries=256)
+
+
+def get_goal_seek_scenario(scenario, PARAMETER, value):
+    """
+    Returns scenario with the solved parameter set to value.
+    """
+    if PARAMETER == "SUBSIDY_VOLUME":
+        return scenario.replace(SUBSIDY_VOLUME=float(value))
+    if PARAMETER == "SALES_PRICE":
+        if scenario.SALES_PRICE is not None or scenario.SALES_PRICE_PATH is not None:
+            raise ValueError("The sales price can only be solved for linear sales prices between start and end.")
+        shift = float(value) - scenario.SALES_PRICE_END
+        return scenario.replace(SALES_PRICE_START=scenario.SALES_PRICE_START + shift, SALES_PRICE_END=float(value))
+    raise KeyError("Unknown goal-seek parameter: " + str(PARAMETER))
+
+
+def _get_history_key(scenario, PARAMETER, METRIC):
+    #All parameters of the scenario, except the solved one, identify the problem.
+    PARAMETERS = scenario.to_dict()
+    if PARAMETER == "SUBSIDY_VOLUME":
+        del PARAMETERS["SUBSIDY_VOLUME"]
+    else:
+        PARAMETERS["SALES_PRICE_START"] = scenario.SALES_PRICE_START - scenario.SALES_PRICE_END
+        del PARAMETERS["SALES_PRICE_END"]
+    return get_parameter_hash(GOAL_SEEK_PARAMETER=PARAMETER, GOAL_SEEK_METRIC=METRIC, **PARAMETERS)
+
+
+def _get_bounds(scenario, PARAMETER):
+    #Lower and upper limit of the solved parameter.
+    if PARAMETER == "SUBSIDY_VOLUME":
+        return 0.0, np.inf
+    #____The sales price start must not become negative.
+    lower = scenario.SALES_PRICE_END - scenario.SALES_PRICE_START
+    lower = max(lower, 0.0)
+    #____Sales prices at or above the purchase price lead to infinite purchases, if sales are guaranteed.
+    if scenario.RATIO_GUARANTEED_SHORTTERM_HSA > 0 or scenario.REINVEST_CYCLES == -1:
+        return lower, scenario.PURCHASE_PRICE_END * (1 - GOAL_SEEK_RTOL)
+    return lower, np.inf
+
+
+@instrumented("goal_seek")
+def solve_goal_seek(scenario, METRIC, TARGET, PARAMETER="SUBSIDY_VOLUME", history=GOAL_SEEK_HISTORY):
+    """
+    Returns the value of PARAMETER ("SUBSIDY_VOLUME" or "SALES_PRICE"), for
+    which the metric METRIC (see TARGET_METRICS) of scenario equals TARGET.
+    Returns a dictionary with
+        "VALUE" : Solved parameter value
+        "SCENARIO" : Scenario with the solved parameter value
+        "ACHIEVED" : Metric at the solved parameter value
+        "SIMULATIONS" : Number of mechanism simulations, which were not cached
+        "EVALUATIONS" : Number of evaluations of the metric
+    Raises a ValueError, if the target cannot be reached.
+    With volatile sales prices, the target applies to the mean over all paths.
+    """
+
+    #scipy is only imported on first use, it is not needed to render the page.
+    from scipy.optimize import brentq
+
+    if METRIC not in TARGET_METRICS:
+        raise KeyError("Unknown target metric: " + str(METRIC))
+    lower, upper = _get_bounds(scenario, PARAMETER)
+
+    key = _get_history_key(scenario, PARAMETER, METRIC)
+    HISTORY = history.get(key)
+    X = list(HISTORY["X"]) if HISTORY is not None else []
+    Y = list(HISTORY["Y"]) if HISTORY is not None else []
+    counters = {"SIMULATIONS": 0, "EVALUATIONS": 0}
+
+    def evaluate(value):
+        if value in X:
+            return Y[X.index(value)]
+        scenario_value = get_goal_seek_scenario(scenario, PARAMETER, value)
+        scenario_value.validate()
+        if scenario_value.get_mechanism_hash() not in SIMULATION_CACHE:
+            counters["SIMULATIONS"] += 1
+        counters["EVALUATIONS"] += 1
+        metric = getattr(ScenarioResults(scenario_value), METRIC)
+        X.append(value)
+        Y.append(metric)
+        return metric
+
+    try:
+        #Bracket: closest remembered evaluations below and above the target,
+        #otherwise start from the current value and a secant step through the origin.
+        x0 = scenario.SUBSIDY_VOLUME if PARAMETER == "SUBSIDY_VOLUME" else scenario.SALES_PRICE_END
+        x0 = min(max(x0, lower), upper)
+        if not any(y < TARGET for y in Y) or not any(y >= TARGET for y in Y):
+            y0 = evaluate(x0)
+            if y0 > 0 and PARAMETER == "SUBSIDY_VOLUME":
+                evaluate(x0 * TARGET / y0)
+
+        for _ in range(GOAL_SEEK_MAX_EXPANSIONS):
+            below = [(x, y) for x, y in zip(X, Y) if y < TARGET]
+            above = [(x, y) for x, y in zip(X, Y) if y >= TARGET]
+            if below and above:
+                break
+            if not above:
+                x_max = max(X)
+                if x_max >= upper:
+                    raise ValueError("Target cannot be reached within the range of the parameter.")
+                evaluate(min(2*x_max if x_max > 0 else 1.0, upper))
+            else:
+                x_min = min(X)
+                if x_min <= lower:
+                    raise ValueError("Target is already exceeded at the lower limit of the parameter.")
+                evaluate(max(x_min/2, lower))
+        else:
+            raise ValueError("Target cannot be bracketed, consider a different starting value.")
+
+        a = max(x for x, y in below)
+        b = min(x for x, y in above)
+        VALUE = b if a >= b else brentq(
+            lambda x: evaluate(x) - TARGET,
+            a, b,
+            xtol=GOAL_SEEK_RTOL*abs(b),
+            rtol=GOAL_SEEK_RTOL,
+            )
+    finally:
+        if X:
+            history.put(key, {"X": np.array(X), "Y": np.array(Y)})
+
+    scenario_value = get_goal_seek_scenario(scenario, PARAMETER, VALUE)
+    return {
+        "VALUE" : VALUE,
+        "SCENARIO" : scenario_value,
+        "ACHIEVED" : getattr(ScenarioResults(scenario_value), METRIC),
+        "SIMULATIONS" : counters["SIMULATIONS"],
+        "EVALUATIONS" : counters["EVALUATIONS"],
+        }
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Charts of the H2Global mechanism app.
+
+Each metric of the evaluation page (VIS_0, VIS_1, ...) has one figure
+function, which only requests the annual result columns it shows from a
+ScenarioResults object. Serialized figures are cached across sessions, keyed
+by pipeline stage and metric, so a figure is only built once per scenario.
+"""
+
+import json
+
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+from utils.h2global_model import DICT_CARRIER_SHORT
+from utils.simulation_cache import SimulationCache
+from utils.pipeline import get_stage_keys
+from utils.instrumentation import measure_stage, register_cache
+
+#Module-level instance, shared across sessions of the Streamlit server.
+FIGURE_CACHE = SimulationCache(max_entries=512, max_bytes=128 * 1024**2)
+register_cache("figure", FIGURE_CACHE)
+
+
+def get_fiscal_distribution(results, cache=FIGURE_CACHE):
+    """
+    Returns the path-wise fiscal NPV distribution of a scenario, which is
+    shared by the histogram and the summary statistics of VIS_5.
+    """
+    key = get_stage_keys(results.scenario)["fiscal"] + ":FISCAL_DISTRIBUTION"
+    FISCAL_DISTRIBUTION = cache.get(key)
+    if FISCAL_DISTRIBUTION is None:
+        FISCAL_DISTRIBUTION = cache.put(key, results.get_fiscal_distribution())
+    return FISCAL_DISTRIBUTION
+
+
+def get_traded_usd_figure(results):
+    Derivative_Short = DICT_CARRIER_SHORT[results.scenario.CARRIER]
+
+    fig = go.Figure()
+
+    #Add bar for Hydrogen Purchases from Funding with error bars
+    fig.add_trace(go.Bar(
+        x=results['Year'],
+        y=results['Hydrogen Purchases from Funding [$]'],
+        name=Derivative_Short + ' purchases <br>using initial funding [US$]'
+        )
+    )
+
+    # Add bar for Hydrogen Purchases from Sales Revenue with error bars
+    fig.add_trace(go.Bar(
+        x=results['Year'],
+        y=results['Hydrogen Purchases from Sales Revenue [$]'],
+        name=Derivative_Short + ' purchases <br>using sales revenue [US$]',
+        error_y=dict(
+            type='data',
+            array=results["Hydrogen Purchases STD [$]"],
+            visible=True)
+        ),
+        )
+
+    # Update layout to stack bars
+    fig.update_layout(
+        title="Traded " + Derivative_Short + " [US$]",
+        barmode='stack',  # Stack bars
+        xaxis_title='Year',
+        yaxis_title='Cashflows [US$]',
+    )
+    return fig
+
+
+def get_traded_tons_figure(results):
+    Derivative_Short = DICT_CARRIER_SHORT[results.scenario.CARRIER]
+
+    fig1 = go.Figure()
+
+    #Add bar for Hydrogen Purchases from Funding with error bars
+    fig1.add_trace(go.Bar(
+        x=results['Year'],
+        y=results['Hydrogen Purchases from Funding [tons]'],
+        name=Derivative_Short + ' purchases <br>using initial funding [tons]'
+        )
+    )
+
+    # Add bar for Hydrogen Purchases from Sales Revenue with error bars
+    fig1.add_trace(go.Bar(
+        x=results['Year'],
+        y=results['Hydrogen Purchases from Sales Revenue [tons]'],
+        name=Derivative_Short + ' purchases <br>using sales revenue [tons]',
+        error_y=dict(
+            type='data',
+            array=results["Hydrogen Purchases STD [tons]"],
+            visible=True)
+        ),
+        )
+
+    # Update layout to stack bars
+    fig1.update_layout(
+        title="Traded " + Derivative_Short + " [tons]",
+        barmode='stack',  # Stack bars
+        xaxis_title='Year',
+        yaxis_title="Purchased " + Derivative_Short + " [tons]",
+    )
+    return fig1
+
+
+def get_annual_funding_figure(results):
+    fig2a = px.bar(
+        results.to_dataframe(["Year", "Used Funding Volume [$]", "NOT Used Funding Volume [$]"]),
+        x='Year',
+        y=[
+            "Used Funding Volume [$]",
+            "NOT Used Funding Volume [$]",
+            ],
+        title="Annual Funding Usage",
+        labels={ # replaces default labels by column name
+                "value": "Annual funding [US$]",
+            },
+        color_discrete_map={'Used Funding Volume [$]': 'rgb(204, 85, 0)', 'NOT Used Funding Volume [$]': 'rgb(255, 165, 0)'}
+        )
+
+    fig2a.update_traces(
+        name='Funding spent [US$]',
+        selector=dict(name='Used Funding Volume [$]')
+    )
+
+    #NOT Used Funding Volume --> Remaining funding
+    fig2a.update_traces(
+        name='Funding remaining [US$]',
+        selector=dict(name='NOT Used Funding Volume [$]')
+    )
+    return fig2a
+
+
+def get_total_funding_figure(results):
+    fig2b = px.bar(
+        results.to_dataframe(["Year", "Total Used Funding Volume [$]", "Total NOT Used Funding Volume [$]"]),
+        x='Year',
+        y=[
+            "Total Used Funding Volume [$]",
+            "Total NOT Used Funding Volume [$]",
+            ],
+        title="Total Funding Usage",
+        labels={ # replaces default labels by column name
+                "value": "Total funding volume [US$]",
+            },
+        color_discrete_map={"Total Used Funding Volume [$]": 'rgb(204, 85, 0)', "Total NOT Used Funding Volume [$]": 'rgb(255, 165, 0)'}
+        )
+
+    fig2b.update_traces(
+        name='Total funding spent [US$]',
+        selector=dict(name='Total Used Funding Volume [$]')
+    )
+
+    fig2b.update_traces(
+        name='Total funding remaining [US$]',
+        selector=dict(name='Total NOT Used Funding Volume [$]')
+    )
+    return fig2b
+
+
+def get_mitigated_co2_figure(results):
+    fig3 = px.scatter(
+        results.to_dataframe(["Year", "Mitigated CO2-emissions [tons]"]),
+        x='Year',
+        y='Mitigated CO2-emissions [tons]',
+        title="Mitigated CO2-emissions* [tons]"
+        )
+    fig3.update_traces(mode='lines+markers', line_shape='linear', marker_color='green')
+    fig3.update_layout(width=600, height=500, yaxis=dict(range=[0, 1.1*max(results['Mitigated CO2-emissions [tons]'])]))
+    return fig3
+
+
+def get_electrolyzer_capacity_figure(results):
+    fig4 = px.scatter(
+        results.to_dataframe(["Year", "Required installed electrolyzer capacity [GW]"]),
+        x='Year',
+        y='Required installed electrolyzer capacity [GW]',
+        title="Required Installed Electrolyzer Capacity for Green Hydrogen Production [GW]"
+        )
+    fig4.update_traces(mode='lines+markers', line_shape='linear', marker_color='green')
+    fig4.update_layout(width=600, height=500, yaxis=dict(range=[0, 1.1*max(results['Required installed electrolyzer capacity [GW]'])]))
+    return fig4
+
+
+def get_fiscal_npv_figure(results):
+    import pandas as pd
+
+    # Total depreciated cashflows for each category, discounted in one step by the fiscal engine
+    FISCAL_RESULTS = results.FISCAL_RESULTS
+    FISCAL_CASHFLOWS_TOTAL_DEPRECIATED = dict(zip(FISCAL_RESULTS["CATEGORIES"], FISCAL_RESULTS["PRESENT_VALUES"]))
+
+    # Prepare data for Plotly as a single stacked bar
+    data = [{'Category': category, 'Total Depreciated Cashflow': value}
+            for category, value in FISCAL_CASHFLOWS_TOTAL_DEPRECIATED.items()]
+
+    # Create a DataFrame for visualization
+    df = pd.DataFrame(data)
+
+    # Add a dummy column for y-axis to create a single stacked bar
+    df['Stacked Bar'] = 'Total Depreciated Cashflow'
+
+    # Create a single stacked bar chart
+    fig5 = px.bar(
+        df,
+        x="Stacked Bar",  # Single stacked bar label
+        y="Total Depreciated Cashflow",
+        color="Category",
+        labels={'Total Depreciated Cashflow': 'Total Depreciated Cashflow [US$]', 'Stacked Bar': ''},
+        title="Total Depreciated Cashflow for All Categories [US$]",
+    )
+
+    # Customize the chart
+    fig5.update_layout(
+        xaxis=dict(showticklabels=False),  # Hide x-axis tick label
+        yaxis=dict(
+            title="Total Depreciated Cashflow [US$]",
+            zeroline=True,          # Show a zero line on the y-axis
+            zerolinecolor="black",   # Set the color of the zero line
+            zerolinewidth=1.5        # Set the thickness of the zero line
+        ),
+        showlegend=True  # Show legend for categories
+    )
+    return fig5
+
+
+def get_fiscal_npv_distribution_figure(results):
+    FISCAL_DISTRIBUTION = get_fiscal_distribution(results)
+
+    fig5b = px.histogram(
+        x=FISCAL_DISTRIBUTION["NPV"] * 1e-6,
+        nbins=50,
+        title="Distribution of the Net-Present Value over Simulated Sales Prices [Million US$]",
+        labels={"x": "Net-present value [Million US$]"},
+        )
+    fig5b.update_layout(yaxis_title="Number of simulated paths", showlegend=False)
+    return fig5b
+
+
+def get_fiscal_cashflows_figure(results):
+    import pandas as pd
+
+    FISCAL_RESULTS = results.FISCAL_RESULTS
+
+    # Combine fiscal and loan cashflows into a DataFrame for each year
+    years = list(range(1, results.scenario.DEPRECIATION_PERIOD + 1))  # Define years as labels
+    data = {"Year": years}
+
+    # Add fiscal cashflows to data dictionary
+    for key, values in zip(FISCAL_RESULTS["CATEGORIES"], FISCAL_RESULTS["CASHFLOWS"]):
+        if key == "FISCAL_EXPENSES":
+            continue
+        else:
+            data[key] = values
+
+    # Add loan cashflows to data dictionary
+    for key, values in FISCAL_RESULTS["LOAN_CASHFLOWS_DICT"].items():
+        data[key] = values
+
+    # Convert data dictionary to a DataFrame
+    df = pd.DataFrame(data)
+
+    # Melt DataFrame for Plotly to create stacked bars
+    df_melted = df.melt(id_vars=["Year"], var_name="Category", value_name="Cashflow")
+
+    # Create a stacked bar chart in Plotly
+    fig6 = px.bar(
+        df_melted,
+        x="Year",
+        y="Cashflow",
+        color="Category",
+        title="Yearly Cashflows by Category [US$]",
+        labels={"Cashflow": "Cashflow [US$]", "Year": "Year"},
+    )
+
+    # Customize the chart
+    fig6.update_layout(
+        yaxis=dict(title="Cashflow [US$]", zeroline=True, zerolinecolor="black", zerolinewidth=1.5),
+        showlegend=True
+    )
+    return fig6
+
+
+#Metric --> (figure function, figure depends on the fiscal model)
+METRICS = {
+    "VIS_0" : (get_traded_usd_figure, False),
+    "VIS_1" : (get_traded_tons_figure, False),
+    "VIS_2_A" : (get_annual_funding_figure, False),
+    "VIS_2_B" : (get_total_funding_figure, False),
+    "VIS_3" : (get_mitigated_co2_figure, False),
+    "VIS_4" : (get_electrolyzer_capacity_figure, False),
+    "VIS_5" : (get_fiscal_npv_figure, True),
+    "VIS_5_DISTRIBUTION" : (get_fiscal_npv_distribution_figure, True),
+    "VIS_6" : (get_fiscal_cashflows_figure, True),
+    }
+
+
+def get_figure_key(scenario, metric):
+    """
+    Returns the cache key of a figure: the key of its upstream pipeline stage
+    (see utils.pipeline) and the metric. Figures of the mechanism only depend
+    on the annual columns, so they are kept when fiscal parameters change.
+    """
+    return get_stage_keys(scenario)["fiscal" if METRICS[metric][1] else "columns"] + ":" + metric
+
+
+def get_figure_json(results, metric, cache=FIGURE_CACHE):
+    """
+    Returns the serialized plotly figure of a metric. The figure is only
+    built, if it is not cached yet.
+    """
+    key = get_figure_key(results.scenario, metric)
+    FIGURE_JSON = cache.get(key)
+    if FIGURE_JSON is None:
+        with measure_stage("figure_build:" + metric):
+            FIGURE_JSON = cache.put(key, METRICS[metric][0](results).to_json())
+    return FIGURE_JSON
+
+
+def put_figure_jsons(scenario, FIGURE_JSONS, cache=FIGURE_CACHE):
+    """
+    Adds serialized figures of scenario by metric to the cache, e.g. figures
+    of the precomputed scenario atlas (see utils.scenario_atlas).
+    """
+    for metric, FIGURE_JSON in FIGURE_JSONS.items():
+        key = get_figure_key(scenario, metric)
+        if key not in cache:
+            cache.put(key, FIGURE_JSON)
+
+
+def get_figure(results, metric, cache=FIGURE_CACHE):
+    """
+    Returns the figure of a metric as dictionary, which can be passed on to
+    st.plotly_chart.
+    """
+    FIGURE_JSON = get_figure_json(results, metric, cache=cache)
+    with measure_stage("figure_decode"):
+        return json.loads(FIGURE_JSON)
+
+
+def get_sensitivity_analysis(scenario, RELATIVE_CHANGE, cache=FIGURE_CACHE):
+    """
+    Returns the one-at-a-time sensitivity analysis of a scenario, see
+    utils.sensitivity.run_sensitivity_analysis.
+    """
+    from utils.sensitivity import run_sensitivity_analysis
+
+    key = scenario.get_hash() + ":SENSITIVITY:" + repr(float(RELATIVE_CHANGE))
+    SENSITIVITY = cache.get(key)
+    if SENSITIVITY is None:
+        SENSITIVITY = cache.put(key, run_sensitivity_analysis(scenario, RELATIVE_CHANGE))
+    return SENSITIVITY
+
+
+def get_tornado_figure(SENSITIVITY, METRIC, title, unit, scale=1.0):
+    """
+    Returns a tornado chart of the change of METRIC ("FISCAL_NPV" or
+    "TOTAL_PURCHASES_TONS") against the baseline, for the decreased and the
+    increased value of each parameter. The largest swing is shown on top.
+    """
+    BASELINE = SENSITIVITY["BASELINE"][METRIC]
+    CHANGES = (SENSITIVITY[METRIC] - BASELINE) * scale
+    ORDER = np.argsort(np.nan_to_num(np.abs(CHANGES[:, 1] - CHANGES[:, 0])))
+    PARAMETERS = [SENSITIVITY["PARAMETERS"][i] for i in ORDER]
+    VALUES = SENSITIVITY["VALUES"][ORDER]
+
+    fig = go.Figure()
+    for column, name in ((0, "Parameter decreased"), (1, "Parameter increased")):
+        fig.add_trace(go.Bar(
+            y=PARAMETERS,
+            x=CHANGES[ORDER, column],
+            orientation='h',
+            name=name,
+            customdata=VALUES[:, column],
+            hovertemplate="%{y} = %{customdata:.4g}<br>Change: %{x:.4g} " + unit + "<extra></extra>",
+            ))
+
+    fig.update_layout(
+        title=title,
+        barmode='overlay',
+        xaxis=dict(title="Change compared to baseline [" + unit + "]", zeroline=True, zerolinecolor="black", zerolinewidth=1.5),
+        height=max(400, 25*len(PARAMETERS)),
+        )
+    return fig
+
+
+def get_carrier_comparison_figure(COMPARISON, column, title):
+    """
+    Returns a chart of an annual column, e.g. "Hydrogen Purchases [tons]",
+    with one line per carrier of a comparison (see utils.carrier_comparison).
+    """
+    fig = go.Figure()
+    for carrier, results in zip(COMPARISON["CARRIERS"], COMPARISON["RESULTS"]):
+        fig.add_trace(go.Scatter(
+            x=results["Year"],
+            y=results[column],
+            mode='lines+markers',
+            name=DICT_CARRIER_SHORT[carrier],
+            ))
+    fig.update_layout(title=title, xaxis=dict(title="Year"), yaxis=dict(title=column, rangemode="tozero"), width=600, height=500)
+    return fig
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+Compute core of the H2Global mechanism app.
+
+A Scenario holds all inputs of the app, evaluate_scenario() simulates the
+mechanism and the fiscal model and returns a ScenarioResults object.
+This module only depends on numpy and pymechanism, so it can be imported
+by worker processes and batch tools without Streamlit or plotly.
+"""
+
+import dataclasses
+
+import numpy as np
+
+from utils.simulation_cache import get_mechanism_attr, get_parameter_hash, get_scenario_hash
+from utils.carriers import CARRIER_INDEX, DOWNSTREAM_CHAINS, get_carrier_column
+from utils.fiscal_engine import get_fiscal_cashflows, get_fiscal_npv_distribution, get_fiscal_revenues, get_share_hpa_contract
+from utils.loans import compare_loan_profiles
+from utils.instrumentation import measure_stage
+from utils.pipeline import COLUMN_CACHE, FISCAL_CACHE, get_stage_keys
+from utils.price_paths import get_price_path, get_price_path_inputs, get_price_path_spec, is_stochastic_price_path, parse_price_path_spec
+
+#Carrier constants, see utils.carriers
+#____Short names of the carriers for labels
+DICT_CARRIER_SHORT = get_carrier_column("SHORT")
+
+#____Efficiency from renewable electricity to carrier
+DICT_EFFICIENCY_FACTORS = get_carrier_column("EFFICIENCY")
+
+#____Lower heating values
+DICT_LHV = get_carrier_column("LHV")
+
+#____Reduced CO2-emissions compared to the grey product [kg_CO2/kg]
+DICT_EMISSION_REDUCTION = get_carrier_column("EMISSION_REDUCTION")
+
+#____Operational full load hours of the electrolyzer
+FULL_LOAD_HOURS = 4000
+
+#____Default prices of the app: purchase price start/end, sales price start/end [US$/kg]
+DICT_PRICE_DEFAULTS = get_carrier_column("PRICE_DEFAULTS")
+
+#____Parameters of the domestic downstream chain of the fiscal model of each carrier
+DICT_DOWNSTREAM_PARAMETERS = {
+    carrier: DOWNSTREAM_CHAINS[chain]["PARAMETERS"]
+    for carrier, chain in get_carrier_column("DOWNSTREAM").items() if chain is not None
+    }
+
+
+def get_price_defaults(carrier):
+    """
+    Returns the default purchase price start/end and sales price start/end of
+    a carrier, or of hydrogen, if no carrier is selected.
+    """
+    return DICT_PRICE_DEFAULTS.get(carrier, DICT_PRICE_DEFAULTS["Hydrogen"])
+
+
+@dataclasses.dataclass(frozen=True)
+class Scenario():
+
+    """
+    All input parameters of one evaluation. Defaults equal the defaults of the
+    app, percentages of the app are given as shares.
+    """
+
+    #Mechanism
+    CARRIER: str = "Hydrogen"
+    SUBSIDY_VOLUME: float = 1e9 #US$
+    PERIOD: int = 10 #years
+    PURCHASE_PRICE_START: float = 6.0 #US$/kg
+    PURCHASE_PRICE_END: float = 6.0 #US$/kg
+    SALES_PRICE_START: float = 3.0 #US$/kg
+    SALES_PRICE_END: float = 4.5 #US$/kg
+    PURCHASE_PRICE: tuple = None #Optional annual price path, overrides start and end [US$/kg]
+    SALES_PRICE: tuple = None #Optional annual price path, overrides start and end [US$/kg]
+    PURCHASE_PRICE_PATH: str = None #Optional generator of the price path as JSON, see utils.price_paths
+    SALES_PRICE_PATH: str = None #Optional generator of the price path as JSON, see utils.price_paths
+    SALES_PRICE_VOLATILITY: float = 0.0
+    NUMBER_PATHS: int = 1000 #Number of simulated paths
+    RATIO_LONGTERM_HSA: float = 0.0
+    FLOOR_PRICE_HSA: float = 4.0 #US$/kg
+    BID_CAP_HSA: float = 4.0 #US$/kg
+    REINVEST_CYCLES: int = 2
+    RATIO_GUARANTEED_SHORTTERM_HSA: float = 0.0
+    #Fiscal model
+    DEPRECIATION_PERIOD: int = 25 #years
+    GRACE_PERIOD: int = 8 #years
+    LOAN_PROFILE: str = "straight_line" #Repayment profile of the loan, see utils.loans
+    WACC: float = 0.025
+    INFLATION: float = 0.03
+    CORPORATE_TAX_RATE: float = 0.35
+    VAT_RATE: float = 0.19
+    VAT_INVEST_BOOL: bool = False
+    VAT_HPA_BOOL: bool = False
+    VAT_HSA_BOOL: bool = False
+    VAT_HYDROGEN_PRODUCT_BOOL: bool = False
+    VAT_DRI_BOOL: bool = False
+    VAT_FERTILIZER_BOOL: bool = False
+    IMPORT_DUTIES_RATE: float = 0.0
+    SHARE_IMPORTED_PRODUCTION_EQUIPMENT: float = 0.9
+    SHARE_HPA_CONTRACT: float = 0.2
+    RAMP_UP: int = 3 #years
+    SHARE_TAXABLE_INCOME: float = 0.5
+    SHARE_DOMESTIC_SALES: float = 0.5
+    SHARE_H2_DRI_DOMESTIC: float = 0.5
+    DRI_SALES_PRICE: float = 0.3 #US$/kg
+    DRI_PER_KG_H2: float = 20
+    SHARE_DOMESTIC_SALES_DRI: float = 1.0
+    SHARE_NH3_FERTILIZER_DOMESTIC: float = 0.5
+    FERTILIZER_SALES_PRICE: float = 0.5 #US$/kg
+    FERTILIZER_PER_KG_NH3: float = 2.0
+    SHARE_DOMESTIC_SALES_FERTILIZER: float = 1.0
+
+    def __post_init__(self):
+        #Price paths are stored as tuples, so that scenarios stay hashable.
+        for name in ("PURCHASE_PRICE", "SALES_PRICE"):
+            value = getattr(self, name)
+            if value is not None:
+                object.__setattr__(self, name, tuple(float(v) for v in np.ravel(value)))
+        #Price path generators are stored as canonical JSON, so that equal paths have equal hashes.
+        for name in ("PURCHASE_PRICE_PATH", "SALES_PRICE_PATH"):
+            value = getattr(self, name)
+            if value is not None:
+                object.__setattr__(self, name, get_price_path_spec(**parse_price_path_spec(value)))
+        if self.CARRIER not in CARRIER_INDEX:
+            raise ValueError("No such carrier defined.")
+
+    def replace(self, **kwargs):
+        return dataclasses.replace(self, **kwargs)
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def get_price_arrays(self):
+        """
+        Returns the annual purchase and sales price arrays, with shape
+        (year, path) for stochastic price paths.
+        """
+        if self.PURCHASE_PRICE is not None:
+            purchase_price_array = np.array(self.PURCHASE_PRICE)
+        elif self.PURCHASE_PRICE_PATH is not None:
+            purchase_price_array = get_price_path(self.PURCHASE_PRICE_PATH, self.PERIOD, self.NUMBER_PATHS)
+        else:
+            purchase_price_array = np.linspace(self.PURCHASE_PRICE_START, self.PURCHASE_PRICE_END, self.PERIOD)
+        if self.SALES_PRICE is not None:
+            sales_price_array = np.array(self.SALES_PRICE)
+        elif self.SALES_PRICE_PATH is not None:
+            sales_price_array = get_price_path(self.SALES_PRICE_PATH, self.PERIOD, self.NUMBER_PATHS)
+        else:
+            sales_price_array = np.linspace(self.SALES_PRICE_START, self.SALES_PRICE_END, self.PERIOD)
+        return purchase_price_array, sales_price_array
+
+    def validate(self):
+        purchase_price_array, sales_price_array = self.get_price_arrays()
+        if np.any(sales_price_array[-1] >= purchase_price_array[-1]) and (self.RATIO_GUARANTEED_SHORTTERM_HSA > 0 or self.REINVEST_CYCLES == -1):
+            raise ValueError("Definition of input parameters leads to infinite energy purchases. Consider a sales price below the purchase price.")
+        if not 0 <= self.GRACE_PERIOD < self.DEPRECIATION_PERIOD:
+            raise ValueError("The grace period of the loan must be shorter than the depreciation period.")
+
+    def get_mechanism_inputs(self):
+        """
+        Returns the keyword arguments of pm.Mechanism.
+        """
+        purchase_price_array, sales_price_array = self.get_price_arrays()
+        MECHANISM_INPUTS = dict(
+            purchase_price=purchase_price_array,
+            sales_price=sales_price_array,
+            subsidy_period=self.PERIOD,
+            subsidy_volume=self.SUBSIDY_VOLUME,
+            NUMBER_SCENARIOS=self.NUMBER_PATHS,
+            RATIO_LONGTERM_HSA=self.RATIO_LONGTERM_HSA,
+            FLOOR_PRICE_HSA=self.FLOOR_PRICE_HSA,
+            BID_CAP_HSA=self.BID_CAP_HSA,
+            REINVEST_CYCLES=self.REINVEST_CYCLES,
+            RATIO_GUARANTEED_SHORTTERM_HSA=self.RATIO_GUARANTEED_SHORTTERM_HSA,
+            VOLATILITY=self.SALES_PRICE_VOLATILITY
+            )
+        return get_price_path_inputs(MECHANISM_INPUTS)
+
+    def is_stochastic(self):
+        """
+        Returns True, if the simulated paths differ, i.e. for a volatile sales
+        price or stochastic price paths.
+        """
+        return (
+            self.SALES_PRICE_VOLATILITY > 0
+            or is_stochastic_price_path(self.PURCHASE_PRICE_PATH)
+            or is_stochastic_price_path(self.SALES_PRICE_PATH)
+            )
+
+    def get_mechanism_hash(self):
+        return get_scenario_hash(**self.get_mechanism_inputs())
+
+    def get_fiscal_parameters(self):
+        """
+        Returns the scalar parameters of the fiscal model.
+        """
+        return dict(
+            PRODUCT_TYPE=self.CARRIER,
+            TOTAL_LOAN=self.SUBSIDY_VOLUME,
+            DEPRECIATION_PERIOD=self.DEPRECIATION_PERIOD,
+            GRACE_PERIOD=self.GRACE_PERIOD,
+            LOAN_PROFILE=self.LOAN_PROFILE,
+            CONTRACT_PERIOD_HPA=self.PERIOD,
+            WACC=self.WACC,
+            INFLATION=self.INFLATION,
+            CORPORATE_TAX_RATE=self.CORPORATE_TAX_RATE,
+            SHARE_HPA_CONTRACT=get_share_hpa_contract(self.SHARE_HPA_CONTRACT, self.RAMP_UP, self.DEPRECIATION_PERIOD),
+            SHARE_TAXABLE_INCOME=self.SHARE_TAXABLE_INCOME,
+            SHARE_DOMESTIC_SALES=self.SHARE_DOMESTIC_SALES,
+            SHARE_IMPORTED_PRODUCTION_EQUIPMENT=self.SHARE_IMPORTED_PRODUCTION_EQUIPMENT,
+            SHARE_H2_DRI_DOMESTIC=self.SHARE_H2_DRI_DOMESTIC,
+            DRI_SALES_PRICE=self.DRI_SALES_PRICE,
+            DRI_PER_KG_H2=self.DRI_PER_KG_H2,
+            SHARE_DOMESTIC_SALES_DRI=self.SHARE_DOMESTIC_SALES_DRI,
+            SHARE_NH3_FERTILIZER_DOMESTIC=self.SHARE_NH3_FERTILIZER_DOMESTIC,
+            FERTILIZER_SALES_PRICE=self.FERTILIZER_SALES_PRICE,
+            FERTILIZER_PER_KG_NH3=self.FERTILIZER_PER_KG_NH3,
+            SHARE_DOMESTIC_SALES_FERTILIZER=self.SHARE_DOMESTIC_SALES_FERTILIZER,
+            IMPORT_DUTIES_RATE=self.IMPORT_DUTIES_RATE,
+            VAT_RATE=self.VAT_RATE,
+            VAT_INVEST_BOOL=self.VAT_INVEST_BOOL,
+            VAT_HPA_BOOL=self.VAT_HPA_BOOL,
+            VAT_HSA_BOOL=self.VAT_HSA_BOOL,
+            VAT_HYDROGEN_PRODUCT_BOOL=self.VAT_HYDROGEN_PRODUCT_BOOL,
+            VAT_DRI_BOOL=self.VAT_DRI_BOOL,
+            VAT_FERTILIZER_BOOL=self.VAT_FERTILIZER_BOOL,
+            )
+
+    def get_fiscal_hash(self):
+        return get_parameter_hash(**self.get_fiscal_parameters())
+
+    def get_hash(self):
+        """
+        Returns a hex digest over all parameters of the scenario.
+        """
+        return get_parameter_hash(**self.to_dict())
+
+    def get_result_hash(self):
+        """
+        Returns a hex digest over all parameters, which affect the results:
+        downstream parameters of other carriers are not included.
+        """
+        PARAMETERS = self.to_dict()
+        for carrier, DOWNSTREAM_PARAMETERS in DICT_DOWNSTREAM_PARAMETERS.items():
+            if carrier != self.CARRIER:
+                for name in DOWNSTREAM_PARAMETERS:
+                    del PARAMETERS[name]
+        return get_parameter_hash(**PARAMETERS)
+
+
+#Default input parameters as dictionary
+DEFAULT_SCENARIO = Scenario().to_dict()
+
+
+#Annual results, derived lazily from ATTR and from each other.
+#____Each column is a function of the results object, which may request further columns.
+#____The order of the entries is the column order of data_to_plot.
+#____Means are accumulated in float64, also for per-path arrays in single precision (see utils.simulation_cache).
+def _mean(key):
+    return lambda results: results.ATTR[key].mean(axis=1, dtype=np.float64)
+
+def _std(key):
+    return lambda results: results.ATTR[key].std(axis=1, dtype=np.float64)
+
+ANNUAL_COLUMNS = {
+    "Hydrogen Purchases [kg]": _mean("Yearly_Product_Purchases"),
+    "Hydrogen Purchases STD [kg]": _std("Yearly_Product_Purchases"),
+    "Hydrogen Purchases from Funding [$]": _mean("Yearly_Purchases_LONG"),
+    "Hydrogen Purchases from Funding STD [$]": _std("Yearly_Purchases_LONG"),
+    "Hydrogen Purchases from Sales Revenue [$]": _mean("Yearly_Purchases_SHORT"),
+    "Hydrogen Purchases from Sales Revenue STD [$]": _std("Yearly_Purchases_SHORT"),
+    "Used Funding Volume [$]": _mean("Yearly_Used_Funding"),
+    "Used Funding Volume STD [$]": _std("Yearly_Used_Funding"),
+    "Annual Sales [$]" : _mean("Yearly_Sales"),
+    "Annual Sales STD [$]" : _std("Yearly_Sales"),
+    "Year": lambda r: np.arange(1, r.scenario.PERIOD+1),
+    #Derive purchased hydrogen quantities in kg and tons
+    "Hydrogen Purchases [$]": lambda r: r["Hydrogen Purchases from Funding [$]"] + r["Hydrogen Purchases from Sales Revenue [$]"],
+    "Hydrogen Purchases STD [$]": lambda r: r["Hydrogen Purchases from Funding STD [$]"] + r["Hydrogen Purchases from Sales Revenue STD [$]"],
+    "Hydrogen Purchases [tons]": lambda r: r["Hydrogen Purchases [kg]"] / 1000,
+    "Hydrogen Purchases STD [tons]": lambda r: r["Hydrogen Purchases STD [kg]"] / 1000,
+    "Hydrogen Purchases from Funding [kg]": _mean("Yearly_Product_Purchases_LONG"),
+    "Hydrogen Purchases from Funding [tons]": lambda r: r["Hydrogen Purchases from Funding [kg]"] / 1000,
+    "Hydrogen Purchases from Sales Revenue [kg]": lambda r: r["Hydrogen Purchases [kg]"] - r["Hydrogen Purchases from Funding [kg]"],
+    "Hydrogen Purchases from Sales Revenue [tons]": lambda r: r["Hydrogen Purchases from Sales Revenue [kg]"] / 1000,
+    "NOT Used Funding Volume [$]": lambda r: r.scenario.SUBSIDY_VOLUME/r.scenario.PERIOD - r["Used Funding Volume [$]"],
+    "Total Used Funding Volume [$]": lambda r: r["Used Funding Volume [$]"].cumsum(),
+    "Total NOT Used Funding Volume [$]": lambda r: r.scenario.SUBSIDY_VOLUME - r["Total Used Funding Volume [$]"],
+    # H2 [GWh] = Installed capacity [GW] * FLH [h/a] * efficiency
+    # --> Installed capacity [GW] = H2 [GWh] / (FLH [h/a] * efficiency)
+    "Required installed electrolyzer capacity [GW]": lambda r: r["Hydrogen Purchases [tons]"]*1e+3*DICT_LHV[r.scenario.CARRIER]*1e-6 / (FULL_LOAD_HOURS*DICT_EFFICIENCY_FACTORS[r.scenario.CARRIER]),
+    "Mitigated CO2-emissions [tons]": lambda r: r["Hydrogen Purchases [tons]"]*DICT_EMISSION_REDUCTION[r.scenario.CARRIER],
+    }
+
+
+class ScenarioResults():
+
+    """
+    Results of one scenario. The mechanism is simulated on first access of
+    ATTR (unless ATTR is given), the fiscal model on first access of
+    FISCAL_RESULTS. Annual results are computed on access by column name,
+    e.g. results["Year"], see ANNUAL_COLUMNS, and kept for further use.
+
+    With memoize, annual columns and the fiscal model are shared across
+    instances by the keys of their pipeline stages, see utils.pipeline.
+    By default, only results of simulated or cached mechanisms are memoized;
+    a given ATTR may be partial or approximate (e.g. of a running job or a
+    surrogate), so it has to be memoized explicitly.
+    """
+
+    #Results are created on each run of the page, so instances carry no __dict__.
+    __slots__ = ("scenario", "store", "memoize", "_ATTR", "_FISCAL_RESULTS", "_columns", "_STAGE_KEYS")
+
+    def __init__(self, scenario, store=None, ATTR=None, memoize=None):
+        self.scenario = scenario
+        self.store = store
+        self._ATTR = ATTR
+        self._FISCAL_RESULTS = None
+        self._columns = {}
+        self.memoize = ATTR is None if memoize is None else memoize
+        self._STAGE_KEYS = None
+
+    @property
+    def ATTR(self):
+        if self._ATTR is None:
+            self._ATTR = get_mechanism_attr(
+                store=self.store,
+                carrier=self.scenario.CARRIER,
+                **self.scenario.get_mechanism_inputs()
+                )
+        return self._ATTR
+
+    def get_stage_key(self, stage):
+        if self._STAGE_KEYS is None:
+            self._STAGE_KEYS = get_stage_keys(self.scenario)
+        return self._STAGE_KEYS[stage]
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if self.memoize:
+                key = self.get_stage_key("columns") + ":" + name
+                COLUMN = COLUMN_CACHE.get(key)
+                if COLUMN is None:
+                    COLUMN = COLUMN_CACHE.put(key, {"VALUE": ANNUAL_COLUMNS[name](self)})
+                self._columns[name] = COLUMN["VALUE"]
+            else:
+                self._columns[name] = ANNUAL_COLUMNS[name](self)
+        return self._columns[name]
+
+    @property
+    def COLUMNS(self):
+        return {name: self[name] for name in ANNUAL_COLUMNS}
+
+    @property
+    def FISCAL_RESULTS(self):
+        if self._FISCAL_RESULTS is None and self.memoize:
+            key = self.get_stage_key("fiscal")
+            self._FISCAL_RESULTS = FISCAL_CACHE.get(key)
+            if self._FISCAL_RESULTS is None:
+                self._FISCAL_RESULTS = FISCAL_CACHE.put(key, self._evaluate_fiscal())
+        elif self._FISCAL_RESULTS is None:
+            self._FISCAL_RESULTS = self._evaluate_fiscal()
+        return self._FISCAL_RESULTS
+
+    def _evaluate_fiscal(self):
+        FISCAL_PARAMETERS = self.scenario.get_fiscal_parameters()
+        FISCAL_RESULTS = get_fiscal_cashflows(
+            ANNUAL_PRODUCTION=self["Hydrogen Purchases [kg]"], #kg
+            ANNUAL_PRODUCT_PURCHASES=self["Hydrogen Purchases [$]"], #USD
+            ANNUAL_PRODUCT_SALES=self["Annual Sales [$]"], #USD
+            ANNUAL_FUNDING=self["Used Funding Volume [$]"], #USD
+            **FISCAL_PARAMETERS
+            )
+
+        if self.store is not None:
+            self.store.write_fiscal(
+                carrier=self.scenario.CARRIER,
+                scenario_hash=self.scenario.get_mechanism_hash(),
+                fiscal_hash=get_parameter_hash(**FISCAL_PARAMETERS),
+                FISCAL_DICTS={
+                    "FISCAL_CASHFLOWS": dict(zip(FISCAL_RESULTS["CATEGORIES"], FISCAL_RESULTS["CASHFLOWS"])),
+                    "LOAN_CASHFLOWS": FISCAL_RESULTS["LOAN_CASHFLOWS_DICT"],
+                    "SALES_REVENUES": FISCAL_RESULTS["SALES_REVENUES_DICT"],
+                    },
+                FISCAL_METADATA={"NPV": FISCAL_RESULTS["NPV"]},
+                )
+        return FISCAL_RESULTS
+
+    @property
+    def TOTAL_PURCHASES_USD(self):
+        return self["Hydrogen Purchases [$]"].sum()
+
+    @property
+    def TOTAL_PURCHASES_TONS(self):
+        return self["Hydrogen Purchases [tons]"].sum()
+
+    @property
+    def TOTAL_USED_FUNDING_USD(self):
+        return self["Used Funding Volume [$]"].sum()
+
+    @property
+    def TOTAL_NOT_USED_FUNDING_USD(self):
+        return self["NOT Used Funding Volume [$]"].sum()
+
+    @property
+    def TOTAL_MITIGATED_CO2_TONS(self):
+        return self["Mitigated CO2-emissions [tons]"].sum()
+
+    @property
+    def MAX_ELECTROLYZER_GW(self):
+        return self["Required installed electrolyzer capacity [GW]"].max()
+
+    @property
+    def FISCAL_NPV(self):
+        return self.FISCAL_RESULTS["NPV"]
+
+    def get_fiscal_distribution(self, **kwargs):
+        """
+        Returns the path-wise NPV distribution of the fiscal model,
+        see fiscal_engine.get_fiscal_npv_distribution.
+        """
+        return get_fiscal_npv_distribution(
+            ATTR=self.ATTR,
+            **self.scenario.get_fiscal_parameters(),
+            **kwargs
+            )
+
+    def get_loan_comparison(self):
+        """
+        Returns the loan of the scenario with each repayment profile, see
+        loans.compare_loan_profiles. Sculpted repayments follow the fiscal
+        revenues and are only compared, if there are revenues to repay from.
+        """
+        scenario = self.scenario
+        REVENUES = get_fiscal_revenues(self.FISCAL_RESULTS["CASHFLOWS"])
+        return compare_loan_profiles(
+            PRINCIPAL=scenario.SUBSIDY_VOLUME,
+            RATE=scenario.WACC,
+            TERM=scenario.DEPRECIATION_PERIOD,
+            GRACE_PERIOD=scenario.GRACE_PERIOD,
+            CASHFLOWS=REVENUES if np.clip(REVENUES[scenario.GRACE_PERIOD:], 0, None).sum() > 0 else None,
+            )
+
+    def to_dataframe(self, columns=None):
+        """
+        Returns the annual results as pandas.DataFrame (data_to_plot), with
+        all columns or only the given ones. pandas is only imported here, at
+        the boundary to charts and exports.
+        """
+        import pandas as pd
+        with measure_stage("data_to_plot"):
+            return pd.DataFrame({name: self[name] for name in (columns or ANNUAL_COLUMNS)})
+
+
+def evaluate_scenario(scenario, fiscal=True, store=None):
+    """
+    Simulates the mechanism and, if fiscal is True, the fiscal model for one
+    scenario. Mechanism results are cached across calls. With a result store
+    (see utils.result_store), results are also read from and written to disk.
+    """
+
+    scenario.validate()
+    results = ScenarioResults(scenario, store=store)
+    results.ATTR #simulates the mechanism
+    if fiscal:
+        results.FISCAL_RESULTS #evaluates the fiscal model
+    return results
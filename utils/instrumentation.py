@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the stages of the H2Global mechanism app.
+
+Stages (simulation, fiscal model, figures, ...) are measured with
+measure_stage(), which records the wall time and, if memory tracing is
+enabled, the tracemalloc peak of the stage. All stages which run within a
+request_scope() (e.g. one run of the evaluation page) are collected into one
+request record, which is written as JSON line to the logger of this module.
+
+Aggregated metrics of all stages and the hit/miss counters of the registered
+caches are available as Prometheus text (get_prometheus_text), optionally
+served on http://localhost:<H2G_METRICS_PORT>/metrics for a local scraper.
+
+This module only depends on the standard library.
+"""
+
+import bisect
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#Environment variables, which configure the instrumentation
+METRICS_PORT_ENV = "H2G_METRICS_PORT" #Port of the Prometheus text endpoint
+METRICS_LOG_ENV = "H2G_METRICS_LOG" #File for the JSON lines of the request records
+TRACE_MEMORY_ENV = "H2G_TRACE_MEMORY" #Enables tracemalloc at import
+
+#Upper bounds of the histogram buckets of stage and request durations [s]
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#Number of request records, which are kept in memory
+RECENT_REQUESTS_MAX = 100
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _Histogram():
+
+    """
+    Cumulative histogram of durations with Prometheus bucket semantics.
+    """
+
+    def __init__(self):
+        self.counts = [0]*len(HISTOGRAM_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)
+        if index < len(HISTOGRAM_BUCKETS):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+
+class MetricsRegistry():
+
+    """
+    Thread-safe registry of the aggregated stage and request metrics and of
+    the caches, whose counters are exported.
+    """
+
+    def __init__(self):
+        self.stages = {} #stage --> _Histogram
+        self.requests = {} #request --> _Histogram
+        self.peak_memory = {} #stage --> maximal peak memory [bytes]
+        self.caches = {} #name --> SimulationCache
+        self.recent_requests = deque(maxlen=RECENT_REQUESTS_MAX)
+        self._lock = threading.Lock()
+
+    def observe_stage(self, stage, seconds, peak_memory=None):
+        with self._lock:
+            self.stages.setdefault(stage, _Histogram()).observe(seconds)
+            if peak_memory is not None:
+                self.peak_memory[stage] = max(self.peak_memory.get(stage, 0), peak_memory)
+
+    def observe_request(self, REQUEST):
+        with self._lock:
+            self.requests.setdefault(REQUEST["REQUEST"], _Histogram()).observe(REQUEST["SECONDS"])
+            self.recent_requests.append(REQUEST)
+
+    def register_cache(self, name, cache):
+        with self._lock:
+            self.caches[name] = cache
+
+    def get_cache_counters(self):
+        with self._lock:
+            caches = dict(self.caches)
+        return {
+            name: {"HITS": cache.hits, "MISSES": cache.misses, "ENTRIES": len(cache), "BYTES": cache.nbytes}
+            for name, cache in caches.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self.stages.clear()
+            self.requests.clear()
+            self.peak_memory.clear()
+            self.recent_requests.clear()
+
+
+#Module-level instance, shared across sessions of the Streamlit server.
+METRICS = MetricsRegistry()
+
+#Stack of the active stages and the active request of each thread
+_local = threading.local()
+
+
+def register_cache(name, cache):
+    """
+    Exports the hit/miss counters, entries and size of a SimulationCache.
+    """
+    METRICS.register_cache(name, cache)
+
+
+def set_memory_tracing(enabled=True):
+    """
+    Starts or stops tracemalloc. Tracing slows down allocations noticeably,
+    so it is only enabled for the debug panel or via H2G_TRACE_MEMORY.
+    """
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _get_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def measure_stage(stage):
+    """
+    Measures the wall time and, if tracemalloc is tracing, the peak memory of
+    the enclosed code as stage. Stages can be nested. The peak memory is
+    given relative to the allocated memory at the start of the stage; with
+    several concurrent sessions, it also contains their allocations.
+    """
+    tracing = tracemalloc.is_tracing()
+    stack = _get_stack()
+    frame = {"PEAK": 0, "START_MEMORY": 0}
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        #____The global peak is reset below, so it is handed to the enclosing stage first.
+        if stack:
+            stack[-1]["PEAK"] = max(stack[-1]["PEAK"], peak)
+        tracemalloc.reset_peak()
+        frame["START_MEMORY"] = current
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        peak_memory = None
+        if tracing and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], frame["PEAK"])
+            peak_memory = max(peak - frame["START_MEMORY"], 0)
+            if stack:
+                stack[-1]["PEAK"] = max(stack[-1]["PEAK"], peak)
+        METRICS.observe_stage(stage, seconds, peak_memory)
+        REQUEST = getattr(_local, "request", None)
+        if REQUEST is not None:
+            REQUEST["STAGES"].append({"STAGE": stage, "SECONDS": seconds, "PEAK_MEMORY_BYTES": peak_memory})
+
+
+def instrumented(stage):
+    """
+    Decorator, which measures each call of the function as stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def request_scope(name):
+    """
+    Collects all stages, which are measured by this thread within the scope,
+    into a request record. Yields the record, which is complete after the
+    scope, and writes it as one JSON line to the logger of this module:
+        "REQUEST" : Name of the request
+        "TIMESTAMP" : Start of the request [s since epoch]
+        "SECONDS" : Wall time of the request
+        "PEAK_MEMORY_BYTES" : Peak memory of the request, None without tracing
+        "STAGES" : List of the measured stages in order of completion
+        "CACHES" : Hits and misses of the registered caches during the request
+    """
+    if getattr(_local, "request", None) is not None:
+        #____Nested scopes belong to the enclosing request.
+        yield _local.request
+        return
+
+    REQUEST = {"REQUEST": name, "TIMESTAMP": time.time(), "SECONDS": None, "PEAK_MEMORY_BYTES": None, "STAGES": [], "CACHES": {}}
+    CACHES_START = METRICS.get_cache_counters()
+    _local.request = REQUEST
+    try:
+        with measure_stage("request:" + name):
+            yield REQUEST
+    finally:
+        _local.request = None
+        #____The last stage is the request itself.
+        REQUEST_STAGE = REQUEST["STAGES"].pop()
+        REQUEST["SECONDS"] = REQUEST_STAGE["SECONDS"]
+        REQUEST["PEAK_MEMORY_BYTES"] = REQUEST_STAGE["PEAK_MEMORY_BYTES"]
+        for cache, counters in METRICS.get_cache_counters().items():
+            start = CACHES_START.get(cache, {"HITS": 0, "MISSES": 0})
+            #________Counters restart at zero, if a cache is cleared.
+            REQUEST["CACHES"][cache] = {
+                "HITS": counters["HITS"] - start["HITS"] if counters["HITS"] >= start["HITS"] else counters["HITS"],
+                "MISSES": counters["MISSES"] - start["MISSES"] if counters["MISSES"] >= start["MISSES"] else counters["MISSES"],
+                }
+        METRICS.observe_request(REQUEST)
+        LOGGER.info(json.dumps(REQUEST))
+
+
+def get_recent_requests():
+    """
+    Returns the last request records of all sessions, oldest first.
+    """
+    with METRICS._lock:
+        return list(METRICS.recent_requests)
+
+
+def _format_labels(**labels):
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items()) + "}"
+
+
+def _format_histogram(lines, metric, label, histograms):
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for le, count in zip(HISTOGRAM_BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(metric + "_bucket" + _format_labels(**{label: name, "le": repr(le)}) + " " + str(cumulative))
+        lines.append(metric + "_bucket" + _format_labels(**{label: name, "le": "+Inf"}) + " " + str(histogram.count))
+        lines.append(metric + "_sum" + _format_labels(**{label: name}) + " " + repr(histogram.sum))
+        lines.append(metric + "_count" + _format_labels(**{label: name}) + " " + str(histogram.count))
+
+
+def get_prometheus_text():
+    """
+    Returns all metrics in the Prometheus text exposition format (version 0.0.4).
+    """
+    with METRICS._lock:
+        stages = {k: v for k, v in METRICS.stages.items() if not k.startswith("request:")}
+        requests = dict(METRICS.requests)
+        peak_memory = dict(METRICS.peak_memory)
+    caches = METRICS.get_cache_counters()
+
+    lines = []
+    lines.append("# HELP h2g_stage_seconds Wall time of the stages of the app.")
+    lines.append("# TYPE h2g_stage_seconds histogram")
+    _format_histogram(lines, "h2g_stage_seconds", "stage", stages)
+
+    lines.append("# HELP h2g_stage_seconds_max Maximal wall time of the stages of the app.")
+    lines.append("# TYPE h2g_stage_seconds_max gauge")
+    for stage, histogram in sorted(stages.items()):
+        lines.append("h2g_stage_seconds_max" + _format_labels(stage=stage) + " " + repr(histogram.max))
+
+    lines.append("# HELP h2g_stage_peak_memory_bytes Maximal tracemalloc peak of the stages, if memory tracing is enabled.")
+    lines.append("# TYPE h2g_stage_peak_memory_bytes gauge")
+    for stage, nbytes in sorted(peak_memory.items()):
+        lines.append("h2g_stage_peak_memory_bytes" + _format_labels(stage=stage) + " " + str(nbytes))
+
+    lines.append("# HELP h2g_request_seconds Wall time of the requests (e.g. runs of the evaluation page).")
+    lines.append("# TYPE h2g_request_seconds histogram")
+    _format_histogram(lines, "h2g_request_seconds", "request", requests)
+
+    for metric, key, kind, description in (
+            ("h2g_cache_hits_total", "HITS", "counter", "Cache hits."),
+            ("h2g_cache_misses_total", "MISSES", "counter", "Cache misses."),
+            ("h2g_cache_entries", "ENTRIES", "gauge", "Number of cached entries."),
+            ("h2g_cache_bytes", "BYTES", "gauge", "Size of the cached arrays and serialized values [bytes]."),
+            ):
+        lines.append("# HELP " + metric + " " + description)
+        lines.append("# TYPE " + metric + " " + kind)
+        for cache, counters in sorted(caches.items()):
+            lines.append(metric + _format_labels(cache=cache) + " " + str(counters[key]))
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = get_prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #Scrapes are not logged.
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=None, host="127.0.0.1"):
+    """
+    Serves get_prometheus_text() on http://<host>:<port>/metrics in a daemon
+    thread. The port defaults to H2G_METRICS_PORT; without port, no server is
+    started. The server is only started once per process and returned.
+    """
+    global _server
+    if port is None:
+        port = os.environ.get(METRICS_PORT_ENV)
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="h2g-metrics", daemon=True).start()
+    return _server
+
+
+def _configure_from_environment():
+    if os.environ.get(TRACE_MEMORY_ENV):
+        set_memory_tracing(True)
+    path = os.environ.get(METRICS_LOG_ENV)
+    if path:
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        LOGGER.addHandler(handler)
+        LOGGER.setLevel(logging.INFO)
+
+
+_configure_from_environment()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Repayment schedules of the loan, which finances the funding volume.
+
+Schedules are computed for a batch of N loans at once, as arrays of shape
+(N, year). Interest is paid on the outstanding balance at the start of each
+year; during the grace period only interest is paid. Repayment profiles:
+
+    straight_line  equal principal payments after the grace period
+    annuity        equal debt service (interest and principal) after the grace period
+    bullet         the principal is repaid at once in the last year
+    sculpted       debt service proportional to the cashflows available for debt
+                   service (e.g. the fiscal revenues of the instrument), so that
+                   the loan is repaid in the last year; loans without positive
+                   cashflows in the repayment period are repaid straight-line
+
+The profile may differ between the loans of a batch, e.g. to compare all
+profiles for one loan.
+"""
+
+import numpy as np
+
+LOAN_PROFILES = {
+    "straight_line" : "Straight-line principal after the grace period",
+    "annuity" : "Annuity (equal debt service) after the grace period",
+    "bullet" : "Bullet repayment in the last year",
+    "sculpted" : "Sculpted to the fiscal revenues",
+    }
+
+
+def _as_loan_column(value, N=None):
+    value = np.asarray(value)
+    if value.ndim > 1:
+        raise ValueError("Loan parameters must be scalars or 1-D arrays.")
+    return value.reshape(-1, 1) if N is None else np.broadcast_to(value.reshape(-1, 1), (N, 1))
+
+
+def _get_straight_line(PRINCIPAL, RATE, REPAYMENT_YEAR, NUMBER_REPAYMENTS, CASHFLOWS):
+    #____Outstanding balance at the start of each year
+    BALANCE = PRINCIPAL * (1 - np.clip(REPAYMENT_YEAR, 0, None) / NUMBER_REPAYMENTS)
+    PRINCIPAL_PAYMENTS = np.where(REPAYMENT_YEAR >= 0, PRINCIPAL / NUMBER_REPAYMENTS, 0.0)
+    return BALANCE, PRINCIPAL_PAYMENTS
+
+
+def _get_annuity(PRINCIPAL, RATE, REPAYMENT_YEAR, NUMBER_REPAYMENTS, CASHFLOWS):
+    k = np.clip(REPAYMENT_YEAR, 0, None)
+    GROWTH = (1 + RATE) ** k
+    with np.errstate(divide="ignore", invalid="ignore"):
+        PAYMENT = np.where(RATE > 0, PRINCIPAL * RATE / (1 - (1 + RATE) ** -NUMBER_REPAYMENTS), PRINCIPAL / NUMBER_REPAYMENTS)
+        BALANCE = np.where(RATE > 0, PRINCIPAL*GROWTH - PAYMENT*(GROWTH - 1)/RATE, PRINCIPAL - PAYMENT*k)
+    PRINCIPAL_PAYMENTS = np.where(REPAYMENT_YEAR >= 0, PAYMENT - BALANCE*RATE, 0.0)
+    return BALANCE, PRINCIPAL_PAYMENTS
+
+
+def _get_bullet(PRINCIPAL, RATE, REPAYMENT_YEAR, NUMBER_REPAYMENTS, CASHFLOWS):
+    BALANCE = np.broadcast_to(PRINCIPAL, REPAYMENT_YEAR.shape)
+    PRINCIPAL_PAYMENTS = np.where(REPAYMENT_YEAR == NUMBER_REPAYMENTS - 1, PRINCIPAL, 0.0)
+    return BALANCE, PRINCIPAL_PAYMENTS
+
+
+def _get_sculpted(PRINCIPAL, RATE, REPAYMENT_YEAR, NUMBER_REPAYMENTS, CASHFLOWS):
+    if CASHFLOWS is None:
+        raise ValueError("Sculpted repayments need the cashflows available for debt service.")
+    #____Debt service is proportional to the positive cashflows of the repayment period, its present value equals the principal.
+    CASHFLOWS = np.where(REPAYMENT_YEAR >= 0, np.clip(CASHFLOWS, 0, None), 0.0)
+    DISCOUNT = (1 + RATE) ** -(REPAYMENT_YEAR + 1.0)
+    PRESENT_VALUE = (CASHFLOWS * DISCOUNT).sum(axis=1, keepdims=True)
+    #____Without positive cashflows (e.g. no fiscal revenues), there is nothing to sculpt to, so the loan is repaid straight-line.
+    SCULPTED = PRESENT_VALUE > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        DEBT_SERVICE = CASHFLOWS * PRINCIPAL / np.where(SCULPTED, PRESENT_VALUE, 1.0)
+    #____Balance at the start of each year: present value of the remaining debt service
+    REMAINING = np.cumsum((DEBT_SERVICE * DISCOUNT)[:, ::-1], axis=1)[:, ::-1]
+    BALANCE = np.where(REPAYMENT_YEAR >= 0, REMAINING / DISCOUNT / (1 + RATE), PRINCIPAL)
+    PRINCIPAL_PAYMENTS = np.where(REPAYMENT_YEAR >= 0, DEBT_SERVICE - BALANCE*RATE, 0.0)
+    STRAIGHT_BALANCE, STRAIGHT_PAYMENTS = _get_straight_line(PRINCIPAL, RATE, REPAYMENT_YEAR, NUMBER_REPAYMENTS, None)
+    BALANCE = np.where(SCULPTED, BALANCE, STRAIGHT_BALANCE)
+    PRINCIPAL_PAYMENTS = np.where(SCULPTED, PRINCIPAL_PAYMENTS, STRAIGHT_PAYMENTS)
+    return BALANCE, PRINCIPAL_PAYMENTS
+
+
+_PROFILE_FUNCTIONS = {
+    "straight_line" : _get_straight_line,
+    "annuity" : _get_annuity,
+    "bullet" : _get_bullet,
+    "sculpted" : _get_sculpted,
+    }
+
+
+def get_loan_schedules(PRINCIPAL, RATE, TERM, GRACE_PERIOD=0, PROFILE="straight_line", CASHFLOWS=None):
+    """
+    Returns the repayment schedules of N loans over TERM years.
+
+    PRINCIPAL, RATE, GRACE_PERIOD and PROFILE are scalars or arrays of shape
+    (N,), CASHFLOWS (only for sculpted repayments) has shape (year,) or (N, year).
+    TERM is common to the batch.
+
+    Returns a dictionary with arrays of shape (N, year)
+        "BALANCE" : Outstanding balance at the start of each year [US$]
+        "INTEREST_PAYMENTS" : Interest payments [US$]
+        "PRINCIPAL_PAYMENTS" : Principal payments [US$]
+        "DEBT_SERVICE" : Interest and principal payments [US$]
+    """
+    PROFILE = _as_loan_column(PROFILE)
+    N = np.broadcast_shapes(*(_as_loan_column(x).shape for x in (PRINCIPAL, RATE, GRACE_PERIOD)), PROFILE.shape)[0]
+    if CASHFLOWS is not None:
+        CASHFLOWS = np.atleast_2d(np.asarray(CASHFLOWS, dtype=np.float64))
+        N = max(N, CASHFLOWS.shape[0])
+        CASHFLOWS = np.broadcast_to(CASHFLOWS, (N, TERM))
+    PRINCIPAL = _as_loan_column(np.asarray(PRINCIPAL, dtype=np.float64), N)
+    RATE = _as_loan_column(np.asarray(RATE, dtype=np.float64), N)
+    GRACE_PERIOD = _as_loan_column(GRACE_PERIOD, N)
+    PROFILE = np.broadcast_to(PROFILE, (N, 1))[:, 0]
+
+    unknown = set(PROFILE.tolist()) - set(_PROFILE_FUNCTIONS)
+    if unknown:
+        raise ValueError("Unknown repayment profile: " + ", ".join(sorted(map(str, unknown))))
+    if np.any(GRACE_PERIOD >= TERM) or np.any(GRACE_PERIOD < 0):
+        raise ValueError("The grace period must be shorter than the term of the loan.")
+
+    #____Year of the repayment period, negative during the grace period
+    REPAYMENT_YEAR = np.arange(TERM) - GRACE_PERIOD
+    NUMBER_REPAYMENTS = TERM - GRACE_PERIOD
+
+    BALANCE = np.empty((N, TERM))
+    PRINCIPAL_PAYMENTS = np.empty((N, TERM))
+    for name in np.unique(PROFILE):
+        rows = PROFILE == name
+        BALANCE[rows], PRINCIPAL_PAYMENTS[rows] = _PROFILE_FUNCTIONS[name](
+            PRINCIPAL[rows], RATE[rows], REPAYMENT_YEAR[rows], NUMBER_REPAYMENTS[rows],
+            CASHFLOWS[rows] if CASHFLOWS is not None else None,
+            )
+    INTEREST_PAYMENTS = BALANCE * RATE
+
+    return {
+        "BALANCE" : BALANCE,
+        "INTEREST_PAYMENTS" : INTEREST_PAYMENTS,
+        "PRINCIPAL_PAYMENTS" : PRINCIPAL_PAYMENTS,
+        "DEBT_SERVICE" : INTEREST_PAYMENTS + PRINCIPAL_PAYMENTS,
+        }
+
+
+def compare_loan_profiles(PRINCIPAL, RATE, TERM, GRACE_PERIOD=0, CASHFLOWS=None, PROFILES=None):
+    """
+    Evaluates one loan with each repayment profile (default: all profiles,
+    sculpted only with CASHFLOWS) in one batch. Returns a dictionary with
+        "PROFILES" : Compared profiles
+        "SCHEDULES" : Schedules of get_loan_schedules, one row per profile
+        "TOTAL_INTEREST" : Sum of the interest payments [US$]
+        "MAX_DEBT_SERVICE" : Highest annual debt service [US$]
+        "AVERAGE_LIFE" : Principal-weighted average year of repayment [years]
+    """
+    if PROFILES is None:
+        PROFILES = [name for name in LOAN_PROFILES if name != "sculpted" or CASHFLOWS is not None]
+    SCHEDULES = get_loan_schedules(PRINCIPAL, RATE, TERM, GRACE_PERIOD, np.array(PROFILES), CASHFLOWS)
+    YEARS = np.arange(1, TERM+1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        AVERAGE_LIFE = (SCHEDULES["PRINCIPAL_PAYMENTS"] @ YEARS) / SCHEDULES["PRINCIPAL_PAYMENTS"].sum(axis=1)
+    return {
+        "PROFILES" : list(PROFILES),
+        "SCHEDULES" : SCHEDULES,
+        "TOTAL_INTEREST" : SCHEDULES["INTEREST_PAYMENTS"].sum(axis=1),
+        "MAX_DEBT_SERVICE" : SCHEDULES["DEBT_SERVICE"].max(axis=1),
+        "AVERAGE_LIFE" : AVERAGE_LIFE,
+        }
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental evaluation of a scenario as a pipeline of memoized stages.
+
+    mechanism  ATTR of pm.Mechanism     inputs: Scenario.get_mechanism_inputs()
+    columns    annual result columns    inputs: mechanism stage, CARRIER, SUBSIDY_VOLUME, PERIOD
+    fiscal     fiscal model             inputs: columns stage, Scenario.get_fiscal_parameters()
+    charts     serialized figures       inputs: columns or fiscal stage and the metric,
+                                        see h2global_charts.get_figure_key
+
+The key of a stage is a hash over its own inputs and the key of the upstream
+stage, so an edit only invalidates the stage of the edited input and the
+stages downstream of it. E.g. a change of VAT_RATE reuses the simulated
+mechanism and the annual columns and only reruns the fiscal model and its
+charts. The mechanism stage is kept in SIMULATION_CACHE, the columns and
+fiscal stages in the caches of this module, which are shared across sessions.
+"""
+
+from utils.simulation_cache import SimulationCache, get_parameter_hash
+from utils.instrumentation import register_cache
+
+#Stages in the order of evaluation --> upstream stage
+PIPELINE_STAGES = {
+    "mechanism" : None,
+    "columns" : "mechanism",
+    "fiscal" : "columns",
+    }
+
+#Scenario attributes of the columns stage besides the mechanism inputs
+COLUMN_PARAMETERS = ("CARRIER", "SUBSIDY_VOLUME", "PERIOD")
+
+#Module-level instances, shared across sessions of the Streamlit server.
+#____Entries of the columns stage are single columns, keyed "<stage key>:<column name>".
+COLUMN_CACHE = SimulationCache(max_entries=4096, max_bytes=64 * 1024**2)
+FISCAL_CACHE = SimulationCache(max_entries=256, max_bytes=64 * 1024**2)
+register_cache("columns", COLUMN_CACHE)
+register_cache("fiscal", FISCAL_CACHE)
+
+
+def get_stage_keys(scenario):
+    """
+    Returns the key of each stage of scenario, see PIPELINE_STAGES.
+    """
+    STAGE_KEYS = {"mechanism": scenario.get_mechanism_hash()}
+    STAGE_KEYS["columns"] = get_parameter_hash(
+        UPSTREAM=STAGE_KEYS["mechanism"],
+        **{name: getattr(scenario, name) for name in COLUMN_PARAMETERS}
+        )
+    STAGE_KEYS["fiscal"] = get_parameter_hash(
+        UPSTREAM=STAGE_KEYS["columns"],
+        **scenario.get_fiscal_parameters()
+        )
+    return STAGE_KEYS
+
+
+def get_changed_stages(previous, scenario):
+    """
+    Returns the stages, which have to be rerun when previous is replaced by
+    scenario, in the order of PIPELINE_STAGES.
+    """
+    if previous is None:
+        return tuple(PIPELINE_STAGES)
+    PREVIOUS_KEYS = get_stage_keys(previous)
+    STAGE_KEYS = get_stage_keys(scenario)
+    return tuple(stage for stage in PIPELINE_STAGES if STAGE_KEYS[stage] != PREVIOUS_KEYS[stage])
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Price paths of the H2Global mechanism beyond a linear development.
+
+A price path is described by its generator and the generator parameters,
+given as canonical JSON (see get_price_path_spec), e.g.
+
+    {"TYPE": "learning_curve", "START": 6.0, "LEARNING_RATE": 0.15, "GROWTH_RATE": 0.3, "FLOOR": 2.0}
+
+    piecewise       linear interpolation between prices VALUES in years YEARS (1 = first year)
+    learning_curve  price START, which falls by LEARNING_RATE with each doubling of the
+                    cumulative production, which grows by GROWTH_RATE per year; at least FLOOR
+    table           annual prices VALUES, e.g. read from a CSV file (see read_price_path_csv)
+    gbm             geometric Brownian motion from START with annual DRIFT and VOLATILITY
+    mean_reverting  Ornstein-Uhlenbeck process from START towards MEAN with speed REVERSION
+                    and annual VOLATILITY relative to MEAN
+
+Deterministic paths have shape (year,), stochastic paths (year, path), with
+one column per simulated path of the mechanism. The generators are vectorized
+over arrays of parameters, e.g. a learning curve for many learning rates at
+once. Generated paths are cached by their generator parameters.
+
+Many price paths of one scenario are simulated in batch with
+get_price_path_attrs(): deterministic paths are simulated as columns of one
+pm.Mechanism instance, since the paths of the mechanism are independent of
+each other.
+"""
+
+import csv
+import io
+import json
+
+import numpy as np
+
+from utils.simulation_cache import (
+    SIMULATION_CACHE, SimulationCache, get_mechanism_attrs, get_parameter_hash, get_scenario_hash, simulate_mechanism
+    )
+from utils.simulation_jobs import broadcast_paths, split_path_chunks
+from utils.instrumentation import measure_stage, register_cache
+
+#Generators and their parameters
+PRICE_PATH_TYPES = {
+    "piecewise" : ("YEARS", "VALUES"),
+    "learning_curve" : ("START", "LEARNING_RATE", "GROWTH_RATE", "FLOOR"),
+    "table" : ("VALUES",),
+    "gbm" : ("START", "DRIFT", "VOLATILITY", "SEED"),
+    "mean_reverting" : ("START", "MEAN", "REVERSION", "VOLATILITY", "SEED"),
+    }
+STOCHASTIC_PRICE_PATH_TYPES = ("gbm", "mean_reverting")
+
+#Lower bound of stochastic prices [US$/kg], the mechanism divides by prices.
+PRICE_PATH_MIN = 0.01
+#Upper bound of prices of inputs [US$/kg]
+PRICE_MAX = 1000.0
+
+#Limits of the generator parameters --> (minimum, maximum), see get_price_path_spec
+#____Price paths also come from shared links, so the limits keep the generators finite.
+PRICE_PATH_LIMITS = {
+    "YEARS" : (0.0, 100.0),
+    "VALUES" : (0.0, PRICE_MAX),
+    "START" : (0.0, PRICE_MAX),
+    "MEAN" : (0.0, PRICE_MAX),
+    "FLOOR" : (0.0, PRICE_MAX),
+    "LEARNING_RATE" : (0.0, 0.9),
+    "GROWTH_RATE" : (0.0, 10.0),
+    "DRIFT" : (-1.0, 1.0),
+    "VOLATILITY" : (0.0, 2.0),
+    "REVERSION" : (0.0, 10.0),
+    "SEED" : (0, 2**32 - 1),
+    }
+#Maximal number of YEARS and VALUES of a price path
+PRICE_PATH_MAX_VALUES = 100
+
+#Module-level instance, shared across sessions of the Streamlit server.
+PRICE_PATH_CACHE = SimulationCache(max_entries=256, max_bytes=64 * 1024**2)
+register_cache("price_path", PRICE_PATH_CACHE)
+
+
+def get_piecewise_paths(YEARS, VALUES, PERIOD):
+    """
+    Returns the linear interpolation of VALUES, given in YEARS, for the years
+    1 to PERIOD. Prices before the first and after the last year are constant.
+    VALUES of shape (knot,) give a path (year,), VALUES of shape (knot, K)
+    give K paths (year, K).
+    """
+    YEARS = np.asarray(YEARS, dtype=np.float64)
+    VALUES = np.asarray(VALUES, dtype=np.float64)
+    if YEARS.ndim != 1 or len(YEARS) != len(VALUES) or len(YEARS) == 0:
+        raise ValueError("Piecewise price paths need one price per year.")
+    ORDER = np.argsort(YEARS)
+    #____Interpolation weights of each knot in each year, so that all paths are interpolated in one product.
+    WEIGHTS = np.stack([np.interp(np.arange(1, PERIOD+1), YEARS[ORDER], column) for column in np.eye(len(YEARS))], axis=1)
+    return WEIGHTS @ VALUES[ORDER]
+
+
+def get_learning_curve_paths(START, LEARNING_RATE, GROWTH_RATE, PERIOD, FLOOR=0.0):
+    """
+    Returns learning-curve price paths: the price falls by LEARNING_RATE with
+    each doubling of the cumulative production, which grows by GROWTH_RATE
+    per year, i.e. by the factor (1+GROWTH_RATE)**log2(1-LEARNING_RATE) per
+    year, and does not fall below FLOOR. Array parameters of shape (K,) give
+    K paths (year, K).
+    """
+    START, LEARNING_RATE, GROWTH_RATE, FLOOR = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (START, LEARNING_RATE, GROWTH_RATE, FLOOR)))
+    if np.any(LEARNING_RATE >= 1) or np.any(GROWTH_RATE <= -1):
+        raise ValueError("Learning rates must be below 100 % and growth rates above -100 %.")
+    YEARS = np.arange(PERIOD, dtype=np.float64).reshape((PERIOD,) + (1,)*START.ndim)
+    return np.maximum(START * (1 + GROWTH_RATE) ** (YEARS * np.log2(1 - LEARNING_RATE)), FLOOR)
+
+
+def get_table_path(VALUES, PERIOD):
+    """
+    Returns the annual prices VALUES, which must cover the funding period.
+    """
+    VALUES = np.asarray(VALUES, dtype=np.float64)
+    if len(VALUES) != PERIOD:
+        raise ValueError("The price path has " + str(len(VALUES)) + " annual prices, the funding period " + str(PERIOD) + " years.")
+    return VALUES
+
+
+def get_gbm_paths(START, DRIFT, VOLATILITY, PERIOD, NUMBER_PATHS, SEED=0):
+    """
+    Returns NUMBER_PATHS paths (year, path) of a geometric Brownian motion,
+    which starts at START in the first year.
+    """
+    SHOCKS = np.random.default_rng(SEED).standard_normal((PERIOD-1, NUMBER_PATHS))
+    LOG_RETURNS = (DRIFT - 0.5*VOLATILITY**2) + VOLATILITY*SHOCKS
+    PATHS = START * np.exp(np.vstack([np.zeros((1, NUMBER_PATHS)), np.cumsum(LOG_RETURNS, axis=0)]))
+    return np.maximum(PATHS, PRICE_PATH_MIN)
+
+
+def get_mean_reverting_paths(START, MEAN, REVERSION, VOLATILITY, PERIOD, NUMBER_PATHS, SEED=0):
+    """
+    Returns NUMBER_PATHS paths (year, path) of an Ornstein-Uhlenbeck process,
+    which starts at START in the first year and reverts to MEAN with speed
+    REVERSION [1/year]. VOLATILITY is the annual volatility relative to MEAN.
+    The annual steps are sampled exactly.
+    """
+    SHOCKS = np.random.default_rng(SEED).standard_normal((PERIOD-1, NUMBER_PATHS))
+    DECAY = np.exp(-REVERSION)
+    STD = VOLATILITY*MEAN * (np.sqrt((1 - DECAY**2) / (2*REVERSION)) if REVERSION > 0 else 1.0)
+    PATHS = np.empty((PERIOD, NUMBER_PATHS))
+    PATHS[0] = START
+    for t in range(1, PERIOD):
+        PATHS[t] = MEAN + (PATHS[t-1] - MEAN)*DECAY + STD*SHOCKS[t-1]
+    return np.maximum(PATHS, PRICE_PATH_MIN)
+
+
+def get_price_path_spec(TYPE, **PARAMETERS):
+    """
+    Returns the canonical JSON of a price path, which identifies it in
+    scenarios and caches. Missing parameters and parameters of the wrong type
+    or outside PRICE_PATH_LIMITS raise a ValueError.
+    """
+    if not isinstance(TYPE, str) or TYPE not in PRICE_PATH_TYPES:
+        raise ValueError("Unknown price path: " + str(TYPE))
+    missing = [name for name in PRICE_PATH_TYPES[TYPE] if name not in PARAMETERS and name not in ("FLOOR", "SEED")]
+    if missing:
+        raise ValueError("Missing parameters of the price path: " + ", ".join(missing))
+    SPEC = {"TYPE": TYPE}
+    for name in PRICE_PATH_TYPES[TYPE]:
+        value = PARAMETERS.get(name, 0)
+        try:
+            if name in ("YEARS", "VALUES"):
+                SPEC[name] = [float(v) for v in np.ravel(value)]
+            elif name == "SEED":
+                if isinstance(value, (bool, float)) or int(value) != value:
+                    raise TypeError
+                SPEC[name] = int(value)
+            else:
+                SPEC[name] = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid parameter " + name + " of the price path.")
+        minimum, maximum = PRICE_PATH_LIMITS[name]
+        VALUES = SPEC[name] if isinstance(SPEC[name], list) else [SPEC[name]]
+        if len(VALUES) > PRICE_PATH_MAX_VALUES:
+            raise ValueError("Price paths have at most " + str(PRICE_PATH_MAX_VALUES) + " values.")
+        if not all(minimum <= v <= maximum for v in VALUES):
+            raise ValueError("The parameter {} of the price path must lie between {} and {}.".format(name, minimum, maximum))
+    return json.dumps(SPEC, sort_keys=True)
+
+
+def parse_price_path_spec(spec):
+    """
+    Returns the price path of a JSON string or dictionary as dictionary.
+    """
+    SPEC = json.loads(spec) if isinstance(spec, str) else dict(spec)
+    if not isinstance(SPEC, dict):
+        raise ValueError("Invalid price path: " + str(spec))
+    return SPEC
+
+
+def is_stochastic_price_path(spec):
+    return spec is not None and parse_price_path_spec(spec)["TYPE"] in STOCHASTIC_PRICE_PATH_TYPES
+
+
+def _generate_price_path(SPEC, PERIOD, NUMBER_PATHS):
+    TYPE = SPEC["TYPE"]
+    if TYPE == "piecewise":
+        return get_piecewise_paths(SPEC["YEARS"], SPEC["VALUES"], PERIOD)
+    if TYPE == "learning_curve":
+        return get_learning_curve_paths(SPEC["START"], SPEC["LEARNING_RATE"], SPEC["GROWTH_RATE"], PERIOD, SPEC["FLOOR"])
+    if TYPE == "table":
+        return get_table_path(SPEC["VALUES"], PERIOD)
+    if TYPE == "gbm":
+        return get_gbm_paths(SPEC["START"], SPEC["DRIFT"], SPEC["VOLATILITY"], PERIOD, NUMBER_PATHS, SPEC["SEED"])
+    return get_mean_reverting_paths(SPEC["START"], SPEC["MEAN"], SPEC["REVERSION"], SPEC["VOLATILITY"], PERIOD, NUMBER_PATHS, SPEC["SEED"])
+
+
+def get_price_path(spec, PERIOD, NUMBER_PATHS=1, cache=PRICE_PATH_CACHE):
+    """
+    Returns the annual prices of a price path (JSON or dictionary): shape
+    (year,) for deterministic, (year, NUMBER_PATHS) for stochastic paths.
+    Paths are cached by their generator parameters and returned read-only.
+    """
+    SPEC = parse_price_path_spec(spec)
+    if SPEC["TYPE"] not in STOCHASTIC_PRICE_PATH_TYPES:
+        NUMBER_PATHS = 1
+    key = get_parameter_hash(SPEC=get_price_path_spec(**SPEC), PERIOD=PERIOD, NUMBER_PATHS=NUMBER_PATHS)
+    ENTRY = cache.get(key)
+    if ENTRY is None:
+        ENTRY = cache.put(key, {"PRICE": _generate_price_path(SPEC, PERIOD, NUMBER_PATHS)})
+    return ENTRY["PRICE"]
+
+
+def read_price_path_csv(file):
+    """
+    Reads annual prices from a CSV file (path, file object or bytes) with one
+    column per price path and an optional column "Year". Returns a dictionary
+    of column name --> annual prices, in the order of the years.
+    """
+    if isinstance(file, bytes):
+        file = io.StringIO(file.decode("utf-8-sig"))
+    elif isinstance(file, str):
+        with open(file, newline="", encoding="utf-8-sig") as f:
+            return read_price_path_csv(f)
+    ROWS = list(csv.DictReader(file))
+    if not ROWS:
+        raise ValueError("The CSV file contains no prices.")
+    if "Year" in ROWS[0]:
+        ROWS.sort(key=lambda row: float(row["Year"]))
+    try:
+        return {name: np.array([float(row[name]) for row in ROWS]) for name in ROWS[0] if name != "Year"}
+    except (TypeError, ValueError):
+        raise ValueError("The CSV file contains values, which are not numbers.")
+
+
+def get_price_path_inputs(MECHANISM_INPUTS):
+    """
+    Completes the keyword arguments of pm.Mechanism for 2-D price paths: the
+    number of simulated paths is the number of columns, and the volatility of
+    the mechanism is not applied on given sales price paths.
+    """
+    for name in ("purchase_price", "sales_price"):
+        if np.ndim(MECHANISM_INPUTS[name]) == 2:
+            MECHANISM_INPUTS["NUMBER_SCENARIOS"] = np.shape(MECHANISM_INPUTS[name])[1]
+    if np.ndim(MECHANISM_INPUTS["sales_price"]) == 2:
+        MECHANISM_INPUTS["VOLATILITY"] = 0.0
+    return MECHANISM_INPUTS
+
+
+def _get_price_array(price, PERIOD, NUMBER_PATHS):
+    if isinstance(price, (str, dict)):
+        return get_price_path(price, PERIOD, NUMBER_PATHS)
+    return np.asarray(price, dtype=np.float64)
+
+
+def get_price_path_attrs(scenario, PRICE_PATHS, cache=SIMULATION_CACHE, max_workers=None):
+    """
+    Returns the ATTR of scenario for each (purchase price, sales price) pair
+    of PRICE_PATHS. Each price is a price path (JSON or dictionary), an array
+    (year,) or (year, path), or None for the price of scenario.
+
+    Cached price paths are not simulated again. Deterministic price paths
+    without volatility are simulated together, as columns of one instance of
+    pm.Mechanism, and each is cached with the number of paths of scenario
+    (as identical paths, see broadcast_paths). All others are simulated in
+    parallel, see get_mechanism_attrs.
+    """
+    BASE_INPUTS = scenario.get_mechanism_inputs()
+    INPUTS_LIST = []
+    for PURCHASE_PRICE, SALES_PRICE in PRICE_PATHS:
+        #____Number of paths and volatility of scenario, get_price_path_inputs adapts them to the given prices.
+        MECHANISM_INPUTS = dict(BASE_INPUTS, NUMBER_SCENARIOS=scenario.NUMBER_PATHS, VOLATILITY=scenario.SALES_PRICE_VOLATILITY)
+        if PURCHASE_PRICE is not None:
+            MECHANISM_INPUTS["purchase_price"] = _get_price_array(PURCHASE_PRICE, scenario.PERIOD, scenario.NUMBER_PATHS)
+        if SALES_PRICE is not None:
+            MECHANISM_INPUTS["sales_price"] = _get_price_array(SALES_PRICE, scenario.PERIOD, scenario.NUMBER_PATHS)
+        INPUTS_LIST.append(get_price_path_inputs(MECHANISM_INPUTS))
+
+    keys = [get_scenario_hash(**MECHANISM_INPUTS) for MECHANISM_INPUTS in INPUTS_LIST]
+    BATCH = {}
+    for key, MECHANISM_INPUTS in zip(keys, INPUTS_LIST):
+        if (key not in cache and MECHANISM_INPUTS["VOLATILITY"] == 0
+                and np.ndim(MECHANISM_INPUTS["purchase_price"]) == 1 and np.ndim(MECHANISM_INPUTS["sales_price"]) == 1):
+            BATCH[key] = MECHANISM_INPUTS
+
+    if BATCH:
+        with measure_stage("simulate_price_paths"):
+            ATTR = simulate_mechanism(**dict(
+                BASE_INPUTS,
+                purchase_price=np.column_stack([I["purchase_price"] for I in BATCH.values()]),
+                sales_price=np.column_stack([I["sales_price"] for I in BATCH.values()]),
+                NUMBER_SCENARIOS=len(BATCH),
+                VOLATILITY=0.0,
+                ))
+        for (key, MECHANISM_INPUTS), PATH_ATTR in zip(BATCH.items(), split_path_chunks(ATTR, [1]*len(BATCH))):
+            cache.put(key, broadcast_paths(PATH_ATTR, MECHANISM_INPUTS["NUMBER_SCENARIOS"]))
+
+    return get_mechanism_attrs(INPUTS_LIST, cache=cache, max_workers=max_workers)
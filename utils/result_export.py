@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of scenario results as CSV or Parquet.
+
+Three tables can be exported:
+
+    annual  annual results of the charts (data_to_plot), one row per year
+    fiscal  fiscal, loan and sales cashflows, one row per year
+    paths   raw per-path arrays of the mechanism (ATTR), one row per path and year
+
+Exports are generators of bytes. The tables are produced in chunks of rows
+(per-path results in chunks of paths), so that only one chunk is held in
+memory at a time, also for large Monte-Carlo runs.
+
+Streamlit keeps downloads of st.download_button in memory, so large exports
+are served by a separate HTTP endpoint, which streams the generators. It is
+started with H2G_EXPORT_PORT; H2G_EXPORT_URL sets the URL, under which the
+browser reaches it (default: http://localhost:<port>).
+"""
+
+import io
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from utils.h2global_model import ANNUAL_COLUMNS, DICT_CARRIER_SHORT
+
+#Environment variables of the export endpoint
+EXPORT_PORT_ENV = "H2G_EXPORT_PORT"
+EXPORT_URL_ENV = "H2G_EXPORT_URL"
+
+EXPORT_TABLES = {
+    "annual" : "Annual results",
+    "fiscal" : "Fiscal, loan and sales cashflows",
+    "paths" : "Per-path results of all simulated paths",
+    }
+EXPORT_FORMATS = {
+    "csv" : "text/csv",
+    "parquet" : "application/vnd.apache.parquet",
+    }
+
+#Number of paths per chunk of the per-path table
+EXPORT_CHUNK_PATHS = 1000
+#Number of results, which are kept for the export endpoint
+EXPORT_MAX_REGISTERED = 64
+#Without endpoint, per-path results are only offered for download up to this number of rows
+EXPORT_INLINE_MAX_ROWS = 100000
+
+
+def iter_annual_chunks(results):
+    """
+    Yields the annual results (data_to_plot) as one chunk of columns.
+    """
+    yield {name: np.asarray(results[name]) for name in ANNUAL_COLUMNS}
+
+
+def get_fiscal_columns(FISCAL_RESULTS):
+    """
+    Returns the fiscal, loan and sales cashflows of the fiscal model as
+    annual columns "<dictionary>.<category>", together with the year.
+    """
+    FISCAL_DICTS = {
+        "FISCAL_CASHFLOWS" : dict(zip(FISCAL_RESULTS["CATEGORIES"], FISCAL_RESULTS["CASHFLOWS"])),
+        "LOAN_CASHFLOWS" : FISCAL_RESULTS["LOAN_CASHFLOWS_DICT"],
+        "SALES_REVENUES" : FISCAL_RESULTS["SALES_REVENUES_DICT"],
+        }
+    columns = {}
+    for name, cashflows in FISCAL_DICTS.items():
+        for category, values in cashflows.items():
+            columns[name + "." + category] = np.asarray(values, dtype=np.float64)
+    length = max(np.size(v) for v in columns.values())
+    columns = {k: np.broadcast_to(v, (length,)) for k, v in columns.items()}
+    return dict({"Year": np.arange(1, length+1)}, **columns)
+
+
+def iter_fiscal_chunks(results):
+    """
+    Yields the fiscal, loan and sales cashflows as one chunk of columns.
+    """
+    yield get_fiscal_columns(results.FISCAL_RESULTS)
+
+
+def _get_path_arrays(ATTR, PERIOD, prefix=""):
+    #Per-path arrays (year, path) and annual arrays (year,) of ATTR, nested dictionaries as "<dict>.<key>".
+    ARRAYS = {}
+    for key, value in ATTR.items():
+        if isinstance(value, dict):
+            ARRAYS.update(_get_path_arrays(value, PERIOD, prefix + key + "."))
+        elif isinstance(value, np.ndarray) and value.ndim in (1, 2) and value.shape[0] == PERIOD:
+            ARRAYS[prefix + key] = value
+    return ARRAYS
+
+
+def iter_path_chunks(ATTR, chunk_paths=EXPORT_CHUNK_PATHS):
+    """
+    Yields the per-path results of ATTR in chunks of chunk_paths paths, with
+    one row per path and year. Annual arrays, which are equal for all paths,
+    are repeated for each path.
+    """
+    PERIOD, NUMBER_PATHS = np.shape(ATTR["Yearly_Product_Purchases"])
+    ARRAYS = _get_path_arrays(ATTR, PERIOD)
+    YEARS = np.arange(1, PERIOD+1)
+    for start in range(0, NUMBER_PATHS, chunk_paths):
+        stop = min(start + chunk_paths, NUMBER_PATHS)
+        columns = {
+            "Path" : np.repeat(np.arange(start+1, stop+1), PERIOD),
+            "Year" : np.tile(YEARS, stop - start),
+            }
+        for key, value in ARRAYS.items():
+            if value.ndim == 2:
+                columns[key] = value[:, start:stop].T.ravel()
+            else:
+                columns[key] = np.tile(value, stop - start)
+        yield columns
+
+
+class _ChunkSink(io.RawIOBase):
+
+    #Write-only file object, which collects the bytes written since the last take().
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _iter_arrow(chunks, get_writer):
+    #Writes the chunks of columns with the pyarrow writer of get_writer(sink, schema) and yields the bytes per chunk.
+    #____pyarrow is only imported, if results are exported.
+    import pyarrow as pa
+
+    sink = _ChunkSink()
+    writer = None
+    try:
+        for columns in chunks:
+            batch = pa.record_batch({name: np.ascontiguousarray(value) for name, value in columns.items()})
+            if writer is None:
+                writer = get_writer(sink, batch.schema)
+            writer.write(batch)
+            yield sink.take()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.take()
+
+
+def iter_csv(chunks):
+    """
+    Yields the chunks of columns as CSV file.
+    """
+    import pyarrow.csv as pc
+    return _iter_arrow(chunks, pc.CSVWriter)
+
+
+def iter_parquet(chunks):
+    """
+    Yields the chunks of columns as Parquet file, one row group per chunk.
+    """
+    import pyarrow.parquet as pq
+    return _iter_arrow(chunks, pq.ParquetWriter)
+
+
+def stream_export(results, table="annual", format="csv", chunk_paths=EXPORT_CHUNK_PATHS):
+    """
+    Returns a generator of the bytes of the export of one table of results
+    (ScenarioResults), see EXPORT_TABLES and EXPORT_FORMATS.
+    """
+    if table == "annual":
+        chunks = iter_annual_chunks(results)
+    elif table == "fiscal":
+        chunks = iter_fiscal_chunks(results)
+    elif table == "paths":
+        chunks = iter_path_chunks(results.ATTR, chunk_paths=chunk_paths)
+    else:
+        raise ValueError("Unknown export table: " + str(table))
+    if format == "csv":
+        return iter_csv(chunks)
+    if format == "parquet":
+        return iter_parquet(chunks)
+    raise ValueError("Unknown export format: " + str(format))
+
+
+def write_export(path, results, table="annual", format="csv", chunk_paths=EXPORT_CHUNK_PATHS):
+    """
+    Writes the export of one table of results to path, chunk by chunk.
+    """
+    with open(path, "wb") as f:
+        for data in stream_export(results, table, format, chunk_paths):
+            f.write(data)
+    return path
+
+
+def get_export_filename(results, table, format):
+    return "h2global-{}-{}-{}.{}".format(
+        DICT_CARRIER_SHORT[results.scenario.CARRIER].lower(), table, results.scenario.get_mechanism_hash()[:8], format
+        )
+
+
+#Results, which can be exported via the endpoint: token --> ScenarioResults
+_registered = OrderedDict()
+_registered_lock = threading.Lock()
+
+
+def register_export(results):
+    """
+    Makes results available to the export endpoint and returns their token,
+    a hash of the scenario. The most recent EXPORT_MAX_REGISTERED results are kept.
+    """
+    token = results.scenario.get_result_hash()[:32]
+    with _registered_lock:
+        _registered[token] = results
+        _registered.move_to_end(token)
+        while len(_registered) > EXPORT_MAX_REGISTERED:
+            _registered.popitem(last=False)
+    return token
+
+
+def get_export_url(token, table, format):
+    """
+    Returns the URL of an export on the endpoint, or None if it is not started.
+    """
+    if _server is None:
+        return None
+    base = os.environ.get(EXPORT_URL_ENV) or "http://localhost:" + str(_server.server_address[1])
+    return base.rstrip("/") + "/export/" + token + "/" + table + "." + format
+
+
+class _ExportHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        #____/export/<token>/<table>.<format>
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "export" or parts[2].count(".") != 1:
+            self.send_error(404)
+            return
+        token, (table, format) = parts[1], parts[2].split(".")
+        with _registered_lock:
+            results = _registered.get(token)
+        if results is None or table not in EXPORT_TABLES or format not in EXPORT_FORMATS:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", EXPORT_FORMATS[format])
+        self.send_header("Content-Disposition", 'attachment; filename="' + get_export_filename(results, table, format) + '"')
+        #____Without Content-Length, the body ends with the connection (HTTP/1.0), so chunks are sent as they are produced.
+        self.end_headers()
+        try:
+            for data in stream_export(results, table, format):
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_export_server(port=None, host="127.0.0.1"):
+    """
+    Serves the exports of registered results on http://<host>:<port>/export/
+    in a daemon thread. The port defaults to H2G_EXPORT_PORT; without port,
+    no server is started. The server is only started once per process and returned.
+    """
+    global _server
+    if port is None:
+        port = os.environ.get(EXPORT_PORT_ENV)
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, int(port)), _ExportHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="h2g-export", daemon=True).start()
+    return _server
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent columnar store for simulation results.
+
+Results are partitioned by carrier and scenario hash (hive layout):
+
+    <root>/carrier=<carrier>/scenario=<hash>/summary.parquet  per-year mean/std columns
+    <root>/carrier=<carrier>/scenario=<hash>/paths.arrow      raw per-path ATTR arrays
+    <root>/carrier=<carrier>/scenario=<hash>/fiscal-<fiscal hash>.parquet
+                                                              fiscal, loan and sales cashflows
+
+The per-path arrays are stored as Arrow IPC file, which is memory-mapped on
+reading, so the returned numpy arrays are zero-copy views on the file.
+Summaries of all stored scenarios can be queried column-wise with scan().
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from utils.simulation_cache import flatten_attr, unflatten_attr
+
+#Environment variable, which enables the result store of the app.
+RESULT_STORE_ENV = "H2G_RESULT_STORE"
+
+
+def get_summary_columns(ATTR):
+    """
+    Returns the per-year mean and standard deviation of all per-path arrays
+    of a mechanism, together with the year.
+    """
+    flat = flatten_attr(ATTR)
+    reference_shape = np.shape(ATTR["Yearly_Product_Purchases"])
+    columns = {"Year": np.arange(1, reference_shape[0]+1)}
+    for key, value in flat.items():
+        if isinstance(value, np.ndarray) and value.shape == reference_shape:
+            columns[key + "_MEAN"] = value.mean(axis=1)
+            columns[key + "_STD"] = value.std(axis=1)
+    return columns
+
+
+class ResultStore():
+
+    """
+    Columnar result store on the local file system, see module docstring.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def get_directory(self, carrier, scenario_hash):
+        return os.path.join(
+            self.root,
+            "carrier=" + quote(carrier, safe=""),
+            "scenario=" + scenario_hash
+            )
+
+    def exists(self, carrier, scenario_hash):
+        return os.path.exists(os.path.join(self.get_directory(carrier, scenario_hash), "paths.arrow"))
+
+    def write(self, carrier, scenario_hash, ATTR):
+        """
+        Stores the mechanism results of one scenario. ATTR is the attribute
+        dictionary of a simulated pm.Mechanism. The files are written to a
+        temporary directory first and moved into place one by one, paths.arrow
+        last, so readers never see partially written results. Partitions are
+        content-addressed, so an existing partition is kept as it is, also if
+        another process wrote it in the meantime.
+        """
+
+        directory = self.get_directory(carrier, scenario_hash)
+        if self.exists(carrier, scenario_hash):
+            return directory
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        temp_directory = tempfile.mkdtemp(dir=os.path.dirname(directory), prefix=".tmp-")
+
+        try:
+            pq.write_table(pa.table(get_summary_columns(ATTR)), os.path.join(temp_directory, "summary.parquet"))
+
+            #____Per-path arrays are flattened to one column each, the shapes are kept as metadata.
+            flat = flatten_attr(ATTR)
+            reference_shape = np.shape(ATTR["Yearly_Product_Purchases"])
+            arrays = {}
+            scalars = {}
+            for key, value in flat.items():
+                if isinstance(value, np.ndarray) and value.shape == reference_shape:
+                    arrays[key] = pa.array(np.ascontiguousarray(value, dtype=np.float64).ravel())
+                elif isinstance(value, np.ndarray):
+                    scalars[key] = value.tolist()
+                elif isinstance(value, np.generic):
+                    scalars[key] = value.item()
+                else:
+                    scalars[key] = value
+            metadata = {
+                "shape": json.dumps(list(reference_shape)),
+                "attributes": json.dumps(scalars),
+                }
+            table = pa.table(arrays).replace_schema_metadata(metadata)
+            with pa.OSFile(os.path.join(temp_directory, "paths.arrow"), "wb") as sink:
+                with ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table, max_chunksize=table.num_rows or None)
+
+            #____The partition may already hold fiscal results or be written by another process, so it is never replaced as a whole.
+            os.makedirs(directory, exist_ok=True)
+            for name in ("summary.parquet", "paths.arrow"):
+                os.replace(os.path.join(temp_directory, name), os.path.join(directory, name))
+        finally:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+        return directory
+
+    def write_fiscal(self, carrier, scenario_hash, fiscal_hash, FISCAL_DICTS, FISCAL_METADATA=None):
+        """
+        Stores fiscal results next to the mechanism results of a scenario.
+        FISCAL_DICTS maps names (e.g. "FISCAL_CASHFLOWS") to dictionaries of
+        annual cashflow arrays, as returned by the fiscal model.
+        FISCAL_METADATA holds scalar fiscal results, e.g. {"NPV": ...}.
+        fiscal_hash identifies the fiscal parameters of the results.
+        """
+
+        directory = self.get_directory(carrier, scenario_hash)
+        os.makedirs(directory, exist_ok=True)
+
+        fiscal_columns = {}
+        for name, cashflows in FISCAL_DICTS.items():
+            for category, values in cashflows.items():
+                fiscal_columns[name + "." + category] = np.asarray(values, dtype=np.float64)
+        length = max(np.size(v) for v in fiscal_columns.values())
+        fiscal_columns = {k: np.broadcast_to(v, (length,)) for k, v in fiscal_columns.items()}
+        fiscal_columns = dict({"Year": np.arange(1, length+1)}, **fiscal_columns)
+        fiscal_table = pa.table(fiscal_columns).replace_schema_metadata(
+            {"fiscal": json.dumps(FISCAL_METADATA or {}, default=float)}
+            )
+
+        path = os.path.join(directory, "fiscal-" + fiscal_hash + ".parquet")
+        #____The temporary file is unique per call, so concurrent writers of the same fiscal results do not collide.
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-fiscal-", suffix=".parquet")
+        os.close(handle)
+        try:
+            pq.write_table(fiscal_table, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return path
+
+    def read_summary(self, carrier, scenario_hash, columns=None):
+        """
+        Returns the per-year summary of one scenario as pyarrow.Table.
+        """
+        return pq.read_table(os.path.join(self.get_directory(carrier, scenario_hash), "summary.parquet"), columns=columns)
+
+    def read_paths(self, carrier, scenario_hash, keys=None):
+        """
+        Returns the attribute dictionary of one scenario. The per-path arrays
+        are read-only, zero-copy views on the memory-mapped Arrow file.
+        With keys, only the given per-path arrays are returned.
+        """
+        source = pa.memory_map(os.path.join(self.get_directory(carrier, scenario_hash), "paths.arrow"), "r")
+        table = ipc.open_file(source).read_all()
+        metadata = table.schema.metadata
+        shape = tuple(json.loads(metadata[b"shape"]))
+
+        flat = {} if keys is not None else json.loads(metadata[b"attributes"])
+        for name in (keys if keys is not None else table.column_names):
+            column = table.column(name)
+            flat[name] = column.chunk(0).to_numpy(zero_copy_only=True).reshape(shape)
+        return unflatten_attr(flat)
+
+    def read_fiscal(self, carrier, scenario_hash, fiscal_hash):
+        """
+        Returns the fiscal cashflow dictionaries and the scalar fiscal results
+        of one scenario, or None if no fiscal results were stored.
+        """
+        path = os.path.join(self.get_directory(carrier, scenario_hash), "fiscal-" + fiscal_hash + ".parquet")
+        if not os.path.exists(path):
+            return None
+        table = pq.read_table(path)
+        FISCAL_DICTS = {}
+        for name in table.column_names:
+            if name == "Year":
+                continue
+            dict_name, category = name.split(".", 1)
+            FISCAL_DICTS.setdefault(dict_name, {})[category] = table.column(name).to_numpy()
+        FISCAL_METADATA = json.loads(table.schema.metadata[b"fiscal"])
+        return FISCAL_DICTS, FISCAL_METADATA
+
+    def scan(self, columns=None, carrier=None):
+        """
+        Returns the summaries of all stored scenarios as one pyarrow.Table,
+        with the partition columns "carrier" and "scenario". Only the
+        requested columns are read from disk.
+        """
+        if not os.path.isdir(self.root) or not os.listdir(self.root):
+            return pa.table({})
+        dataset = ds.dataset(
+            self.root,
+            format="parquet",
+            partitioning="hive",
+            ignore_prefixes=[".", "_", "fiscal", "paths"],
+            )
+        expression = None
+        if carrier is not None:
+            expression = ds.field("carrier") == carrier
+        if columns is not None:
+            columns = list(dict.fromkeys(["carrier", "scenario"] + list(columns)))
+        return dataset.to_table(columns=columns, filter=expression)
+
+
+def get_default_result_store():
+    """
+    Returns the result store configured via the environment variable
+    H2G_RESULT_STORE, or None if no store is configured.
+    """
+    root = os.environ.get(RESULT_STORE_ENV)
+    if not root:
+        return None
+    return ResultStore(root)
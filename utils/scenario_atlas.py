@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed scenario atlas of the H2Global mechanism app.
+
+The atlas holds a grid of common scenarios (default prices of each carrier,
+common funding volumes and periods), with the mechanism results (ATTR), the
+fiscal results and the serialized figures of each scenario. It is built
+offline into one Arrow IPC file:
+
+    python -m utils.scenario_atlas -o scenario_atlas.arrow
+
+The app memory-maps the atlas (see get_default_atlas) and serves scenarios of
+the grid without simulation. Scenarios off the grid are evaluated live.
+
+Layout: one row per scenario, identified by Scenario.get_result_hash().
+Arrays are stored as list<float64> columns "ATTR.<key>" and "FISCAL.<key>"
+(nested dictionaries flattened with "."), which are read as zero-copy views
+on the file. Arrays of identical paths
+(e.g. without sales price volatility) are stored as one path and broadcast on
+reading. Scalars are stored as JSON, figures as zlib-compressed plotly JSON.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import threading
+import zlib
+from importlib import metadata
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from utils.h2global_model import DICT_LHV, Scenario, ScenarioResults, evaluate_scenario, get_price_defaults
+from utils.simulation_cache import SIMULATION_CACHE, flatten_attr, split_flat_attr, unflatten_attr
+
+#Environment variable with the path of the atlas of the app
+SCENARIO_ATLAS_ENV = "H2G_SCENARIO_ATLAS"
+#Path of the atlas, if the environment variable is not set
+SCENARIO_ATLAS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scenario_atlas.arrow")
+
+#Version of the layout. Atlases of other versions, or built with another
+#version of pymechanism, are not served.
+ATLAS_VERSION = "4"
+
+#Grid of the atlas. Prices are the defaults of each carrier, all other inputs
+#are the defaults of the app.
+ATLAS_GRID = {
+    "CARRIER" : tuple(DICT_LHV),
+    "SUBSIDY_VOLUME" : (0.5e9, 1e9, 2e9, 5e9),
+    "PERIOD" : (5, 10, 15, 20),
+    }
+
+
+def get_atlas_scenarios(grid=ATLAS_GRID):
+    """
+    Returns the scenarios of the cartesian product of grid, with the default
+    prices of each carrier.
+    """
+    keys = list(grid)
+    scenarios = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        case = dict(zip(keys, values))
+        PURCHASE_PRICE_START, PURCHASE_PRICE_END, SALES_PRICE_START, SALES_PRICE_END = get_price_defaults(case.get("CARRIER", Scenario.CARRIER))
+        scenarios.append(Scenario(
+            PURCHASE_PRICE_START=PURCHASE_PRICE_START,
+            PURCHASE_PRICE_END=PURCHASE_PRICE_END,
+            SALES_PRICE_START=SALES_PRICE_START,
+            SALES_PRICE_END=SALES_PRICE_END,
+            **case
+            ))
+    return scenarios
+
+
+def _get_atlas_metadata():
+    return {
+        b"ATLAS_VERSION": ATLAS_VERSION.encode(),
+        b"PYMECHANISM": metadata.version("pymechanism").encode(),
+        }
+
+
+def _collapse_paths(array):
+    #Returns the array with one path, if all paths (last axis) are identical.
+    if array.ndim == 2 and array.shape[1] > 1 and (array == array[:, :1]).all():
+        return array[:, :1], True
+    return array, False
+
+
+def _get_figure_jsons(results):
+    #plotly is only imported for building the atlas.
+    from utils.h2global_charts import METRICS
+    FIGURES = {}
+    for metric, (get_figure, _) in METRICS.items():
+        if metric == "VIS_5_DISTRIBUTION" and not results.scenario.is_stochastic():
+            continue
+        FIGURES[metric] = get_figure(results).to_json()
+    return FIGURES
+
+
+def get_atlas_record(scenario):
+    """
+    Evaluates scenario and returns its row of the atlas as dictionary of
+    arrays, scalars and figures.
+    """
+    results = evaluate_scenario(scenario)
+    FISCAL_RESULTS = results.FISCAL_RESULTS
+
+    ATTR_ARRAYS, ATTR_SCALARS = split_flat_attr(flatten_attr(results.ATTR, "ATTR."))
+    FISCAL_ARRAYS, FISCAL_SCALARS = split_flat_attr(flatten_attr(FISCAL_RESULTS, "FISCAL."))
+    ARRAYS = {}
+    LAYOUT = {}
+    for key, array in {**ATTR_ARRAYS, **FISCAL_ARRAYS}.items():
+        shape = list(array.shape)
+        array, collapsed = _collapse_paths(np.asarray(array, dtype=np.float64))
+        ARRAYS[key] = array.ravel()
+        LAYOUT[key] = {"SHAPE": shape, "COLLAPSED": collapsed}
+    return {
+        "SCENARIO_HASH" : scenario.get_result_hash(),
+        "SCENARIO" : scenario.to_dict(),
+        "ARRAYS" : ARRAYS,
+        "LAYOUT" : LAYOUT,
+        "SCALARS" : {**ATTR_SCALARS, **FISCAL_SCALARS},
+        "FIGURES" : {k: zlib.compress(v.encode(), 9) for k, v in _get_figure_jsons(results).items()},
+        }
+
+
+def build_atlas(path, scenarios=None, progress=None):
+    """
+    Evaluates all scenarios (default: the grid ATLAS_GRID) and writes the
+    atlas to path. Returns the number of scenarios.
+    """
+    if scenarios is None:
+        scenarios = get_atlas_scenarios()
+
+    records = []
+    for i, scenario in enumerate(scenarios):
+        records.append(get_atlas_record(scenario))
+        if progress is not None:
+            progress(i+1, len(scenarios))
+
+    array_keys = sorted({key for record in records for key in record["ARRAYS"]})
+    figure_keys = sorted({key for record in records for key in record["FIGURES"]})
+    columns = {
+        "scenario_hash" : pa.array([r["SCENARIO_HASH"] for r in records], pa.string()),
+        "scenario" : pa.array([json.dumps(r["SCENARIO"]) for r in records], pa.string()),
+        "layout" : pa.array([json.dumps(r["LAYOUT"]) for r in records], pa.string()),
+        "scalars" : pa.array([json.dumps(r["SCALARS"]) for r in records], pa.string()),
+        }
+    for key in array_keys:
+        columns[key] = pa.array([r["ARRAYS"].get(key) for r in records], pa.list_(pa.float64()))
+    for key in figure_keys:
+        columns["FIGURE." + key] = pa.array([r["FIGURES"].get(key) for r in records], pa.binary())
+    table = pa.table(columns).replace_schema_metadata(_get_atlas_metadata())
+
+    #Written to a temporary file first, so that a running app never maps a partial atlas.
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+        tmp = f.name
+    try:
+        with pa.OSFile(tmp, "wb") as sink, ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=len(records) or None)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return len(records)
+
+
+class ScenarioAtlas():
+
+    """
+    Read-only view on an atlas file. The file is memory-mapped, arrays of a
+    scenario are zero-copy views on it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        #The memory map stays open as long as arrays of the atlas are referenced.
+        table = ipc.open_file(pa.memory_map(path, "r")).read_all()
+        self.metadata = table.schema.metadata or {}
+        self._index = {h: i for i, h in enumerate(table.column("scenario_hash").to_pylist())}
+        self._layouts = table.column("layout").to_pylist()
+        self._scalars = table.column("scalars").to_pylist()
+        self._arrays = {}
+        self._figures = {}
+        for name in table.column_names:
+            column = table.column(name).chunk(0) if table.num_rows else None #written as one record batch
+            if name.startswith(("ATTR.", "FISCAL.")):
+                #____Offsets and values of the list column, valid rows
+                self._arrays[name] = (
+                    column.offsets.to_numpy(zero_copy_only=True),
+                    column.values.to_numpy(zero_copy_only=True),
+                    column.is_valid().to_numpy(zero_copy_only=False),
+                    )
+            elif name.startswith("FIGURE."):
+                self._figures[name[len("FIGURE."):]] = column
+
+    @property
+    def is_compatible(self):
+        return self.metadata == _get_atlas_metadata()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, scenario):
+        return scenario.get_result_hash() in self._index
+
+    def _get_arrays(self, i, prefix):
+        LAYOUT = json.loads(self._layouts[i])
+        ARRAYS = {}
+        for key, (offsets, values, valid) in self._arrays.items():
+            if not key.startswith(prefix) or not valid[i]:
+                continue
+            values = values[offsets[i]:offsets[i+1]]
+            shape = LAYOUT[key]["SHAPE"]
+            if LAYOUT[key]["COLLAPSED"]:
+                values = np.broadcast_to(values.reshape(shape[0], 1), shape)
+            else:
+                values = values.reshape(shape)
+            ARRAYS[key] = values
+        SCALARS = {k: tuple(v) if isinstance(v, list) else v for k, v in json.loads(self._scalars[i]).items() if k.startswith(prefix)}
+        return unflatten_attr({**SCALARS, **ARRAYS}, prefix)
+
+    def get_results(self, scenario):
+        """
+        Returns the ScenarioResults of scenario with mechanism and fiscal
+        results of the atlas, or None if scenario is not in the atlas.
+        """
+        i = self._index.get(scenario.get_result_hash())
+        if i is None:
+            return None
+        results = ScenarioResults(scenario, ATTR=self._get_arrays(i, "ATTR."))
+        FISCAL_RESULTS = self._get_arrays(i, "FISCAL.")
+        if FISCAL_RESULTS:
+            results._FISCAL_RESULTS = FISCAL_RESULTS
+        return results
+
+    def get_figure_jsons(self, scenario):
+        """
+        Returns the serialized figures of scenario by metric (see
+        utils.h2global_charts.METRICS).
+        """
+        i = self._index.get(scenario.get_result_hash())
+        if i is None:
+            return {}
+        return {
+            metric: zlib.decompress(column[i].as_buffer()).decode()
+            for metric, column in self._figures.items() if column[i].is_valid
+            }
+
+
+_default_atlas = None
+_default_atlas_lock = threading.Lock()
+
+
+def get_default_atlas():
+    """
+    Returns the atlas of the app at H2G_SCENARIO_ATLAS (default:
+    scenario_atlas.arrow in the root of the app), which is memory-mapped on
+    first use. Returns None, if there is no compatible atlas.
+    """
+    global _default_atlas
+    with _default_atlas_lock:
+        if _default_atlas is None:
+            path = os.environ.get(SCENARIO_ATLAS_ENV) or SCENARIO_ATLAS_PATH
+            atlas = ScenarioAtlas(path) if os.path.exists(path) else None
+            _default_atlas = atlas if atlas is not None and atlas.is_compatible else False
+    return _default_atlas or None
+
+
+def get_atlas_results(scenario, atlas=None, cache=SIMULATION_CACHE):
+    """
+    Returns the ScenarioResults of scenario from atlas (default: the atlas of
+    the app), or None if scenario is off the grid. The mechanism results are
+    added to the simulation cache, so that further analyses of the scenario
+    (e.g. sensitivities) do not simulate it again.
+    """
+    if atlas is None:
+        atlas = get_default_atlas()
+    results = atlas.get_results(scenario) if atlas is not None else None
+    if results is not None and cache is not None:
+        key = scenario.get_mechanism_hash()
+        if key not in cache:
+            cache.put(key, results.ATTR)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds the precomputed scenario atlas of the app.")
+    parser.add_argument("-o", "--output", default=SCENARIO_ATLAS_PATH, help="Path of the atlas file.")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print("Evaluated scenario", done, "of", total, flush=True)
+
+    number = build_atlas(args.output, progress=progress)
+    print("Atlas with", number, "scenarios in", args.output, "(" + str(round(os.path.getsize(args.output)/1024**2, 2)), "MiB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Persistence and sharing of scenarios.
+
+Scenarios are encoded into a compact, URL-safe token (see encode_scenario),
+which the evaluation page keeps in the query parameter "scenario", so that
+the address of the page restores all inputs:
+
+    <version>.<urlsafe base64 of the zlib-compressed JSON of all parameters,
+                which differ from the defaults of Scenario>
+
+If a default of Scenario changes, SCENARIO_ENCODING_VERSION has to be
+increased and decode_scenario has to fill up older tokens with the former
+defaults.
+
+The scenario library is a SQLite database, configured via the environment
+variable H2G_SCENARIO_LIBRARY, with the tables
+
+    scenarios  token, name, carrier, mechanism hash and creation time of saved scenarios
+    results    mechanism results (ATTR) by mechanism hash, as compressed npz
+               arrays and JSON scalars
+
+Mechanism results of a restored scenario are read from the library into
+SIMULATION_CACHE, so opening a shared link does not simulate the mechanism
+again, also after a restart of the server.
+"""
+
+import base64
+import dataclasses
+import io
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from utils.h2global_model import DEFAULT_SCENARIO, Scenario
+from utils.loans import LOAN_PROFILES
+from utils.price_paths import PRICE_MAX, get_price_path_spec, parse_price_path_spec
+from utils.simulation_cache import SIMULATION_CACHE, flatten_attr, split_flat_attr, unflatten_attr
+
+#Environment variable with the path of the SQLite database of the scenario library.
+SCENARIO_LIBRARY_ENV = "H2G_SCENARIO_LIBRARY"
+
+#Query parameter of the evaluation page, which holds the encoded scenario
+SCENARIO_QUERY_PARAM = "scenario"
+
+SCENARIO_ENCODING_VERSION = "1"
+
+#Limits of parameters of decoded scenarios --> (minimum, maximum), None is unbounded
+#____Tokens come from untrusted links, so they are bounded by the limits of the widgets of the app,
+#____which also bound the size of the simulation. RAMP_UP and the length of annual prices are bounded by PERIOD,
+#____generators of price paths by PRICE_PATH_LIMITS of utils.price_paths.
+SCENARIO_LIMITS = {
+    "SUBSIDY_VOLUME" : (0.0, None),
+    "PERIOD" : (0, 50),
+    "PURCHASE_PRICE_START" : (0.0, PRICE_MAX),
+    "PURCHASE_PRICE_END" : (0.0, PRICE_MAX),
+    "SALES_PRICE_START" : (0.0, PRICE_MAX),
+    "SALES_PRICE_END" : (0.0, PRICE_MAX),
+    "SALES_PRICE_VOLATILITY" : (0.0, 0.2),
+    "NUMBER_PATHS" : (1, DEFAULT_SCENARIO["NUMBER_PATHS"]),
+    "RATIO_LONGTERM_HSA" : (0.0, 1.0),
+    "FLOOR_PRICE_HSA" : (0.0, PRICE_MAX),
+    "BID_CAP_HSA" : (0.0, PRICE_MAX),
+    "REINVEST_CYCLES" : (-1, 100),
+    "RATIO_GUARANTEED_SHORTTERM_HSA" : (0.0, 1.0),
+    "DEPRECIATION_PERIOD" : (0, 100),
+    "GRACE_PERIOD" : (0, None),
+    "WACC" : (0.0, None),
+    "INFLATION" : (0.0, None),
+    "CORPORATE_TAX_RATE" : (0.0, None),
+    "VAT_RATE" : (0.0, None),
+    "IMPORT_DUTIES_RATE" : (0.0, None),
+    "SHARE_IMPORTED_PRODUCTION_EQUIPMENT" : (0.0, 1.0),
+    "SHARE_HPA_CONTRACT" : (0.0, 1.0),
+    "RAMP_UP" : (0, None),
+    "SHARE_TAXABLE_INCOME" : (0.0, 1.0),
+    "SHARE_DOMESTIC_SALES" : (0.0, 1.0),
+    }
+
+#Type of each parameter of Scenario
+_PARAMETER_TYPES = {field.name: field.type for field in dataclasses.fields(Scenario)}
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS scenarios (token TEXT PRIMARY KEY, name TEXT, carrier TEXT, mechanism_hash TEXT, created REAL)",
+    "CREATE TABLE IF NOT EXISTS results (mechanism_hash TEXT PRIMARY KEY, arrays BLOB, attributes TEXT)",
+    )
+
+
+def _to_json(value):
+    #Price paths are tuples in Scenario and lists in JSON.
+    return list(value) if isinstance(value, tuple) else value
+
+
+def encode_scenario(scenario):
+    """
+    Returns the compact, URL-safe token of scenario, see module docstring.
+    """
+    PARAMETERS = {
+        key: _to_json(value) for key, value in scenario.to_dict().items()
+        if _to_json(value) != _to_json(DEFAULT_SCENARIO[key])
+        }
+    encoded = json.dumps(PARAMETERS, sort_keys=True, separators=(",", ":")).encode()
+    payload = base64.urlsafe_b64encode(zlib.compress(encoded, 9)).decode().rstrip("=")
+    return SCENARIO_ENCODING_VERSION + "." + payload
+
+
+def decode_scenario(token):
+    """
+    Returns the Scenario of a token of encode_scenario. Invalid tokens,
+    parameters of the wrong type and parameters outside SCENARIO_LIMITS
+    raise a ValueError.
+    """
+    version, _, payload = str(token).partition(".")
+    if version != SCENARIO_ENCODING_VERSION:
+        raise ValueError("Unsupported version of the scenario encoding: " + version)
+    try:
+        encoded = zlib.decompress(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        PARAMETERS = json.loads(encoded)
+    except (ValueError, zlib.error) as error:
+        raise ValueError("Invalid scenario encoding: " + str(error))
+    if not isinstance(PARAMETERS, dict):
+        raise ValueError("Invalid scenario encoding.")
+    unknown = set(PARAMETERS) - set(DEFAULT_SCENARIO)
+    if unknown:
+        raise ValueError("Unknown scenario parameters: " + ", ".join(sorted(unknown)))
+    for key, value in PARAMETERS.items():
+        _check_parameter(key, value)
+    PERIOD = PARAMETERS.get("PERIOD", DEFAULT_SCENARIO["PERIOD"])
+    if PARAMETERS.get("RAMP_UP", DEFAULT_SCENARIO["RAMP_UP"]) > PERIOD:
+        raise ValueError("The ramp up period must not be longer than the funding period.")
+    for key in ("PURCHASE_PRICE", "SALES_PRICE"):
+        if PARAMETERS.get(key) is not None and len(PARAMETERS[key]) != PERIOD:
+            raise ValueError("The scenario parameter " + key + " must have one price per year of the funding period.")
+    return Scenario(**PARAMETERS)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+
+def _check_parameter(key, value):
+    #Decoded parameters must have the type of the parameter of Scenario and lie within SCENARIO_LIMITS.
+    kind = _PARAMETER_TYPES[key]
+    if value is None and DEFAULT_SCENARIO[key] is None:
+        return
+    if kind is bool:
+        valid = isinstance(value, bool)
+    elif kind is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif kind is float:
+        valid = _is_number(value)
+    elif kind is tuple:
+        valid = isinstance(value, list) and all(_is_number(v) and 0 <= v <= PRICE_MAX for v in value)
+    else:
+        valid = isinstance(value, kind)
+    if not valid:
+        raise ValueError("Invalid value of the scenario parameter " + key + ".")
+    if key in ("PURCHASE_PRICE_PATH", "SALES_PRICE_PATH"):
+        #____Types and limits of the generator parameters, see utils.price_paths.
+        get_price_path_spec(**parse_price_path_spec(value))
+    minimum, maximum = SCENARIO_LIMITS.get(key, (None, None))
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ValueError("The scenario parameter {} must lie between {} and {}.".format(key, minimum, maximum))
+    if key == "LOAN_PROFILE" and value not in LOAN_PROFILES:
+        raise ValueError("Unknown repayment profile: " + value)
+
+
+class ScenarioLibrary():
+
+    """
+    SQLite-backed library of saved scenarios and their mechanism results,
+    see module docstring. Each operation opens its own connection, so one
+    library can be used by all sessions of the Streamlit server.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, scenario, name=None, ATTR=None):
+        """
+        Saves scenario under name and, if given, its mechanism results.
+        Returns the token of the scenario.
+        """
+        token = encode_scenario(scenario)
+        mechanism_hash = scenario.get_mechanism_hash()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO scenarios VALUES (?, ?, ?, ?, ?) ON CONFLICT(token) DO UPDATE SET name=excluded.name",
+                (token, name or token[:16], scenario.CARRIER, mechanism_hash, time.time()),
+                )
+        if ATTR is not None:
+            self.put_attr(mechanism_hash, ATTR)
+        return token
+
+    def list_scenarios(self):
+        """
+        Returns the saved scenarios, latest first, as list of dictionaries
+        with "TOKEN", "NAME", "CARRIER", "CREATED" and "HAS_RESULTS".
+        """
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT s.token, s.name, s.carrier, s.created, r.mechanism_hash IS NOT NULL FROM scenarios s "
+                "LEFT JOIN results r ON s.mechanism_hash = r.mechanism_hash ORDER BY s.created DESC"
+                ).fetchall()
+        return [
+            {"TOKEN": token, "NAME": name, "CARRIER": carrier, "CREATED": created, "HAS_RESULTS": bool(has_results)}
+            for token, name, carrier, created, has_results in rows
+            ]
+
+    def delete(self, token):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM scenarios WHERE token = ?", (token,))
+
+    def has_attr(self, mechanism_hash):
+        with self._connect() as connection:
+            return connection.execute("SELECT 1 FROM results WHERE mechanism_hash = ?", (mechanism_hash,)).fetchone() is not None
+
+    def put_attr(self, mechanism_hash, ATTR):
+        """
+        Stores the mechanism results of a mechanism hash, unless they are stored already.
+        """
+        if self.has_attr(mechanism_hash):
+            return
+        ARRAYS, SCALARS = split_flat_attr(flatten_attr(ATTR))
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **ARRAYS)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?)",
+                (mechanism_hash, buffer.getvalue(), json.dumps(SCALARS)),
+                )
+
+    def get_attr(self, mechanism_hash):
+        """
+        Returns the stored mechanism results of a mechanism hash, or None.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT arrays, attributes FROM results WHERE mechanism_hash = ?", (mechanism_hash,)).fetchone()
+        if row is None:
+            return None
+        with np.load(io.BytesIO(row[0])) as ARRAYS:
+            FLAT = {key: ARRAYS[key] for key in ARRAYS.files}
+        FLAT.update(json.loads(row[1]))
+        return unflatten_attr(FLAT)
+
+
+def restore_scenario(token, library=None, cache=SIMULATION_CACHE):
+    """
+    Returns the Scenario of a token. Mechanism results, which are stored in
+    the library, are added to cache, so the scenario is not simulated again.
+    """
+    scenario = decode_scenario(token)
+    if library is not None:
+        key = scenario.get_mechanism_hash()
+        if key not in cache:
+            ATTR = library.get_attr(key)
+            if ATTR is not None:
+                cache.put(key, ATTR)
+    return scenario
+
+
+def get_default_scenario_library():
+    """
+    Returns the scenario library configured via the environment variable
+    H2G_SCENARIO_LIBRARY, or None if no library is configured.
+    """
+    path = os.environ.get(SCENARIO_LIBRARY_ENV)
+    if not path:
+        return None
+    return ScenarioLibrary(path)
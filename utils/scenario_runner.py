@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch runner for scenarios of the H2Global mechanism.
+
+Scenarios are read from a JSON or CSV file, evaluated with pymechanism and
+the fiscal model on a process pool and written to a JSON-lines file as soon
+as each scenario is finished. Scenarios which are already contained in the
+output file are skipped, so interrupted sweeps can be resumed. Scenarios
+which failed (lines with "ERROR") are evaluated again on resume, since the
+error may be transient; the last line of a scenario holds its result.
+
+Usage:
+    python -m utils.scenario_runner scenarios.json -o results.jsonl --workers 8
+
+The scenario file is either a list of scenarios, or a grid of the form
+    {"base": {...}, "grid": {"SUBSIDY_VOLUME": [1e9, 2e9], "PERIOD": [10, 15]}}
+whose cartesian product is evaluated. Parameters which are not specified
+take the values of DEFAULT_SCENARIO, which equal the defaults of the app.
+Each scenario is evaluated with utils.h2global_model.
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from utils.h2global_model import DEFAULT_SCENARIO, Scenario, evaluate_scenario as evaluate_model
+
+
+def get_scenario(**kwargs):
+    """
+    Returns a complete scenario dictionary, filled up with DEFAULT_SCENARIO.
+    """
+    unknown = set(kwargs) - set(DEFAULT_SCENARIO)
+    if unknown:
+        raise KeyError("Unknown scenario parameters: " + ", ".join(sorted(unknown)))
+    scenario = dict(DEFAULT_SCENARIO)
+    scenario.update(kwargs)
+    return scenario
+
+
+def get_scenario_id(scenario):
+    """
+    Returns a short, stable identifier of a complete scenario dictionary.
+    """
+    encoded = json.dumps(scenario, sort_keys=True, default=_to_json).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def evaluate_scenario(scenario, store=None, fiscal=True):
+    """
+    Simulates the mechanism and the fiscal model for one scenario and returns
+    a flat, JSON-serializable dictionary of totals and annual mean values.
+    With a ResultStore, mechanism results are reused from and all results
+    are written to the store.
+    """
+
+    scenario = get_scenario(**scenario)
+    results = evaluate_model(Scenario(**scenario), fiscal=fiscal, store=store)
+    SUBSIDY_VOLUME = scenario["SUBSIDY_VOLUME"]
+
+    result = {
+        "SCENARIO_ID" : get_scenario_id(scenario),
+        "SCENARIO" : scenario,
+        "TOTAL_PURCHASES_TONS" : results.TOTAL_PURCHASES_TONS,
+        "TOTAL_PURCHASES_USD" : results.TOTAL_PURCHASES_USD,
+        "TOTAL_USED_FUNDING_USD" : results.TOTAL_USED_FUNDING_USD,
+        "RATIO_FUNDING_UTILIZATION" : results.TOTAL_USED_FUNDING_USD / SUBSIDY_VOLUME if SUBSIDY_VOLUME > 0 else np.nan,
+        "TOTAL_MITIGATED_CO2_TONS" : results.TOTAL_MITIGATED_CO2_TONS,
+        "MAX_ELECTROLYZER_GW" : results.MAX_ELECTROLYZER_GW,
+        "ANNUAL_PURCHASES_TONS" : results["Hydrogen Purchases [tons]"],
+        "ANNUAL_PURCHASES_USD" : results["Hydrogen Purchases [$]"],
+        "ANNUAL_SALES_USD" : results["Annual Sales [$]"],
+        "ANNUAL_USED_FUNDING_USD" : results["Used Funding Volume [$]"],
+        }
+
+    if fiscal:
+        result["FISCAL_NPV"] = results.FISCAL_NPV
+        result["FISCAL_PRESENT_VALUES"] = dict(zip(results.FISCAL_RESULTS["CATEGORIES"], results.FISCAL_RESULTS["PRESENT_VALUES"]))
+
+    return result
+
+
+def _get_store(store_root):
+    #pyarrow is only imported, if a result store is used.
+    if not store_root:
+        return None
+    from utils.result_store import ResultStore
+    return ResultStore(store_root)
+
+
+def _evaluate_scenario_safe(scenario, store_root=None, fiscal=True):
+    #Errors of single scenarios are recorded instead of aborting the sweep.
+    try:
+        return evaluate_scenario(scenario, store=_get_store(store_root), fiscal=fiscal)
+    except Exception as error:
+        scenario = get_scenario(**{k: v for k, v in scenario.items() if k in DEFAULT_SCENARIO})
+        return {
+            "SCENARIO_ID" : get_scenario_id(scenario),
+            "SCENARIO" : scenario,
+            "ERROR" : type(error).__name__ + ": " + str(error),
+            }
+
+
+def get_grid_scenarios(base, grid):
+    """
+    Returns the cartesian product of all values in grid, applied on base.
+    """
+    keys = list(grid)
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def read_scenarios(path):
+    """
+    Reads scenarios from a JSON file (list or grid) or a CSV file (one scenario per row).
+    All returned scenarios are complete, i.e. filled up with DEFAULT_SCENARIO.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            scenarios = [{k: _parse_csv_value(k, v) for k, v in row.items() if v != ""} for row in csv.DictReader(f)]
+    else:
+        with open(path) as f:
+            content = json.load(f)
+        if isinstance(content, dict):
+            scenarios = get_grid_scenarios(content.get("base", {}), content.get("grid", {}))
+        else:
+            scenarios = content
+    return [get_scenario(**s) for s in scenarios]
+
+
+def _parse_csv_value(key, value):
+    default = DEFAULT_SCENARIO.get(key)
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes")
+    if isinstance(default, str) or key in ("PURCHASE_PRICE_PATH", "SALES_PRICE_PATH"):
+        return value
+    if key in ("PURCHASE_PRICE", "SALES_PRICE"):
+        return [float(v) for v in value.split(";")]
+    number = float(value)
+    return int(number) if isinstance(default, int) else number
+
+
+def _read_finished_ids(output_path):
+    finished = set()
+    if os.path.exists(output_path):
+        with open(output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    #____Failed scenarios are evaluated again.
+                    if "ERROR" not in record:
+                        finished.add(record["SCENARIO_ID"])
+                except (ValueError, KeyError, TypeError):
+                    #Skip lines of an interrupted write.
+                    continue
+    return finished
+
+
+def run_scenarios(scenarios, output_path, max_workers=None, progress=None, store_root=None, fiscal=True):
+    """
+    Evaluates all scenarios on a process pool and appends each result to
+    output_path as soon as it is available. Returns the number of scenarios
+    which were evaluated in this call. With store_root, the full results
+    are additionally written to a ResultStore in this directory. With
+    fiscal=False, the fiscal model is skipped.
+    """
+
+    finished = _read_finished_ids(output_path)
+    pending = {}
+    for scenario in scenarios:
+        scenario = get_scenario(**scenario)
+        scenario_id = get_scenario_id(scenario)
+        if scenario_id not in finished:
+            pending[scenario_id] = scenario
+
+    if not pending:
+        return 0
+
+    count = 0
+    with open(output_path, "a") as f, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_evaluate_scenario_safe, s, store_root, fiscal) for s in pending.values()]
+        for future in as_completed(futures):
+            f.write(json.dumps(future.result(), default=_to_json) + "\n")
+            f.flush()
+            count += 1
+            if progress is not None:
+                progress(count, len(futures))
+
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless scenario sweeps of the H2Global mechanism.")
+    parser.add_argument("scenarios", help="JSON file (list of scenarios or base/grid) or CSV file with one scenario per row.")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSON-lines file, to which results are appended.")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("-s", "--store", default=None, help="Directory of a result store for per-path and fiscal results (optional).")
+    parser.add_argument("--no-fiscal", action="store_true", help="Skip the fiscal model.")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print progress.")
+    args = parser.parse_args(argv)
+
+    scenarios = read_scenarios(args.scenarios)
+
+    def progress(done, total):
+        print("Finished scenario", done, "of", total, flush=True)
+
+    count = run_scenarios(scenarios, args.output, max_workers=args.workers, progress=None if args.quiet else progress, store_root=args.store, fiscal=not args.no_fiscal)
+    print("Evaluated", count, "of", len(scenarios), "scenarios. Results in", args.output)
+
+
+if __name__ == "__main__":
+    main()
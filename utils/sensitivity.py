@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+One-at-a-time sensitivity analysis of a scenario (tornado analysis).
+
+Each input parameter is decreased and increased by a relative change, while
+all other parameters keep the values of the baseline scenario. The 2*k
+perturbed scenarios are evaluated together: mechanism inputs which are not
+cached yet are simulated in parallel, perturbations of fiscal parameters reuse
+the simulation of the baseline, and the fiscal model is evaluated for all
+scenarios in one batch.
+"""
+
+import numpy as np
+
+from utils.h2global_model import DICT_DOWNSTREAM_PARAMETERS, ScenarioResults
+from utils.simulation_cache import get_mechanism_attrs
+from utils.fiscal_engine import get_fiscal_cashflows_batch
+from utils.instrumentation import instrumented
+
+#Parameters, which are perturbed by default
+SENSITIVITY_PARAMETERS = (
+    #Mechanism
+    "SUBSIDY_VOLUME",
+    "PURCHASE_PRICE_START",
+    "PURCHASE_PRICE_END",
+    "SALES_PRICE_START",
+    "SALES_PRICE_END",
+    "SALES_PRICE_VOLATILITY",
+    "RATIO_LONGTERM_HSA",
+    "FLOOR_PRICE_HSA",
+    "BID_CAP_HSA",
+    "REINVEST_CYCLES",
+    "RATIO_GUARANTEED_SHORTTERM_HSA",
+    #Fiscal model
+    "GRACE_PERIOD",
+    "WACC",
+    "INFLATION",
+    "CORPORATE_TAX_RATE",
+    "VAT_RATE",
+    "IMPORT_DUTIES_RATE",
+    "SHARE_IMPORTED_PRODUCTION_EQUIPMENT",
+    "SHARE_HPA_CONTRACT",
+    "RAMP_UP",
+    "SHARE_TAXABLE_INCOME",
+    "SHARE_DOMESTIC_SALES",
+    )
+
+#Downstream parameters, which are only perturbed for the respective carrier (without the VAT flag)
+DOWNSTREAM_SENSITIVITY_PARAMETERS = {carrier: PARAMETERS[:-1] for carrier, PARAMETERS in DICT_DOWNSTREAM_PARAMETERS.items()}
+
+#Parameters, which are rounded to whole years or cycles. They change by at least one step.
+_INTEGER_PARAMETERS = ("REINVEST_CYCLES", "GRACE_PERIOD", "RAMP_UP")
+
+#Parameters, which are shares and therefore bounded to [0, 1]
+_SHARE_PARAMETERS = (
+    "RATIO_LONGTERM_HSA", "RATIO_GUARANTEED_SHORTTERM_HSA", "SHARE_IMPORTED_PRODUCTION_EQUIPMENT",
+    "SHARE_HPA_CONTRACT", "SHARE_TAXABLE_INCOME", "SHARE_DOMESTIC_SALES",
+    "SHARE_H2_DRI_DOMESTIC", "SHARE_DOMESTIC_SALES_DRI",
+    "SHARE_NH3_FERTILIZER_DOMESTIC", "SHARE_DOMESTIC_SALES_FERTILIZER",
+    )
+
+
+def get_sensitivity_parameters(scenario):
+    """
+    Returns the default parameters of a sensitivity analysis of scenario.
+    """
+    return SENSITIVITY_PARAMETERS + DOWNSTREAM_SENSITIVITY_PARAMETERS.get(scenario.CARRIER, ())
+
+
+def get_perturbed_values(scenario, PARAMETER, RELATIVE_CHANGE):
+    """
+    Returns the decreased and increased value of a parameter, or None if the
+    parameter cannot be perturbed relatively (value zero, or the special
+    value REINVEST_CYCLES = -1).
+    """
+    value = getattr(scenario, PARAMETER)
+    if value == 0 or (PARAMETER == "REINVEST_CYCLES" and value == -1):
+        return None
+
+    low, high = value*(1-RELATIVE_CHANGE), value*(1+RELATIVE_CHANGE)
+    if PARAMETER in _INTEGER_PARAMETERS:
+        low = min(int(round(low)), value-1)
+        high = max(int(round(high)), value+1)
+        low = max(low, 0)
+        if PARAMETER == "RAMP_UP":
+            high = min(high, scenario.PERIOD)
+    if PARAMETER in _SHARE_PARAMETERS:
+        low, high = max(low, 0.0), min(high, 1.0)
+    return low, high
+
+
+def get_perturbed_scenarios(scenario, RELATIVE_CHANGE=0.1, PARAMETERS=None):
+    """
+    Returns the perturbed parameters and a list of (low, high) scenario pairs.
+    """
+    if PARAMETERS is None:
+        PARAMETERS = get_sensitivity_parameters(scenario)
+
+    NAMES = []
+    SCENARIO_PAIRS = []
+    for PARAMETER in PARAMETERS:
+        values = get_perturbed_values(scenario, PARAMETER, RELATIVE_CHANGE)
+        if values is None:
+            continue
+        NAMES.append(PARAMETER)
+        SCENARIO_PAIRS.append(tuple(scenario.replace(**{PARAMETER: v}) for v in values))
+    return NAMES, SCENARIO_PAIRS
+
+
+def _is_valid(scenario):
+    try:
+        scenario.validate()
+    except ValueError:
+        return False
+    return True
+
+
+@instrumented("fiscal_batch")
+def get_fiscal_npv_batch(results_list):
+    """
+    Returns the fiscal NPV of a list of ScenarioResults, which are evaluated
+    in one batch of the fiscal model. All scenarios share the funding period
+    and the depreciation period, carriers may differ.
+    """
+    FISCAL_PARAMETERS_LIST = [results.scenario.get_fiscal_parameters() for results in results_list]
+    COMMON = ("DEPRECIATION_PERIOD", "CONTRACT_PERIOD_HPA")
+    BATCH_PARAMETERS = {key: FISCAL_PARAMETERS_LIST[0][key] for key in COMMON}
+    for key in FISCAL_PARAMETERS_LIST[0]:
+        if key not in COMMON:
+            BATCH_PARAMETERS[key] = np.array([p[key] for p in FISCAL_PARAMETERS_LIST])
+
+    FISCAL_RESULTS = get_fiscal_cashflows_batch(
+        ANNUAL_PRODUCTION=np.stack([r["Hydrogen Purchases [kg]"] for r in results_list]), #kg
+        ANNUAL_PRODUCT_PURCHASES=np.stack([r["Hydrogen Purchases [$]"] for r in results_list]), #USD
+        ANNUAL_PRODUCT_SALES=np.stack([r["Annual Sales [$]"] for r in results_list]), #USD
+        ANNUAL_FUNDING=np.stack([r["Used Funding Volume [$]"] for r in results_list]), #USD
+        **BATCH_PARAMETERS
+        )
+    return FISCAL_RESULTS["NPV"]
+
+
+@instrumented("sensitivity")
+def run_sensitivity_analysis(scenario, RELATIVE_CHANGE=0.1, PARAMETERS=None, max_workers=None):
+    """
+    Runs a one-at-a-time sensitivity analysis of scenario. Returns a dictionary with
+        "PARAMETERS" : Names of the perturbed parameters (k)
+        "VALUES" : Decreased and increased parameter values, shape (k, 2)
+        "BASELINE" : Fiscal NPV and total traded tons of the baseline
+        "FISCAL_NPV" : Fiscal NPV of the perturbed scenarios, shape (k, 2) [US$]
+        "TOTAL_PURCHASES_TONS" : Total traded tons of the perturbed scenarios, shape (k, 2)
+    Perturbed scenarios which lead to infinite purchases are NaN.
+    """
+
+    scenario.validate()
+    NAMES, SCENARIO_PAIRS = get_perturbed_scenarios(scenario, RELATIVE_CHANGE, PARAMETERS)
+    scenarios = [scenario] + [s for pair in SCENARIO_PAIRS for s in pair]
+    valid = [_is_valid(s) for s in scenarios]
+    valid_scenarios = [s for s, v in zip(scenarios, valid) if v]
+
+    #Mechanism: one parallel evaluation of all uncached input vectors
+    ATTRS = get_mechanism_attrs([s.get_mechanism_inputs() for s in valid_scenarios], max_workers=max_workers)
+    results_list = [ScenarioResults(s, ATTR=ATTR) for s, ATTR in zip(valid_scenarios, ATTRS)]
+
+    #Fiscal model: one batch over all scenarios
+    FISCAL_NPV = np.full(len(scenarios), np.nan)
+    TOTAL_PURCHASES_TONS = np.full(len(scenarios), np.nan)
+    FISCAL_NPV[valid] = get_fiscal_npv_batch(results_list)
+    TOTAL_PURCHASES_TONS[valid] = [r.TOTAL_PURCHASES_TONS for r in results_list]
+
+    return {
+        "PARAMETERS" : NAMES,
+        "VALUES" : np.array([[getattr(s, name) for s in pair] for name, pair in zip(NAMES, SCENARIO_PAIRS)], dtype=np.float64).reshape(-1, 2),
+        "BASELINE" : {"FISCAL_NPV" : FISCAL_NPV[0], "TOTAL_PURCHASES_TONS" : TOTAL_PURCHASES_TONS[0]},
+        "FISCAL_NPV" : FISCAL_NPV[1:].reshape(-1, 2),
+        "TOTAL_PURCHASES_TONS" : TOTAL_PURCHASES_TONS[1:].reshape(-1, 2),
+        }
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache for simulations of the H2Global mechanism.
+
+Simulation results of pymechanism are stored in a bounded LRU cache, which
+lives at module level and is therefore shared across all Streamlit sessions
+of a server process. The cache key is a hash over the full input vector of
+pm.Mechanism, so identical scenarios are only simulated once. Concurrent
+requests of an input vector, which is not cached yet, wait for one simulation.
+
+Simulation results are stored compactly: per-path arrays of identical paths
+(e.g. without sales price volatility) are kept as one path and broadcast,
+and with H2G_RESULT_DTYPE=float32 per-path arrays are stored in single
+precision, which halves the memory of stochastic results.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pymechanism as pm
+
+from utils.instrumentation import measure_stage, register_cache
+
+#Default bounds of the shared simulation cache
+CACHE_MAX_ENTRIES = 128
+CACHE_MAX_BYTES = 512 * 1024**2
+CACHE_TTL_SECONDS = 6 * 3600
+
+#Environment variable with the floating point type of cached per-path arrays, e.g. "float32".
+#____Annual mean values are still accumulated in float64.
+RESULT_DTYPE_ENV = "H2G_RESULT_DTYPE"
+
+
+def get_parameter_hash(**kwargs):
+    """
+    Returns a hex digest over keyword parameters.
+    Arrays are hashed by content, numbers by their float value,
+    so that e.g. 2 and 2.0 map onto the same parameter set.
+    """
+
+    digest = hashlib.sha256()
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        digest.update(key.encode())
+        if isinstance(value, (np.ndarray, list, tuple)):
+            array = np.ascontiguousarray(value, dtype=np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+        elif isinstance(value, (bool, np.bool_)) or value is None or isinstance(value, str):
+            digest.update(repr(value).encode())
+        else:
+            digest.update(repr(float(value)).encode())
+
+    return digest.hexdigest()
+
+
+def get_scenario_hash(
+        purchase_price,
+        sales_price,
+        subsidy_period,
+        subsidy_volume,
+        **kwargs
+        ):
+    """
+    Returns a hex digest over all inputs of pm.Mechanism.
+    """
+    return get_parameter_hash(
+        purchase_price=purchase_price,
+        sales_price=sales_price,
+        subsidy_period=subsidy_period,
+        subsidy_volume=subsidy_volume,
+        **kwargs
+        )
+
+
+def _compact_paths(array, dtype=None):
+    #Returns a (year, path) array of identical paths as broadcast view of one path,
+    #other arrays of float64 in dtype. The returned arrays do not share memory with array.
+    if array.ndim == 2 and array.shape[1] > 1 and (array[:, 1:] == array[:, :1]).all():
+        path = array[:, :1].astype(dtype or array.dtype)
+        path.flags.writeable = False
+        return np.broadcast_to(path, array.shape)
+    if array.ndim == 2 and dtype is not None and array.dtype == np.float64:
+        return array.astype(dtype)
+    return array.copy()
+
+
+def _freeze_attr(ATTR, compact=False, dtype=None):
+    #Copy the attribute dictionary and make all arrays read-only,
+    #because cached entries are shared between sessions.
+    #Arrays which are read-only already (e.g. memory-mapped or broadcast) are not copied.
+    ATTR_FROZEN = {}
+    for key, value in ATTR.items():
+        if isinstance(value, np.ndarray) and value.flags.writeable:
+            value = _compact_paths(value, dtype) if compact else value.copy()
+            if value.flags.writeable:
+                value.flags.writeable = False
+        elif isinstance(value, dict):
+            value = _freeze_attr(value, compact, dtype)
+        ATTR_FROZEN[key] = value
+    return ATTR_FROZEN
+
+
+def _get_nbytes(ATTR):
+    nbytes = 0
+    for value in ATTR.values():
+        if isinstance(value, np.ndarray):
+            #____Broadcast views (stride 0, e.g. identical paths) only hold their distinct elements.
+            nbytes += value.itemsize * int(np.prod([n for n, stride in zip(value.shape, value.strides) if stride != 0]))
+        elif isinstance(value, dict):
+            nbytes += _get_nbytes(value)
+    return nbytes
+
+
+def flatten_attr(ATTR, prefix=""):
+    """
+    Returns a nested attribute dictionary (e.g. with Yearly_Sales_Dict) as
+    flat dictionary with the keys "<prefix><dict>.<key>".
+    """
+    FLAT = {}
+    for key, value in ATTR.items():
+        if isinstance(value, dict):
+            FLAT.update(flatten_attr(value, prefix + key + "."))
+        else:
+            FLAT[prefix + key] = value
+    return FLAT
+
+
+def unflatten_attr(FLAT, prefix=""):
+    """
+    Returns the nested attribute dictionary of flatten_attr.
+    """
+    ATTR = {}
+    for key, value in FLAT.items():
+        target = ATTR
+        *parents, name = key[len(prefix):].split(".")
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[name] = value
+    return ATTR
+
+
+def split_flat_attr(FLAT):
+    """
+    Splits a flat attribute dictionary into its arrays and its scalars,
+    with numpy scalars as Python scalars, e.g. for JSON.
+    """
+    ARRAYS, SCALARS = {}, {}
+    for key, value in FLAT.items():
+        if isinstance(value, np.ndarray):
+            ARRAYS[key] = value
+        else:
+            SCALARS[key] = value.item() if isinstance(value, np.generic) else value
+    return ARRAYS, SCALARS
+
+
+class SimulationCache():
+
+    """
+    Thread-safe LRU cache for the attribute dictionaries (ATTR) of simulated
+    mechanism instances. Entries are evicted by count, by total size of the
+    stored arrays and by age. With compact, (year, path) arrays of entries are
+    stored compactly, see module docstring.
+    """
+
+    def __init__(self,
+                 max_entries=CACHE_MAX_ENTRIES,
+                 max_bytes=CACHE_MAX_BYTES,
+                 ttl_seconds=CACHE_TTL_SECONDS,
+                 compact=False,
+                 dtype=None,
+                 ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.compact = compact
+        self.dtype = np.dtype(dtype) if dtype else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() #key --> (timestamp, nbytes, ATTR)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries and not self._is_expired(key)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def _is_expired(self, key):
+        timestamp = self._entries[key][0]
+        return time.monotonic() - timestamp > self.ttl_seconds
+
+    def _pop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._nbytes -= nbytes
+
+    def _evict(self):
+        #____Drop expired entries first, then least recently used ones.
+        for key in [k for k in self._entries if self._is_expired(k)]:
+            self._pop(key)
+        while self._entries and (len(self._entries) > self.max_entries or self._nbytes > self.max_bytes):
+            self._pop(next(iter(self._entries)))
+
+    def get(self, key, count=True):
+        #With count=False, the lookup is not counted as hit or miss, e.g. a recheck of a counted lookup.
+        with self._lock:
+            if key in self._entries and not self._is_expired(key):
+                self._entries.move_to_end(key)
+                self.hits += count
+                return self._entries[key][2]
+            if key in self._entries:
+                self._pop(key)
+            self.misses += count
+            return None
+
+    def put(self, key, ATTR):
+        #Besides ATTR dictionaries, serialized values (str or bytes) can be cached.
+        if isinstance(ATTR, dict):
+            ATTR = _freeze_attr(ATTR, self.compact, self.dtype)
+            nbytes = _get_nbytes(ATTR)
+        else:
+            nbytes = len(ATTR)
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (time.monotonic(), nbytes, ATTR)
+                self._nbytes += nbytes
+            self._evict()
+        return ATTR
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+class _Flight():
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+
+    """
+    Coalesces concurrent calls with the same key onto one execution: the first
+    caller executes the function, callers which arrive while it is running
+    wait for it and share its result (or its exception).
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {} #key --> _Flight
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def do(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            with measure_stage("simulate_wait"):
+                flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.result
+
+
+#Module-level instances, shared across sessions of the Streamlit server.
+SIMULATION_CACHE = SimulationCache(compact=True, dtype=os.environ.get(RESULT_DTYPE_ENV))
+register_cache("simulation", SIMULATION_CACHE)
+#____Simulations in progress, so that identical requests of concurrent sessions are simulated once.
+SIMULATION_FLIGHTS = SingleFlight()
+
+
+def get_flight_key(cache, key):
+    """
+    Returns the key of a simulation in SIMULATION_FLIGHTS. Simulations are
+    only coalesced, if their results are written to the same cache.
+    """
+    return str(id(cache)) + ":" + key
+
+
+def get_mechanism_attr(
+        purchase_price,
+        sales_price,
+        subsidy_period,
+        subsidy_volume,
+        cache=SIMULATION_CACHE,
+        store=None,
+        carrier=None,
+        **kwargs
+        ):
+    """
+    Returns the attribute dictionary (ATTR) of a simulated pm.Mechanism.
+    The arguments are passed on to pm.Mechanism unchanged. If the same
+    input vector has been simulated before, the cached result is returned;
+    if it is being simulated for another session, that simulation is awaited.
+    The returned arrays are read-only.
+
+    With a persistent store (see utils.result_store.ResultStore), results
+    are read from and written to the partition of carrier, so they survive
+    restarts of the server.
+    """
+
+    key = get_scenario_hash(purchase_price, sales_price, subsidy_period, subsidy_volume, **kwargs)
+
+    ATTR = cache.get(key)
+    if ATTR is not None:
+        return ATTR
+
+    def evaluate():
+        #____The simulation may have finished between the cache lookup and the start of the flight.
+        #____One lookup only, since other sessions evict entries concurrently.
+        ATTR = cache.get(key, count=False)
+        if ATTR is not None:
+            return ATTR
+
+        if store is not None and store.exists(carrier, key):
+            with measure_stage("store_read"):
+                return cache.put(key, store.read_paths(carrier, key))
+
+        with measure_stage("simulate"):
+            ATTR = cache.put(key, simulate_mechanism(purchase_price, sales_price, subsidy_period, subsidy_volume, **kwargs))
+        if store is not None:
+            store.write(carrier, key, ATTR)
+        return ATTR
+
+    return SIMULATION_FLIGHTS.do(get_flight_key(cache, key), evaluate)
+
+
+def simulate_mechanism(
+        purchase_price,
+        sales_price,
+        subsidy_period,
+        subsidy_volume,
+        **kwargs
+        ):
+    """
+    Simulates pm.Mechanism without cache and returns its attribute dictionary.
+    """
+    mechanism_instance = pm.Mechanism(
+        purchase_price=purchase_price,
+        sales_price=sales_price,
+        subsidy_period=subsidy_period,
+        subsidy_volume=subsidy_volume,
+        **kwargs
+        )
+    mechanism_instance.simulate_mechanism()
+    return mechanism_instance.ATTR
+
+
+def _simulate_mechanism_inputs(MECHANISM_INPUTS):
+    return simulate_mechanism(**MECHANISM_INPUTS)
+
+
+def get_mechanism_attrs(MECHANISM_INPUTS_LIST, cache=SIMULATION_CACHE, max_workers=None):
+    """
+    Returns the attribute dictionaries (ATTR) for a list of input vectors of
+    pm.Mechanism, each given as dictionary of keyword arguments. Input vectors
+    which are not cached are simulated in parallel on a process pool and
+    added to the cache. Duplicate input vectors are only simulated once.
+    """
+
+    keys = [get_scenario_hash(**MECHANISM_INPUTS) for MECHANISM_INPUTS in MECHANISM_INPUTS_LIST]
+    ATTRS = {key: cache.get(key) for key in set(keys)}
+    pending = {}
+    serial = {}
+    for key, MECHANISM_INPUTS in zip(keys, MECHANISM_INPUTS_LIST):
+        if ATTRS[key] is not None:
+            continue
+        #____Input vectors, which are simulated for another session, are awaited.
+        if get_flight_key(cache, key) in SIMULATION_FLIGHTS:
+            serial[key] = MECHANISM_INPUTS
+        else:
+            pending[key] = MECHANISM_INPUTS
+
+    if len(pending) == 1 or max_workers == 1:
+        serial.update(pending)
+    elif pending:
+        #____The warm pool of worker processes of the server is used, if configured (see utils.warmup).
+        from utils.warmup import get_worker_pool
+        pool = get_worker_pool() if max_workers is None else None
+        with measure_stage("simulate_batch"):
+            if pool is not None:
+                for key, ATTR in zip(pending, pool.map(_simulate_mechanism_inputs, pending.values())):
+                    ATTRS[key] = cache.put(key, ATTR)
+            else:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    for key, ATTR in zip(pending, executor.map(_simulate_mechanism_inputs, pending.values())):
+                        ATTRS[key] = cache.put(key, ATTR)
+
+    for key, MECHANISM_INPUTS in serial.items():
+        ATTRS[key] = get_mechanism_attr(cache=cache, **MECHANISM_INPUTS)
+
+    return [ATTRS[key] for key in keys]
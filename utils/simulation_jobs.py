@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs for simulations of the H2Global mechanism.
+
+A simulation is submitted with SimulationJobs.submit(), which returns a job
+id at once. The job is executed on a worker pool, outside of the Streamlit
+script thread, in chunks of simulated paths, so that the page can poll the
+progress and show results of the paths simulated so far. Submissions of an
+input vector, which is already simulated by a pending or running job, are
+deduplicated onto that job. Finished results are added to the simulation cache.
+
+The job manager lives at module level and is therefore shared across all
+Streamlit sessions of a server process.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from utils.simulation_cache import (
+    SIMULATION_CACHE, SIMULATION_FLIGHTS, get_flight_key, get_scenario_hash, simulate_mechanism, _simulate_mechanism_inputs
+    )
+from utils.instrumentation import measure_stage
+from utils.warmup import get_worker_pool, warm_up_worker
+
+#Default number of jobs, which are executed at the same time
+JOB_MAX_WORKERS = 2
+#Maximum number of chunks of a job and minimum number of simulated paths per chunk.
+#____Each chunk adds the overhead of one simulation, so small runs are not split.
+JOB_MAX_CHUNKS = 10
+JOB_MIN_CHUNK_PATHS = 2000
+#Number of finished jobs, which are kept for polling
+JOB_MAX_FINISHED = 256
+
+#States of a job
+JOB_PENDING = "PENDING"
+JOB_RUNNING = "RUNNING"
+JOB_DONE = "DONE"
+JOB_FAILED = "FAILED"
+
+
+def get_path_chunks(NUMBER_PATHS, max_chunks=JOB_MAX_CHUNKS, min_chunk_paths=JOB_MIN_CHUNK_PATHS):
+    """
+    Returns the number of paths of each chunk.
+    """
+    NUMBER_CHUNKS = min(max_chunks, max(1, NUMBER_PATHS // min_chunk_paths))
+    return [len(c) for c in np.array_split(np.arange(NUMBER_PATHS), NUMBER_CHUNKS)]
+
+
+def merge_path_chunks(ATTRS):
+    """
+    Merges the attribute dictionaries (ATTR) of simulations of the same input
+    vector with different numbers of paths into one ATTR. The paths of
+    pm.Mechanism are simulated independently of each other, so (year, path)
+    arrays are concatenated along the path axis.
+    """
+    if len(ATTRS) == 1:
+        return ATTRS[0]
+    MERGED = {}
+    for key, value in ATTRS[0].items():
+        if isinstance(value, dict):
+            MERGED[key] = merge_path_chunks([ATTR[key] for ATTR in ATTRS])
+        elif isinstance(value, np.ndarray) and value.ndim == 2:
+            MERGED[key] = np.concatenate([ATTR[key] for ATTR in ATTRS], axis=1)
+        elif key == "NUMBER_SCENARIOS":
+            MERGED[key] = sum(ATTR[key] for ATTR in ATTRS)
+        else:
+            MERGED[key] = value
+    return MERGED
+
+
+def split_path_chunks(ATTR, SIZES):
+    """
+    Splits the ATTR of a simulation into the ATTRs of consecutive chunks of
+    paths with the given number of paths, the inverse of merge_path_chunks.
+    """
+    STARTS = np.cumsum([0] + list(SIZES))
+    CHUNKS = [{} for _ in SIZES]
+    for key, value in ATTR.items():
+        if isinstance(value, dict):
+            for CHUNK, VALUE in zip(CHUNKS, split_path_chunks(value, SIZES)):
+                CHUNK[key] = VALUE
+        elif isinstance(value, np.ndarray) and value.ndim == 2:
+            for i, CHUNK in enumerate(CHUNKS):
+                CHUNK[key] = value[:, STARTS[i]:STARTS[i+1]]
+        elif key == "NUMBER_SCENARIOS":
+            for CHUNK, size in zip(CHUNKS, SIZES):
+                CHUNK[key] = size
+        else:
+            for CHUNK in CHUNKS:
+                CHUNK[key] = value
+    return CHUNKS
+
+
+def broadcast_paths(ATTR, NUMBER_PATHS):
+    """
+    Returns the ATTR of one simulated path as ATTR of NUMBER_PATHS identical
+    paths. The (year, path) arrays are read-only views, which do not copy the path.
+    """
+    BROADCAST = {}
+    for key, value in ATTR.items():
+        if isinstance(value, dict):
+            BROADCAST[key] = broadcast_paths(value, NUMBER_PATHS)
+        elif isinstance(value, np.ndarray) and value.ndim == 2:
+            BROADCAST[key] = np.broadcast_to(value, (value.shape[0], NUMBER_PATHS))
+        elif key == "NUMBER_SCENARIOS":
+            BROADCAST[key] = NUMBER_PATHS
+        else:
+            BROADCAST[key] = value
+    return BROADCAST
+
+
+class SimulationJob():
+
+    """
+    State of one background simulation. PROGRESS is the share of simulated
+    paths, get_partial_attr() returns the ATTR of the paths simulated so far.
+    """
+
+    def __init__(self, key, MECHANISM_INPUTS, carrier=None, store=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.MECHANISM_INPUTS = MECHANISM_INPUTS
+        self.carrier = carrier
+        self.store = store
+        self.state = JOB_PENDING
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        self.NUMBER_PATHS = MECHANISM_INPUTS.get("NUMBER_SCENARIOS", 1000)
+        self._chunks = []
+        self._ATTR = None
+        self._lock = threading.Lock()
+
+    @property
+    def PROGRESS(self):
+        if self.state == JOB_DONE:
+            return 1.0
+        with self._lock:
+            return sum(ATTR["NUMBER_SCENARIOS"] for ATTR in self._chunks) / self.NUMBER_PATHS
+
+    @property
+    def done(self):
+        return self.state in (JOB_DONE, JOB_FAILED)
+
+    @property
+    def ATTR(self):
+        """
+        ATTR of all simulated paths, None until the job is done.
+        """
+        return self._ATTR
+
+    def get_partial_attr(self):
+        """
+        Returns the ATTR of the paths simulated so far, or None.
+        """
+        if self._ATTR is not None:
+            return self._ATTR
+        with self._lock:
+            chunks = list(self._chunks)
+        return merge_path_chunks(chunks) if chunks else None
+
+    def get_status(self):
+        return {
+            "ID" : self.id,
+            "STATE" : self.state,
+            "PROGRESS" : self.PROGRESS,
+            "ERROR" : self.error,
+            "SECONDS" : (self.finished or time.time()) - self.submitted,
+            }
+
+
+class SimulationJobs():
+
+    """
+    Thread-safe manager of background simulations. Jobs are executed by
+    worker threads; with processes=True, the chunks of the jobs are simulated
+    on an own process pool, so that simulations run outside of the server
+    process. By default (processes=None), the warm pool of worker processes
+    of the server is used, if configured (see utils.warmup).
+    """
+
+    def __init__(self, max_workers=JOB_MAX_WORKERS, processes=None, cache=SIMULATION_CACHE, max_chunks=JOB_MAX_CHUNKS):
+        self.max_workers = max_workers
+        self.processes = processes
+        self.cache = cache
+        self.max_chunks = max_chunks
+        self._jobs = OrderedDict() #job id --> SimulationJob
+        self._inflight = {} #scenario hash --> SimulationJob, which is pending or running
+        self._executor = None
+        self._process_executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        #Pools are created on first submission, so that importing this module is cheap.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="h2g-job")
+            if self.processes:
+                self._process_executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=warm_up_worker)
+            elif self.processes is None:
+                self._process_executor = get_worker_pool()
+        return self._executor
+
+    def submit(self, MECHANISM_INPUTS, carrier=None, store=None):
+        """
+        Submits the simulation of an input vector of pm.Mechanism and returns
+        the job id. If the input vector is cached, the job is done at once;
+        if it is simulated by a pending or running job, that job's id is returned.
+        """
+        key = get_scenario_hash(**MECHANISM_INPUTS)
+        with self._lock:
+            if key in self._inflight:
+                return self._inflight[key].id
+            job = SimulationJob(key, MECHANISM_INPUTS, carrier=carrier, store=store)
+            self._jobs[job.id] = job
+            ATTR = self.cache.get(key)
+            if ATTR is not None:
+                self._finish(job, ATTR)
+                self._discard_finished()
+                return job.id
+            self._inflight[key] = job
+            self._get_executor().submit(self._run, job)
+        return job.id
+
+    def submit_scenario(self, scenario, store=None):
+        """
+        Submits the simulation of a Scenario, see submit().
+        """
+        return self.submit(scenario.get_mechanism_inputs(), carrier=scenario.CARRIER, store=store)
+
+    def get(self, job_id):
+        """
+        Returns the job with job_id, or None if it is unknown or discarded.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_status(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError("Unknown job id: " + str(job_id))
+        return job.get_status()
+
+    def wait(self, job_id, timeout=None, interval=0.05):
+        """
+        Blocks until the job is done and returns it.
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError("Unknown job id: " + str(job_id))
+        start = time.monotonic()
+        while not job.done:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("Job " + job_id + " is not done after " + str(timeout) + " s.")
+            time.sleep(interval)
+        return job
+
+    def _simulate_chunk(self, MECHANISM_INPUTS):
+        if self._process_executor is not None:
+            return self._process_executor.submit(_simulate_mechanism_inputs, MECHANISM_INPUTS).result()
+        return simulate_mechanism(**MECHANISM_INPUTS)
+
+    def _simulate_job(self, job):
+        #____The input vector may have been simulated for another session in the meantime.
+        #____One lookup only, since other sessions evict entries concurrently.
+        ATTR = self.cache.get(job.key, count=False)
+        if ATTR is not None:
+            return ATTR
+        with measure_stage("simulate_job"):
+            if job.store is not None and job.store.exists(job.carrier, job.key):
+                ATTR = job.store.read_paths(job.carrier, job.key)
+            else:
+                #____2-D price paths (year, path) are split like the outputs, so each chunk simulates its own columns.
+                for CHUNK_INPUTS in split_path_chunks(job.MECHANISM_INPUTS, get_path_chunks(job.NUMBER_PATHS, self.max_chunks)):
+                    ATTR = self._simulate_chunk(CHUNK_INPUTS)
+                    with job._lock:
+                        job._chunks.append(ATTR)
+                ATTR = merge_path_chunks(job._chunks)
+                if job.store is not None:
+                    job.store.write(job.carrier, job.key, ATTR)
+        return self.cache.put(job.key, ATTR)
+
+    def _run(self, job):
+        job.state = JOB_RUNNING
+        try:
+            #Synchronous simulations of the same input vector (see get_mechanism_attr) share the result.
+            ATTR = SIMULATION_FLIGHTS.do(get_flight_key(self.cache, job.key), lambda: self._simulate_job(job))
+        except Exception as error:
+            job.error = repr(error)
+            job.state = JOB_FAILED
+            job.finished = time.time()
+        else:
+            with self._lock:
+                self._finish(job, ATTR)
+        finally:
+            with self._lock:
+                self._inflight.pop(job.key, None)
+                self._discard_finished()
+
+    def _finish(self, job, ATTR):
+        job._ATTR = ATTR
+        job._chunks = []
+        job.finished = time.time()
+        job.state = JOB_DONE
+
+    def _discard_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(len(finished) - JOB_MAX_FINISHED, 0)]:
+            del self._jobs[job_id]
+
+
+#Module-level instance, shared across sessions of the Streamlit server.
+SIMULATION_JOBS = SimulationJobs()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Surrogate models of the H2Global mechanism for interactive what-if analyses.
+
+A surrogate interpolates the annual mean results of pm.Mechanism (purchases,
+sales, used funding) over the purchase prices and sales prices, for fixed
+values of all other mechanism inputs (funding period, sales agreements,
+re-usage cycles) and without sales price volatility. All results scale
+linearly with the funding volume, so they are interpolated per US$ of funding
+and the funding volume is exact.
+
+The sales prices are parametrized as ratio to the purchase prices, and the
+design covers ratios below one, where the results are smooth. The design is a
+Latin hypercube, the interpolator a radial basis function interpolator of
+scipy. The error bound of a surrogate is the maximal relative error of the
+totals over the contract period at validation points, which are simulated
+in addition to the design.
+
+Surrogates are built with the CLI and loaded by the app from H2G_SURROGATE_DIR
+(default: surrogates/ in the root of the app):
+
+    python -m utils.surrogate -o surrogates
+"""
+
+import argparse
+import glob
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.h2global_model import DICT_LHV, Scenario, ScenarioResults, get_price_defaults
+from utils.simulation_cache import SimulationCache, get_mechanism_attrs, get_parameter_hash
+
+#Environment variable with the directory of the surrogates of the app
+SURROGATE_DIR_ENV = "H2G_SURROGATE_DIR"
+SURROGATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "surrogates")
+
+#Interpolated inputs: purchase prices [US$/kg] and ratios of sales price to purchase price
+SURROGATE_INPUTS = ("PURCHASE_PRICE_START", "PURCHASE_PRICE_END", "SALES_PRICE_RATIO_START", "SALES_PRICE_RATIO_END")
+#Interpolated annual mean values of ATTR
+SURROGATE_OUTPUTS = (
+    "Yearly_Product_Purchases",
+    "Yearly_Product_Purchases_LONG",
+    "Yearly_Purchases_LONG",
+    "Yearly_Purchases_SHORT",
+    "Yearly_Used_Funding",
+    "Yearly_Sales",
+    )
+#Mechanism inputs, which are fixed for one surrogate
+SURROGATE_FIXED_PARAMETERS = (
+    "PERIOD",
+    "RATIO_LONGTERM_HSA",
+    "FLOOR_PRICE_HSA",
+    "BID_CAP_HSA",
+    "REINVEST_CYCLES",
+    "RATIO_GUARANTEED_SHORTTERM_HSA",
+    )
+
+#Default design: purchase prices relative to the default purchase price of the carrier, and ratios
+SURROGATE_PURCHASE_PRICE_FACTORS = (0.5, 2.0)
+SURROGATE_SALES_PRICE_RATIOS = (0.05, 0.95)
+SURROGATE_POINTS = 512
+SURROGATE_VALIDATION_POINTS = 128
+SURROGATE_KERNEL = "quintic"
+
+
+def get_surrogate_inputs(scenario):
+    """
+    Returns the interpolated inputs of scenario, see SURROGATE_INPUTS.
+    """
+    return np.array([
+        scenario.PURCHASE_PRICE_START,
+        scenario.PURCHASE_PRICE_END,
+        scenario.SALES_PRICE_START / scenario.PURCHASE_PRICE_START if scenario.PURCHASE_PRICE_START > 0 else np.inf,
+        scenario.SALES_PRICE_END / scenario.PURCHASE_PRICE_END if scenario.PURCHASE_PRICE_END > 0 else np.inf,
+        ])
+
+
+def _get_design_scenario(scenario, x):
+    return scenario.replace(
+        PURCHASE_PRICE_START=float(x[0]),
+        PURCHASE_PRICE_END=float(x[1]),
+        SALES_PRICE_START=float(x[2]*x[0]),
+        SALES_PRICE_END=float(x[3]*x[1]),
+        SUBSIDY_VOLUME=1e9,
+        NUMBER_PATHS=1,
+        SALES_PRICE_VOLATILITY=0.0,
+        PURCHASE_PRICE=None,
+        SALES_PRICE=None,
+        PURCHASE_PRICE_PATH=None,
+        SALES_PRICE_PATH=None,
+        )
+
+
+def _evaluate_design(scenario, X, max_workers=None):
+    #Returns the annual mean results per US$ of funding, shape (points, outputs, years).
+    #____Design points are simulated with a private cache, so that the cache of the app is not flushed.
+    scenarios = [_get_design_scenario(scenario, x) for x in X]
+    ATTRS = get_mechanism_attrs(
+        [s.get_mechanism_inputs() for s in scenarios],
+        cache=SimulationCache(max_entries=len(scenarios)+1),
+        max_workers=max_workers
+        )
+    return np.array([[ATTR[key].mean(axis=1) for key in SURROGATE_OUTPUTS] for ATTR in ATTRS]) / 1e9
+
+
+class MechanismSurrogate():
+
+    """
+    Interpolator of the annual mean results of pm.Mechanism for the fixed
+    mechanism inputs FIXED, on the box LOWER <= inputs <= UPPER (see
+    SURROGATE_INPUTS). ERROR_BOUND holds the maximal relative error of the
+    total of each output at the validation points.
+    """
+
+    def __init__(self, FIXED, LOWER, UPPER, X, Y, ERROR_BOUND, kernel=SURROGATE_KERNEL):
+        #scipy is only imported, if a surrogate is used.
+        from scipy.interpolate import RBFInterpolator
+
+        self.FIXED = dict(FIXED)
+        self.LOWER = np.asarray(LOWER, dtype=np.float64)
+        self.UPPER = np.asarray(UPPER, dtype=np.float64)
+        self.X = np.asarray(X, dtype=np.float64)
+        self.Y = np.asarray(Y, dtype=np.float64)
+        self.ERROR_BOUND = dict(ERROR_BOUND)
+        self.kernel = kernel
+        self._interpolator = RBFInterpolator(self._normalize(self.X), self.Y.reshape(len(self.Y), -1), kernel=kernel)
+
+    def _normalize(self, X):
+        return (X - self.LOWER) / (self.UPPER - self.LOWER)
+
+    def covers(self, scenario):
+        """
+        Returns True, if scenario is within the range of the surrogate.
+        """
+        if scenario.SALES_PRICE_VOLATILITY != 0 or any(
+                getattr(scenario, name) is not None for name in ("PURCHASE_PRICE", "SALES_PRICE", "PURCHASE_PRICE_PATH", "SALES_PRICE_PATH")):
+            return False
+        if any(getattr(scenario, name) != value for name, value in self.FIXED.items()):
+            return False
+        x = get_surrogate_inputs(scenario)
+        return bool(np.all(x >= self.LOWER) and np.all(x <= self.UPPER))
+
+    def predict_attr(self, scenario):
+        """
+        Returns the approximate ATTR of scenario with the keys
+        SURROGATE_OUTPUTS, as arrays of shape (year, 1).
+        """
+        if not self.covers(scenario):
+            raise ValueError("Scenario is not within the range of the surrogate.")
+        Y = self._interpolator(self._normalize(get_surrogate_inputs(scenario))[np.newaxis, :])
+        Y = Y.reshape(len(SURROGATE_OUTPUTS), -1) * scenario.SUBSIDY_VOLUME
+        return {key: Y[i][:, np.newaxis] for i, key in enumerate(SURROGATE_OUTPUTS)}
+
+    def get_results(self, scenario):
+        """
+        Returns approximate ScenarioResults of scenario. Annual mean values
+        and derived columns are available, standard deviations are zero.
+        """
+        return ScenarioResults(scenario, ATTR=self.predict_attr(scenario))
+
+    def get_error_bound(self, OUTPUTS=SURROGATE_OUTPUTS):
+        """
+        Returns the maximal error bound of OUTPUTS, relative to their totals.
+        """
+        return max(self.ERROR_BOUND[key] for key in OUTPUTS)
+
+    def save(self, path):
+        np.savez(
+            path,
+            FIXED=json.dumps(self.FIXED),
+            LOWER=self.LOWER,
+            UPPER=self.UPPER,
+            X=self.X,
+            Y=self.Y,
+            ERROR_BOUND=json.dumps(self.ERROR_BOUND),
+            KERNEL=self.kernel,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as DATA:
+            return cls(
+                FIXED=json.loads(str(DATA["FIXED"])),
+                LOWER=DATA["LOWER"],
+                UPPER=DATA["UPPER"],
+                X=DATA["X"],
+                Y=DATA["Y"],
+                ERROR_BOUND=json.loads(str(DATA["ERROR_BOUND"])),
+                kernel=str(DATA["KERNEL"]),
+                )
+
+
+def get_surrogate_bounds(scenario):
+    """
+    Returns the default lower and upper bounds of the design around the
+    default purchase price of the carrier of scenario.
+    """
+    PURCHASE_PRICE = get_price_defaults(scenario.CARRIER)[0]
+    lower = [PURCHASE_PRICE*SURROGATE_PURCHASE_PRICE_FACTORS[0]]*2 + [SURROGATE_SALES_PRICE_RATIOS[0]]*2
+    upper = [PURCHASE_PRICE*SURROGATE_PURCHASE_PRICE_FACTORS[1]]*2 + [SURROGATE_SALES_PRICE_RATIOS[1]]*2
+    return np.array(lower), np.array(upper)
+
+
+def build_surrogate(
+        scenario,
+        LOWER=None,
+        UPPER=None,
+        n_points=SURROGATE_POINTS,
+        n_validation=SURROGATE_VALIDATION_POINTS,
+        kernel=SURROGATE_KERNEL,
+        seed=0,
+        max_workers=None
+        ):
+    """
+    Builds the surrogate for the fixed mechanism inputs of scenario on a
+    Latin hypercube design of n_points within LOWER and UPPER (default: see
+    get_surrogate_bounds) and estimates its error on n_validation further points.
+    """
+    from scipy.stats import qmc
+
+    if LOWER is None or UPPER is None:
+        LOWER, UPPER = get_surrogate_bounds(scenario)
+    LOWER, UPPER = np.asarray(LOWER, dtype=np.float64), np.asarray(UPPER, dtype=np.float64)
+
+    X = LOWER + qmc.LatinHypercube(d=len(SURROGATE_INPUTS), seed=seed).random(n_points) * (UPPER - LOWER)
+    X_VALIDATION = LOWER + qmc.LatinHypercube(d=len(SURROGATE_INPUTS), seed=seed+1).random(n_validation) * (UPPER - LOWER)
+    Y = _evaluate_design(scenario, np.concatenate([X, X_VALIDATION]), max_workers=max_workers)
+    Y, Y_VALIDATION = Y[:n_points], Y[n_points:]
+
+    surrogate = MechanismSurrogate(
+        FIXED={name: getattr(scenario, name) for name in SURROGATE_FIXED_PARAMETERS},
+        LOWER=LOWER,
+        UPPER=UPPER,
+        X=X,
+        Y=Y,
+        ERROR_BOUND={key: 0.0 for key in SURROGATE_OUTPUTS},
+        kernel=kernel,
+        )
+
+    #Error bound: maximal relative error of the totals over the contract period
+    Y_PREDICTED = surrogate._interpolator(surrogate._normalize(X_VALIDATION)).reshape(Y_VALIDATION.shape)
+    TOTALS = Y_VALIDATION.sum(axis=2)
+    ERRORS = np.abs(Y_PREDICTED.sum(axis=2) - TOTALS)
+    #____Totals of zero (e.g. no purchases from sales revenue) are compared to the largest total of the output.
+    SCALE = np.maximum(np.abs(TOTALS), 1e-9*np.abs(TOTALS).max(axis=0, initial=0))
+    RELATIVE_ERRORS = np.divide(ERRORS, SCALE, out=np.zeros_like(ERRORS), where=SCALE > 0)
+    surrogate.ERROR_BOUND = {key: float(RELATIVE_ERRORS[:, i].max()) for i, key in enumerate(SURROGATE_OUTPUTS)}
+    return surrogate
+
+
+def get_surrogate_filename(surrogate):
+    return "surrogate-" + get_parameter_hash(LOWER=surrogate.LOWER, UPPER=surrogate.UPPER, **surrogate.FIXED)[:16] + ".npz"
+
+
+_default_surrogates = None
+_default_surrogates_lock = threading.Lock()
+
+
+def get_default_surrogates():
+    """
+    Returns the surrogates of the app in H2G_SURROGATE_DIR (default:
+    surrogates/ in the root of the app), which are loaded on first use.
+    """
+    global _default_surrogates
+    with _default_surrogates_lock:
+        if _default_surrogates is None:
+            directory = os.environ.get(SURROGATE_DIR_ENV) or SURROGATE_DIR
+            _default_surrogates = [MechanismSurrogate.load(path) for path in sorted(glob.glob(os.path.join(directory, "surrogate-*.npz")))]
+    return _default_surrogates
+
+
+def find_surrogate(scenario, surrogates=None, fixed_only=False):
+    """
+    Returns the first surrogate, which covers scenario, or None. With
+    fixed_only, only the fixed mechanism inputs are compared, not the range
+    of the interpolated inputs.
+    """
+    if surrogates is None:
+        surrogates = get_default_surrogates()
+    for surrogate in surrogates:
+        if fixed_only and all(getattr(scenario, name) == value for name, value in surrogate.FIXED.items()):
+            return surrogate
+        if surrogate.covers(scenario):
+            return surrogate
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds surrogate models of pm.Mechanism for the what-if analysis of the app.")
+    parser.add_argument("-o", "--output", default=SURROGATE_DIR, help="Directory of the surrogate files.")
+    parser.add_argument("--carriers", nargs="+", default=["Hydrogen", "Ammonia"], choices=tuple(DICT_LHV), help="Carriers, whose default prices define the ranges.")
+    parser.add_argument("--periods", nargs="+", type=int, default=[5, 10, 15, 20], help="Funding periods [years].")
+    parser.add_argument("--points", type=int, default=SURROGATE_POINTS, help="Number of design points.")
+    parser.add_argument("--validation-points", type=int, default=SURROGATE_VALIDATION_POINTS, help="Number of validation points.")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    for carrier in args.carriers:
+        for period in args.periods:
+            scenario = Scenario(CARRIER=carrier, PERIOD=period, DEPRECIATION_PERIOD=max(Scenario.DEPRECIATION_PERIOD, period))
+            surrogate = build_surrogate(scenario, n_points=args.points, n_validation=args.validation_points)
+            path = os.path.join(args.output, get_surrogate_filename(surrogate))
+            surrogate.save(path)
+            print(
+                carrier, "period", period, "--> error bound of the totals:",
+                {key: round(value, 5) for key, value in surrogate.ERROR_BOUND.items()},
+                "-->", path, flush=True
+                )
+
+
+if __name__ == "__main__":
+    main()
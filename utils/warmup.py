@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-up of the compute stack of the app and the pool of worker processes.
+
+The first evaluation in a fresh server process pays for importing
+pymechanism, pandas and plotly, for the first simulation and for loading the
+plotly templates and validators (about one second in total). start_warmup()
+does this once per process in a background thread:
+
+    simulate  tiny dummy simulation of pm.Mechanism and of the fiscal model
+    charts    import of pandas and plotly, construction and serialization
+              of all figures of the evaluation page for the dummy results
+    workers   start of the worker processes, see get_worker_pool()
+
+With H2G_WORKER_PROCESSES set, simulations of background jobs (see
+utils.simulation_jobs) and batches of simulations (see
+simulation_cache.get_mechanism_attrs) run on one pool of worker processes,
+which is kept for the lifetime of the server. Each worker runs the dummy
+simulation when it is started, so it is ready before the first request.
+
+The warm-up is started by the first script run of the app; a readiness
+probe, which requests the app after a deploy, therefore warms the server
+before users arrive. It can also be run from the command line, which prints
+the duration of each step:
+
+    python -m utils.warmup
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from utils.instrumentation import measure_stage
+
+#Environment variable, which disables the warm-up with "0".
+WARMUP_ENV = "H2G_WARMUP"
+#Environment variable with the number of worker processes for simulations.
+#____Without it, simulations run in threads of the server process.
+WORKER_PROCESSES_ENV = "H2G_WORKER_PROCESSES"
+
+#Scenario of the dummy simulation: as small as possible, but with all stages of the models.
+WARMUP_SCENARIO = {"PERIOD": 2, "NUMBER_PATHS": 2}
+
+_warmup_thread = None
+_worker_pool = None
+_lock = threading.Lock()
+
+
+def _get_warmup_scenario():
+    from utils.h2global_model import Scenario
+    return Scenario(**WARMUP_SCENARIO)
+
+
+def warm_up_worker():
+    """
+    Runs the dummy simulation in the current process. Initializer of the
+    worker processes.
+    """
+    from utils.simulation_cache import simulate_mechanism
+    simulate_mechanism(**_get_warmup_scenario().get_mechanism_inputs())
+
+
+def _wait_for_worker():
+    #No-op task, which blocks a worker until it is started and initialized.
+    return os.getpid()
+
+
+def get_worker_count():
+    return int(os.environ.get(WORKER_PROCESSES_ENV) or 0)
+
+
+def get_worker_pool():
+    """
+    Returns the pool of worker processes of the server, configured via the
+    environment variable H2G_WORKER_PROCESSES, or None if no pool is
+    configured. The pool is created once per process.
+    """
+    global _worker_pool
+    if get_worker_count() <= 0:
+        return None
+    with _lock:
+        if _worker_pool is None:
+            _worker_pool = ProcessPoolExecutor(max_workers=get_worker_count(), initializer=warm_up_worker)
+    return _worker_pool
+
+
+def warm_up(charts=True):
+    """
+    Warms the compute stack in the current process, see module docstring.
+    Returns the duration of each step in seconds.
+    """
+    from utils.h2global_model import ScenarioResults
+    from utils.simulation_cache import simulate_mechanism
+
+    SECONDS = {}
+    start = time.perf_counter()
+    with measure_stage("warmup:simulate"):
+        #____The dummy scenario is simulated without cache and not memoized, so the shared caches are left untouched.
+        scenario = _get_warmup_scenario()
+        results = ScenarioResults(scenario, ATTR=simulate_mechanism(**scenario.get_mechanism_inputs()), memoize=False)
+        results.FISCAL_NPV
+    SECONDS["simulate"] = time.perf_counter() - start
+
+    if charts:
+        start = time.perf_counter()
+        with measure_stage("warmup:charts"):
+            from utils.h2global_charts import METRICS
+            for function, _ in METRICS.values():
+                function(results).to_json()
+        SECONDS["charts"] = time.perf_counter() - start
+
+    pool = get_worker_pool()
+    if pool is not None:
+        start = time.perf_counter()
+        with measure_stage("warmup:workers"):
+            wait([pool.submit(_wait_for_worker) for _ in range(get_worker_count())])
+        SECONDS["workers"] = time.perf_counter() - start
+    return SECONDS
+
+
+def start_warmup():
+    """
+    Starts the warm-up in a daemon thread, once per process, unless it is
+    disabled via H2G_WARMUP=0. Returns the thread, or None.
+    """
+    global _warmup_thread
+    if os.environ.get(WARMUP_ENV) == "0":
+        return None
+    with _lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=warm_up, name="h2g-warmup", daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Warms the compute stack of the H2Global app and prints the duration of each step.")
+    parser.add_argument("--no-charts", action="store_true", help="Skip the warm-up of pandas and plotly.")
+    args = parser.parse_args(argv)
+    for step, seconds in warm_up(charts=not args.no_charts).items():
+        print(step, round(seconds*1e3, 1), "[ms]")
+
+
+if __name__ == "__main__":
+    main()